@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# Relay actuation for the heat tents
+#
+# Usage: python actuator.py [relays.csv]
+#
+# Prints how often each zone's heater changed state and how long it
+# spent in each state, from the transition log the controller writes:
+# one "timestamp,zone,from,to,held" line per change, held being the
+# seconds spent in the previous state. The log is rotated daily like
+# sensors.csv, and the rotated files are read too.
+
+import argparse
+import codecs
+import logging
+import time
+
+from readings import parse_stamp
+from recordwriter import history
+
+# Relay levels (fan, stage one, stage two) for each heater state
+RELAY_LEVELS = {"OFF": (False, False, False),
+                "FAN": (True, False, False),
+                "ST1": (True, True, False),
+                "ST2": (True, True, True)}
+
+
+class RelayActuator(object):
+    """
+    Drives one relay group. The level last written to each pin is
+    cached so a pin is only written when its level changes, a new
+    state is held back until the current one has lasted min_dwell
+    seconds (or the min_dwell given to apply()), and each change of
+    state is logged and handed to `journal`, which is called with the
+    time of the change and the ",zone,from,to,held" fields of its
+    transition log row and must not block. The actuator must be the
+    only writer of its pins.
+    """
+
+    def __init__(self, gpio, pins, name='tent', min_dwell=30,
+                 journal=None, clock=time.time, logger=None):
+        self.gpio = gpio
+        # Fan, stage one and stage two relay pins
+        self.pins = tuple(pins)
+        self.name = name
+        self.min_dwell = min_dwell
+        # Receives each transition log row; None disables the log
+        self.journal = journal
+        self.clock = clock
+        self.logger = logger or logging.getLogger("Controller")
+
+        # Level last written to each pin; None until first written
+        self.levels = dict((pin, None) for pin in self.pins)
+        for pin in self.pins:
+            self.gpio.setup_output(pin)
+
+        # Current state, when it was entered and whether it is held
+        self.state = None
+        self.since = None
+        self.held = False
+
+        # Pin writes and state changes, for benchmarking
+        self.writes = 0
+        self.transitions = 0
+
+    def apply(self, state, stamp=None, force=False, min_dwell=None):
+        """
+        Drive the relays for a heater state and return the state they
+        are in, which is the previous one while it is held for
+        min_dwell seconds, by default the actuator's. With force set,
+        every pin is written and the state is not held, i.e. to pull
+        the relays low at startup.
+        """
+
+        stamp = self.clock() if stamp is None else stamp
+        if not force:
+            if state == self.state:
+                return state
+            if min_dwell is None:
+                min_dwell = self.min_dwell
+            if self.held and stamp - self.since < min_dwell:
+                return self.state
+
+        for pin, level in zip(self.pins, RELAY_LEVELS[state]):
+            if force or self.levels[pin] != level:
+                self.gpio.output(pin, level)
+                self.levels[pin] = level
+                self.writes += 1
+
+        if self.state is not None and state != self.state:
+            self.transitions += 1
+            self.record(stamp, self.state, state, stamp - self.since)
+        if state != self.state:
+            self.since = stamp
+        self.state = state
+        self.held = not force
+        return state
+
+    def record(self, stamp, before, after, held):
+        """
+        Log a change of state and hand it to the transition log.
+        """
+
+        self.logger.info('Zone %s relays %s -> %s after %d s',
+                         self.name, before, after, held)
+        if self.journal is not None:
+            self.journal(stamp, ',%s,%s,%s,%d' % (self.name, before,
+                                                  after, held))
+
+
+def summarize(filename='relays.csv'):
+    """
+    Return {zone: (transitions, {state: seconds}, shortest)} from a
+    transition log and its rotated files, shortest being the briefest
+    time a state was held.
+    """
+
+    zones = {}
+    for path in history(filename):
+        with codecs.open(path, 'r', 'utf-8') as log:
+            for line in log:
+                fields = line.strip().split(',')
+                if len(fields) != 5:
+                    continue
+                try:
+                    parse_stamp(fields[0])
+                    held = int(fields[4])
+                except ValueError:
+                    continue
+                name, before = fields[1], fields[2]
+                count, durations, shortest = zones.get(name, (0, {}, None))
+                durations[before] = durations.get(before, 0) + held
+                if shortest is None or held < shortest:
+                    shortest = held
+                zones[name] = (count + 1, durations, shortest)
+    return zones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Summarize the heater transition log.')
+    parser.add_argument('log', nargs='?', default='relays.csv',
+                        help='transition log (default: relays.csv)')
+    args = parser.parse_args(argv)
+
+    if not history(args.log):
+        parser.error('%s does not exist' % args.log)
+    for name, (count, durations, shortest) in sorted(
+            summarize(args.log).items()):
+        print('%s: %d transitions, shortest state %d s, %s' % (
+            name, count, shortest, ', '.join(
+                '%s %.1f h' % (state, seconds / 3600.0)
+                for state, seconds in sorted(durations.items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1368 @@
+#!/usr/bin/env python
+
+# Off-device benchmarks for the thermostat controllers
+#
+# Usage: python benchmark.py [name ...] [--save FILE]
+#            [--baseline FILE] [--tolerance 0.25]
+# Runs every benchmark when no name is given. Figures returned by a
+# benchmark, i.e. soak's, can be saved as a baseline; compared against
+# one, the run exits non-zero when a figure has regressed.
+
+import argparse
+import codecs
+import json
+import os
+import selectors
+import shutil
+import socket
+import string
+import sys
+import tempfile
+import time
+
+import bus
+import metrics
+from cycletimer import CycleTimer
+import outdoorfeed
+import readings
+import sensor
+from readscheduler import ReadScheduler
+import recordwriter
+from recordwriter import RecordWriter
+
+
+def timed(func, repeat):
+    """
+    Call func repeat times and return the mean seconds per call.
+    """
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_scan(repeat=2000):
+    """
+    In-process I2C scan over a fake bus with eight sensors and an RTC.
+    """
+
+    fake = bus.FakeBus([0x18 + i for i in range(8)] + [0x68])
+    per_scan = timed(lambda: bus.scan(fake, {0x68}), repeat)
+    print('scan: %.1f us/scan, %d probes/scan' %
+          (per_scan * 1e6, fake.transactions // repeat))
+
+
+class SlowSensor(object):
+    """
+    Simulated sensor type whose read blocks for a fixed latency.
+    """
+
+    def __init__(self, latency, bus_id, count=1):
+        self.latency = latency
+        self.bus_id = bus_id
+        self.count = count
+
+    def read(self):
+        # One bus transaction per attached sensor
+        time.sleep(self.latency * self.count)
+        return [sensor.Reading(0x18 + i, 20.0, self.latency, sensor.OK)
+                for i in range(self.count)]
+
+
+def bench_restart(cycles=10, downtime=90, repeat=1000):
+    """
+    A heat tent restarted after a watchdog reboot, cold and from its
+    state snapshot: the relay state it starts with, the I2C probes made
+    before its first decision and the cost of writing and reading the
+    snapshot.
+    """
+
+    import simulation
+    import snapshot
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.mktime((2026, 1, 1, 0, 0, 0, 0, 0, -1))
+        controller, _, _ = simulation.build('heat', ['68'], seed=1,
+                                            start=start)
+        controller.main(cycles)
+        before = controller.zones[0].actuator.state
+        size = os.path.getsize(controller.snapshot_file)
+
+        for warm in (False, True):
+            if not warm:
+                os.rename(controller.snapshot_file, 'saved.bin')
+            else:
+                os.rename('saved.bin', controller.snapshot_file)
+            restarted, _, _ = simulation.build(
+                'heat', ['68'], seed=1,
+                start=start + cycles * 60 + downtime)
+            i2c = restarted.sensors[0].bus
+            seen = []
+            control = restarted.control
+
+            def first(sample):
+                if not seen:
+                    seen.append((restarted.zones[0].actuator.state,
+                                 i2c.transactions))
+                control(sample)
+            restarted.control = first
+            restarted.main(1)
+            relays, probes = seen[0]
+            print('restart: %-4s relays %s at first decision (were %s), '
+                  '%d I2C probes before it' %
+                  ('warm' if warm else 'cold', relays, before, probes))
+
+        state = restarted.snapshot()
+        saving = timed(lambda: snapshot.save('bench.bin', state), repeat)
+        loading = timed(lambda: snapshot.load('bench.bin'), repeat)
+        print('restart: %d byte snapshot, saved in %.1f us, loaded in '
+              '%.1f us' % (size, saving * 1e6, loading * 1e6))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def bench_reads(latency=0.02, repeat=5):
+    """
+    Sequential reads against the concurrent read scheduler for
+    eight I2C sensors on each of two buses plus a serial CO2 sensor.
+    """
+
+    sensors = [SlowSensor(latency, 'i2c-1', 8),
+               SlowSensor(latency, 'i2c-3', 8),
+               SlowSensor(latency * 5, 'serial')]
+    scheduler = ReadScheduler(timeout=5.0)
+    jobs = [(sen.bus_id, sen.read) for sen in sensors]
+
+    sequential = timed(lambda: [sen.read() for sen in sensors], repeat)
+    concurrent = timed(lambda: scheduler.run(jobs), repeat)
+    scheduler.shutdown()
+    print('reads: sequential %.0f ms/cycle, scheduled %.0f ms/cycle' %
+          (sequential * 1e3, concurrent * 1e3))
+
+    # A hung sensor must not hold the cycle past the read timeout
+    hung = SlowSensor(2, 'i2c-4')
+    scheduler = ReadScheduler(timeout=0.5)
+    start = time.perf_counter()
+    results = scheduler.run(jobs + [(hung.bus_id, hung.read)])
+    print('reads: hung sensor cycle %.0f ms, timed out: %s' %
+          ((time.perf_counter() - start) * 1e3,
+           results[-1].error is not None))
+    scheduler.shutdown()
+
+    # One slow MCP9808 among eight loses only its own reading
+    import hardware
+    from sensor import MCP9808
+    tent = hardware.SimTent(hardware.SimClock(0))
+    i2c = hardware.SimBus(tent, [0x18 + i for i in range(8)])
+    mcp = MCP9808([], i2c_bus=i2c)
+    mcp.detect()
+    mcp.sensor_list[3].latency = 1.5
+    start = time.perf_counter()
+    readings = mcp.read(timeout=0.5)
+    print('reads: one 1.5 s sensor of 8 with a 0.5 s deadline, %d read '
+          'in %.0f ms' % (sum(r.value is not None for r in readings),
+                          (time.perf_counter() - start) * 1e3))
+
+
+def bench_records(rows=5000):
+    """
+    Per-cycle open/append/close of sensors.csv against the buffered
+    RecordWriter, counting file operations per row.
+    """
+
+    workdir = tempfile.mkdtemp()
+    readings = ',20.0625,20.125,19.875,20.0,20.25,20.1875,19.9375,20.0625'
+    when = time.localtime()
+    try:
+        path = os.path.join(workdir, 'legacy.csv')
+
+        def legacy():
+            # Mirrors the previous controller loop: one open, four
+            # writes and one close per cycle.
+            out = codecs.open(path, 'a', 'utf-8')
+            out.write(time.strftime("%Y/%m/%d %H:%M:%S", when))
+            out.write(readings)
+            out.write(',410ppm')
+            out.write('\n')
+            out.close()
+
+        per_row = timed(legacy, rows)
+        print('records: legacy %.1f us/row, 6 file ops/row' % (per_row * 1e6))
+
+        for policy in ('never', 'flush', 'always'):
+            writer = RecordWriter(os.path.join(workdir, policy + '.csv'),
+                                  flush_rows=10, fsync=policy)
+            per_row = timed(lambda: writer.write_row(when, readings,
+                                                     ',410ppm'), rows)
+            writer.close()
+            print('records: fsync=%s %.1f us/row, %.2f writes/row, '
+                  '%.2f fsyncs/row, %d bytes/write' %
+                  (policy, per_row * 1e6, writer.writes / float(rows),
+                   writer.fsyncs / float(rows),
+                   writer.bytes // max(writer.writes, 1)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+# Started in a fresh interpreter by bench_startup: builds a tent from
+# its configuration on simulated hardware and a real clock, and prints
+# when the first control decision was made and what was imported
+STARTUP_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+import config
+import hardware
+from sensor import MCP9808
+
+settings = config.validate({'role': sys.argv[2]})
+simulated = hardware.simulated(clock=hardware.SystemClock())
+tent = hardware.SimTent(simulated.clock, gpio=simulated.gpio)
+i2c = hardware.SimBus(tent, [0x18 + i for i in range(8)])
+built = time.time()
+feed = hardware.SimOutdoorFeed(tent)
+controller = config.build(
+    settings, hardware=simulated, sensor_list=[MCP9808([], i2c_bus=i2c)],
+    outdoor_feed=feed)
+
+# A heat tent decides on its relays, a control tent on what it
+# publishes
+decided = []
+owner, name = ((controller, 'control') if sys.argv[2] == 'heat' else
+               (feed, 'publish'))
+decide = getattr(owner, name)
+
+def first(*args):
+    decided.append(time.time())
+    return decide(*args)
+setattr(owner, name, first)
+controller.main(1)
+print(json.dumps({'built': built, 'decided': decided[0],
+                  'modules': sorted(sys.modules)}))
+"""
+
+
+def bench_startup(repeat=5):
+    """
+    Time from starting a tent's interpreter to its first control
+    decision, with the configuration read by config.py, and the
+    heavyweight or tent-specific modules it imported.
+    """
+
+    import json
+    import subprocess
+
+    source = os.path.dirname(os.path.abspath(__file__))
+    # Modules a tent should only import when it drives the hardware
+    watched = ('RPi', 'serial', 'Adafruit_MCP9808', 'smbus',
+               'heatcontroller', 'controlcontroller', 'strategy', 'actuator')
+    for role in ('heat', 'control'):
+        imports, firsts = [], []
+        for _ in range(repeat):
+            workdir = tempfile.mkdtemp()
+            try:
+                began = time.time()
+                output = subprocess.check_output(
+                    [sys.executable, '-c', STARTUP_SCRIPT, source, role],
+                    cwd=workdir)
+            finally:
+                shutil.rmtree(workdir)
+            result = json.loads(output.decode('utf-8').splitlines()[-1])
+            imports.append(result['built'] - began)
+            firsts.append(result['decided'] - began)
+        loaded = [name for name in watched if name in result['modules']]
+        print('startup: %-7s interpreter and imports %.0f ms, first '
+              'decision %.0f ms after start (best of %d); loaded %s' %
+              (role, min(imports) * 1e3, min(firsts) * 1e3, repeat,
+               ', '.join(loaded)))
+
+
+def bench_store(rows=100000):
+    """
+    Writing and reading a history of eight-sensor rows as sensors.csv
+    and as the binary record store, and exporting the store to CSV.
+    """
+
+    import recordstore
+    values = [20.0625, 20.125, 19.875, 20.0, 20.25, 20.1875, 19.9375, 20.0625]
+    pairs = [sensor.Reading(0x18 + i, value, 0.001, sensor.OK)
+             for i, value in enumerate(values)]
+    fields = ''.join(',' + repr(value) for value in values)
+    start = time.mktime((2019, 1, 1, 0, 0, 0, 0, 0, -1))
+    workdir = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(workdir, 'sensors.csv')
+        bin_path = os.path.join(workdir, 'sensors.bin')
+
+        writer = RecordWriter(csv_path, flush_rows=60, fsync='never')
+        began = time.perf_counter()
+        for i in range(rows):
+            writer.write_row(time.localtime(start + 60 * i), fields,
+                             ',410ppm')
+        writer.close()
+        csv_write = time.perf_counter() - began
+
+        store = recordstore.RecordStore(bin_path, flush_rows=60,
+                                        fsync='never')
+        began = time.perf_counter()
+        for i in range(rows):
+            store.write_row(start + 60 * i, pairs, 410)
+        store.close()
+        bin_write = time.perf_counter() - began
+
+        began = time.perf_counter()
+        total = 0.0
+        for path in recordwriter.history(csv_path):
+            with open(path) as records:
+                for line in records:
+                    row = readings.parse_row(line)
+                    if row is not None:
+                        total += sum(row[1])
+        csv_read = time.perf_counter() - began
+
+        reader = recordstore.RecordReader(bin_path)
+        began = time.perf_counter()
+        total = 0
+        for _, address, status, value in reader.records():
+            if status == recordstore.OK and address != recordstore.CO2_ADDRESS:
+                total += value
+        total /= recordstore.SCALE
+        bin_read = time.perf_counter() - began
+
+        csv_size = sum(os.path.getsize(path)
+                       for path in recordwriter.history(csv_path))
+        print('store: %d rows, csv %.1f us/row write, %.1f us/row read, '
+              '%d bytes' % (rows, csv_write / rows * 1e6,
+                            csv_read / rows * 1e6, csv_size))
+        print('store: binary %.1f us/row write, %.1f us/row read, '
+              '%d bytes, %d days indexed' %
+              (bin_write / rows * 1e6, bin_read / rows * 1e6,
+               os.path.getsize(bin_path), len(reader.days())))
+
+        try:
+            began = time.perf_counter()
+            array = reader.array()
+            temps = array['value'][array['address'] !=
+                                   recordstore.CO2_ADDRESS]
+            temps.mean() / recordstore.SCALE
+            print('store: numpy %.2f us/row read' %
+                  ((time.perf_counter() - began) / rows * 1e6))
+            del array, temps
+        except ImportError:
+            print('store: numpy not installed')
+
+        began = time.perf_counter()
+        with open(os.devnull, 'w') as out:
+            recordstore.export_csv(reader, out)
+        print('store: export to csv %.1f us/row' %
+              ((time.perf_counter() - began) / rows * 1e6))
+        reader.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_query(days=365):
+    """
+    A two-hour query over a year of per-minute rows held in a single
+    sensors.csv, against scanning the whole file, with the sparse
+    index built on the first query and reused afterwards.
+    """
+
+    import io
+    import query
+    fields = ',20.0625,20.125,19.875,20.0,20.25,20.1875,19.9375,20.0625'
+    start = time.mktime((2019, 1, 1, 0, 0, 0, 0, 0, -1))
+    rows = days * 1440
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'sensors.csv')
+        with open(path, 'w') as out:
+            for i in range(rows):
+                out.write(time.strftime(readings.ROW_FORMAT,
+                                        time.localtime(start + 60 * i)) +
+                          fields + ',410ppm\n')
+
+        first = time.mktime((2019, 7, 12, 2, 0, 0, 0, 0, -1))
+        last = time.mktime((2019, 7, 12, 4, 0, 0, 0, 0, -1))
+
+        began = time.perf_counter()
+        found = 0
+        with open(path) as records:
+            for line in records:
+                row = readings.parse_row(line)
+                if row is not None and first <= row[0] <= last:
+                    found += 1
+        scan = time.perf_counter() - began
+
+        timings = []
+        for _ in range(2):
+            began = time.perf_counter()
+            count = query.write_csv(query.csv_rows(path, first, last),
+                                    io.StringIO())
+            timings.append(time.perf_counter() - began)
+        print('query: %d rows of %d, full scan %.2f s, indexed %.3f s '
+              'building the index, %.4f s after' %
+              (count, rows, scan, timings[0], timings[1]))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_rollup(days=14):
+    """
+    Cost of the streaming rollups per cycle, and a check that every
+    rollup line matches the statistics computed in batch over the raw
+    readings of its bucket, with a restart partway through a day.
+    Exits non-zero on a mismatch.
+    """
+
+    import random
+    import rollup
+    from sensorhealth import FAILED
+    import statistics
+    rng = random.Random(1)
+    start = time.mktime((2019, 3, 1, 0, 0, 0, 0, 0, -1))
+    cycles = []
+    for i in range(days * 1440):
+        values = [sensor.Reading(0x18 + s, round(rng.gauss(20, 3) * 16) / 16.0,
+                                 0.001, sensor.OK) for s in range(8)]
+        # An occasional failed sensor
+        if rng.random() < 0.01:
+            failed = rng.randrange(8)
+            values[failed] = sensor.Reading(0x18 + failed, None, 0.001,
+                                            FAILED)
+        cycles.append((start + 60 * i, values, rng.randint(380, 450)))
+
+    workdir = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(workdir, 'rollup')
+        rollups = rollup.Rollups(prefix=prefix)
+        began = time.perf_counter()
+        for i, (stamp, values, co2) in enumerate(cycles):
+            if i == len(cycles) // 2 + 7:
+                rollups.close()
+                rollups = rollup.Rollups(prefix=prefix)
+            rollups.add(stamp, values, co2)
+        per_cycle = (time.perf_counter() - began) / len(cycles)
+        rollups.close()
+
+        mismatches = 0
+        checked = 0
+        for name, period in rollup.RESOLUTIONS:
+            batch = {}
+            for stamp, values, co2 in cycles:
+                bucket = rollup.bucket_start(stamp, period)
+                for reading in values:
+                    if reading.status == sensor.OK:
+                        batch.setdefault((bucket, '%02x' % reading.address),
+                                         []).append(reading.value)
+                batch.setdefault((bucket, 'co2'), []).append(co2)
+
+            with open('%s-%s.csv' % (prefix, name)) as lines:
+                next(lines)
+                for line in lines:
+                    when, sensor_name, count, mean, low, high, std = \
+                        line.strip().split(',')
+                    values = batch[(readings.parse_stamp(when), sensor_name)]
+                    expected = (len(values), statistics.mean(values),
+                                min(values), max(values),
+                                statistics.pstdev(values))
+                    actual = (int(count), float(mean), float(low),
+                              float(high), float(std))
+                    checked += 1
+                    if (actual[0] != expected[0] or
+                            any(abs(a - e) > 1e-3 for a, e in
+                                zip(actual[1:], expected[1:]))):
+                        mismatches += 1
+        print('rollup: %.1f us/cycle, %d rollup lines match batch '
+              'statistics, %d mismatches' %
+              (per_cycle * 1e6, checked - mismatches, mismatches))
+        if mismatches:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_co2(cycles=10, interval=0.2, latency=2.0):
+    """
+    Cycle time of a heat tent on a real clock with a CO2 sensor that
+    takes two seconds to answer, read by the background sampler; read
+    attempts against a missing sensor over an hour; and the cost of
+    picking up the latest value.
+    """
+
+    import asyncio
+    import hardware
+    from co2sampler import CO2Sampler
+    from heatcontroller import HeatController
+    from sensor import MCP9808
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        simulated = hardware.simulated(
+            clock=hardware.SystemClock(),
+            co2=hardware.SimCO2(latency=latency))
+        simulated.background = True
+        tent = hardware.SimTent(simulated.clock, gpio=simulated.gpio)
+        i2c = hardware.SimBus(tent, [0x18 + i for i in range(8)])
+        controller = HeatController(
+            [MCP9808([], i2c_bus=i2c)], hardware=simulated,
+            outdoor_feed=hardware.SimOutdoorFeed(tent))
+        controller.log_interval = interval
+        controller.timer = CycleTimer(interval, clock=time.monotonic,
+                                      sleep=time.sleep, wall=time.time)
+        take_sample = controller.take_sample
+        durations = []
+
+        def timed_sample(*args):
+            began = time.perf_counter()
+            sample = take_sample(*args)
+            durations.append(time.perf_counter() - began)
+            return sample
+        controller.take_sample = timed_sample
+        asyncio.run(controller.run(cycles))
+        print('co2: %d cycles with a %.0f s CO2 read took %.1f ms at most '
+              'to sample, %d CO2 reads' %
+              (cycles, latency, max(durations) * 1e3, simulated.co2.reads))
+
+        class Missing(object):
+            def read(self):
+                return None
+
+            def zero_point_calibration(self):
+                pass
+
+        clock = hardware.SimClock(0)
+        sampler = CO2Sampler(Missing(), clock=clock.time, state_file='co2')
+        while clock.now < 3600:
+            clock.sleep(sampler.poll())
+        print('co2: %d reads of a missing sensor in an hour, %d without '
+              'backoff' % (sampler.reads, 3600 // sampler.interval))
+
+        sampler = CO2Sampler(hardware.SimCO2(), state_file='co2')
+        sampler.poll()
+        print('co2: latest value in %.0f ns' %
+              (timed(sampler.latest, 100000) * 1e9))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def bench_core(cycles=20, interval=0.1, disk_latency=0.5):
+    """
+    Delay from taking a sample to switching the relays in the heat
+    tent controller on a real clock, with every sensors.csv write
+    stalled as on a slow SD card.
+    """
+
+    import hardware
+    from heatcontroller import HeatController
+    from sensor import MCP9808
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        simulated = hardware.simulated(clock=hardware.SystemClock())
+        tent = hardware.SimTent(simulated.clock, gpio=simulated.gpio)
+        i2c = hardware.SimBus(tent, [0x18 + i for i in range(8)])
+        controller = HeatController(
+            [MCP9808([], i2c_bus=i2c)], hardware=simulated,
+            outdoor_feed=hardware.SimOutdoorFeed(tent))
+        controller.log_interval = interval
+        controller.timer = CycleTimer(interval, clock=time.monotonic,
+                                      sleep=time.sleep, wall=time.time)
+
+        write_row = controller.sensor_readings.write_row
+
+        def slow_write_row(*args):
+            time.sleep(disk_latency)
+            write_row(*args)
+        controller.sensor_readings.write_row = slow_write_row
+
+        delays = []
+        control = controller.control
+
+        def timed_control(sample):
+            control(sample)
+            delays.append(time.time() - sample.stamp)
+        controller.control = timed_control
+
+        import asyncio
+        began = time.perf_counter()
+        asyncio.run(controller.run(cycles))
+        elapsed = time.perf_counter() - began
+        delays.sort()
+        print('core: %d cycles in %.1f s with %.1f s writes, relays '
+              'switched %.1f ms (median) %.1f ms (max) after each sample' %
+              (cycles, elapsed, disk_latency,
+               delays[len(delays) // 2] * 1e3, delays[-1] * 1e3))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def bench_feed(tents=5, samples=20):
+    """
+    Multicast outdoor feed on localhost with several simulated heat
+    tents, reporting how long each sample takes to reach all of them.
+    """
+
+    subscribers = [outdoorfeed.OutdoorSubscriber() for _ in range(tents)]
+    publisher = outdoorfeed.OutdoorPublisher()
+    delays = []
+    try:
+        for i in range(samples):
+            start = time.time()
+            publisher.publish([20.0 + i, 21.0 + i])
+            while any(sub.latest()[0] != [20.0 + i, 21.0 + i]
+                      for sub in subscribers):
+                if time.time() - start > 1.0:
+                    break
+                time.sleep(0.0005)
+            delays.append(time.time() - start)
+    finally:
+        publisher.close()
+        for sub in subscribers:
+            sub.stop()
+    delays.sort()
+    print('feed: %d tents, median %.2f ms, max %.2f ms to reach all' %
+          (tents, delays[len(delays) // 2] * 1e3, delays[-1] * 1e3))
+
+
+def bench_fanout(tents=48, samples=50, interval=0.02):
+    """
+    Load test for the TCP outdoor feed server: many simulated heat
+    tents connect from one harness thread and each published sample's
+    delivery latency to every tent is recorded.
+    """
+
+    server = outdoorfeed.OutdoorServer(host='127.0.0.1', port=0)
+    selector = selectors.DefaultSelector()
+    buffers = {}
+    for _ in range(tents):
+        sock = socket.create_connection(('127.0.0.1', server.port))
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        buffers[sock] = b''
+    while len(server.clients) < tents:
+        time.sleep(0.01)
+
+    delays = []
+    for i in range(samples):
+        server.publish([20.0 + i, 21.0 + i])
+        deadline = time.time() + interval
+        while time.time() < deadline:
+            for key, _ in selector.select(timeout=interval):
+                data = key.fileobj.recv(4096)
+                now = time.time()
+                buffers[key.fileobj] += data
+                while b'\n' in buffers[key.fileobj]:
+                    frame, buffers[key.fileobj] = \
+                        buffers[key.fileobj].split(b'\n', 1)
+                    delays.append(now - outdoorfeed.decode_frame(frame)[1])
+
+    server.close()
+    for sock in buffers:
+        sock.close()
+    delays.sort()
+    print('fanout: %d tents, %d/%d frames delivered, p50 %.2f ms, '
+          'p99 %.2f ms, max %.2f ms, server cpu %.0f us/sample' %
+          (tents, len(delays), tents * samples,
+           delays[len(delays) // 2] * 1e3,
+           delays[int(len(delays) * 0.99)] * 1e3, delays[-1] * 1e3,
+           server.cpu_time / samples * 1e6))
+
+
+def bench_parse(rows=20000):
+    """
+    Outdoor parsing throughput for well-formed and corrupted records,
+    and aggregation throughput for agreeing sensors and with an
+    outlier, against the previous per-character printable filter and
+    plain mean, and sensors.csv backfill parsing.
+    """
+
+    corrupted = '20.0625,20.125,\x0019.875,20.0,20.25,20.1875,19.9375,85.0'
+    clean = corrupted.replace('\x00', '')
+
+    def legacy(record):
+        out_vals = []
+        for t in record.split(','):
+            try:
+                out_vals.append(float(t))
+            except ValueError:
+                joined = "".join(c for c in t if c in string.printable)
+                if joined:
+                    out_vals.append(float(joined))
+        return out_vals
+
+    for name, record in (('well-formed', clean), ('corrupted', corrupted)):
+        per_legacy = timed(lambda: legacy(record), rows)
+        per_new = timed(lambda: readings.parse_readings(record), rows)
+        print('parse: %-11s legacy %.0f rows/s, new %.0f rows/s' %
+              (name, 1 / per_legacy, 1 / per_new))
+
+    # The robust mean drops the 85.0 reading the plain mean averages in
+    values = readings.parse_readings(clean)
+    for name, sample in (('agreeing', values[:-1]), ('outlier', values)):
+        aggregator = readings.OutdoorAggregator()
+        per_legacy = timed(lambda: sum(sample) / len(sample), rows)
+        per_new = timed(lambda: aggregator.update(sample), rows)
+        print('parse: %-11s plain mean %.0f rows/s (%.2f), robust mean '
+              '%.0f rows/s (%.2f)' % (name, 1 / per_legacy,
+                                      sum(sample) / len(sample),
+                                      1 / per_new, aggregator.value))
+
+    row = '2019/07/12 02:00:00' + ',' + record + ',410ppm\n'
+    per_row = timed(lambda: readings.parse_row(row), rows)
+    print('parse: sensors.csv backfill %.0f rows/s' % (1 / per_row))
+
+
+class VirtualClock(object):
+    """
+    Simulated clock whose sleep advances time instantly.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+
+def bench_strategies(hours=24):
+    """
+    Closed-loop runs of each control strategy on a simulated heat tent,
+    checking every 60 s and every 15 s with sensors.csv still written
+    once a minute, and a check that a thermal model fitted to the run
+    recovers the simulated tent.
+    """
+
+    from actuator import RELAY_LEVELS
+    import asyncio
+    import hardware
+    from heatcontroller import Zone
+    import simulation
+    import strategy
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.mktime((2026, 1, 1, 0, 0, 0, 0, 0, -1))
+        for interval in (60, 15):
+            for name in sorted(strategy.STRATEGIES):
+                zone = Zone('tent', strategy=strategy.STRATEGIES[name]())
+                controller, _, _ = simulation.build(
+                    'heat', [], start=start, seed=1, zones=[zone])
+                controller.check_interval = interval
+
+                history = []
+                control = controller.control
+
+                def recorded_control(sample, control=control,
+                                     controller=controller,
+                                     history=history):
+                    control(sample)
+                    history.append((sample.stamp, controller.indoor,
+                                    controller.outdoor, controller.heater))
+                controller.control = recorded_control
+
+                asyncio.run(controller.run(hours * 3600 // interval))
+
+                # Skip the first hour while the tent warms up
+                errors = [indoor - outdoor - controller.temperature_diff
+                          for stamp, indoor, outdoor, _ in history
+                          if stamp >= start + 3600]
+                switches = 0
+                for before, after in zip(history, history[1:]):
+                    switches += sum(
+                        a != b for a, b in zip(RELAY_LEVELS[before[3]],
+                                               RELAY_LEVELS[after[3]]))
+                print('strategies: %-9s every %2d s, rms error %.3f, '
+                      '%4d relay switches' %
+                      (name, interval,
+                       (sum(e * e for e in errors) / len(errors)) ** 0.5,
+                       switches))
+
+                if name == 'threshold' and interval == 60:
+                    model = strategy.ThermalModel.fit(
+                        *zip(*history))
+                    tent = hardware.SimTent(controller.clock)
+                    expected = [tent.loss, tent.heat_rates[2]]
+                    fitted = [model.loss, model.rates["ST2"]]
+                    print('strategies: fitted %r' % model)
+                    if any(abs(f - e) > 0.05 * e
+                           for f, e in zip(fitted, expected)):
+                        print('strategies: fitted model is off by over 5%')
+                        sys.exit(1)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def bench_timer(cycles=1440, interval=60.0):
+    """
+    A simulated day of cycles with slow sensors: drift of the previous
+    sleep-after-work loop against the fixed-rate CycleTimer, and the
+    timer's jitter statistics with occasional overruns.
+    """
+
+    import random
+    rng = random.Random(1)
+    work = [rng.uniform(0.5, 4.0) for _ in range(cycles)]
+    # Every hundredth cycle hangs on a sensor past the interval
+    for i in range(0, cycles, 100):
+        work[i] = interval * 1.5
+
+    # Previous loop: work then sleep a full interval
+    legacy = sum(w + interval for w in work) - cycles * interval
+    print('timer: sleep loop drifts %.0f s over %d cycles' %
+          (legacy, cycles))
+
+    for policy in ('skip', 'compress'):
+        clock = VirtualClock()
+        timer = CycleTimer(interval, policy=policy, clock=clock.time,
+                           sleep=clock.sleep, wall=clock.time)
+        for w in work:
+            timer.wait()
+            clock.sleep(w)
+        timer.wait()
+        stats = timer.stats()
+        drift = clock.now - timer.origin - timer.cycle * interval
+        print('timer: %s drift %.1f s, %d overruns, %d skipped, '
+              'max lateness %.1f s, mean duration %.2f s' %
+              (policy, drift, stats['overruns'], stats['skipped'],
+               stats['lateness_max'], stats['duration_mean']))
+
+
+def bench_logging(records=2000, stall=0.01, cycles=1440):
+    """
+    Time spent by the caller per log record with a plain file handler
+    and with the queued JSON-lines pipeline while every flush stalls
+    as on a slow SD card, and the size of a day of heat tent logging
+    as plain text and as deduplicated JSON lines, checked against what
+    query.py reads back.
+    """
+
+    import io
+    import logging
+    import logpipeline
+    import query
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    logger = logging.getLogger('benchmark')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    try:
+        plain = logging.FileHandler('plain.log')
+        listener = logpipeline.start('control.log')
+        # Detach from the root logger; only the benchmark logs here
+        logging.getLogger().removeHandler(listener.queue_handler)
+        for name, handler in (('plain', plain),
+                              ('pipeline', listener.queue_handler)):
+            file_handler = plain if handler is plain else \
+                listener.handlers[0]
+            flush = file_handler.flush
+
+            def slow_flush(flush=flush):
+                time.sleep(stall)
+                flush()
+            file_handler.flush = slow_flush
+            logger.addHandler(handler)
+            began = time.perf_counter()
+            for i in range(records):
+                logger.info('%.2f inside, %.2f outside, heater %s',
+                            20 + i * 0.01, 15.0, 'OFF')
+            elapsed = time.perf_counter() - began
+            logger.removeHandler(handler)
+            print('logging: %-8s %7.1f us per record with %.0f ms flushes' %
+                  (name, elapsed / records * 1e6, stall * 1e3))
+        listener.stop()
+        plain.close()
+
+        # A day of the messages a heat tent logs each minute
+        start = time.mktime((2026, 1, 1, 0, 0, 0, 0, 0, -1))
+        cycle = [('Building sensors record', ()),
+                 ('Reading sensors from Pi', ()),
+                 ('Detected indoor temp of %.2f', (20.5,)),
+                 ('Logging %d ppm to file', (410,)),
+                 ('Retrieving outdoor temp from control tent', ()),
+                 ('Average retrieved temperature: %r', (15.0,)),
+                 ('%.2f inside, %.2f outside, heater %s',
+                  (20.5, 15.0, 'OFF'))]
+        text = logging.Formatter("%(asctime)-15s %(message)s")
+        structured = logpipeline.JSONFormatter()
+        dedupe = logpipeline.DedupeFilter()
+        sizes = [0, 0]
+        lines = io.StringIO()
+        written = 0
+        for i in range(cycles):
+            for number, (msg, args) in enumerate(cycle):
+                if args and number != len(cycle) - 1:
+                    args = (args[0] + (i % 7) * 0.1,)
+                record = logging.makeLogRecord({
+                    'msg': msg, 'args': args, 'levelno': logging.INFO,
+                    'levelname': 'INFO',
+                    'created': start + i * 60 + number * 0.01,
+                    'msecs': number * 10})
+                sizes[0] += len(text.format(record)) + 1
+                if dedupe.filter(record):
+                    line = structured.format(record) + '\n'
+                    sizes[1] += len(line)
+                    lines.write(line)
+                    written += 1
+        with open('day.log', 'w') as day:
+            day.write(lines.getvalue())
+        out = io.StringIO()
+        query.log_lines('day.log', start, start + cycles * 60, out, 'json')
+        if out.getvalue() != lines.getvalue():
+            print('logging: query.py did not read back the day of logging')
+            sys.exit(1)
+        print('logging: a day of heat tent logging is %d KB as text, %d KB '
+              'as deduplicated JSON lines (%d of %d records written)' %
+              (sizes[0] // 1024, sizes[1] // 1024, written,
+               cycles * len(cycle)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def io_counters():
+    """
+    Return this process's read and write calls and bytes so far, from
+    /proc/self/io, or None where it is not available.
+    """
+
+    try:
+        with open('/proc/self/io') as counters:
+            fields = dict(line.split(':') for line in counters)
+    except (IOError, OSError, ValueError):
+        return None
+    return dict((name, int(fields[name])) for name in
+                ('syscr', 'syscw', 'rchar', 'wchar'))
+
+
+def soak(role, cycles, warmup, trace):
+    """
+    Run a simulated tent for `cycles` cycles in a scratch directory and
+    return (seconds per sample, per-stage Metrics, I/O counter deltas,
+    heap growth in bytes after `warmup` cycles, the source line that
+    grew most). With trace unset the heap is not traced.
+    """
+
+    import asyncio
+    import gc
+    import logging
+    import tracemalloc
+    import simulation
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        stages = metrics.Metrics()
+        controller, tent, simulated = simulation.build(
+            role, ['68'], seed=1, metrics=stages,
+            start=time.mktime((2026, 1, 1, 0, 0, 0, 0, 0, -1)))
+
+        samples = []
+        heap = []
+        take_sample = controller.take_sample
+
+        def timed_sample(*args):
+            began = time.perf_counter()
+            sample = take_sample(*args)
+            samples.append(time.perf_counter() - began)
+            if trace and len(samples) in (warmup, cycles):
+                # Let the log writer catch up; queued records are not
+                # growth
+                for handler in logging.getLogger().handlers:
+                    while getattr(handler, 'queue', None) and \
+                            not handler.queue.empty():
+                        time.sleep(0.001)
+                gc.collect()
+                # Leave out the benchmark's own allocations
+                heap.append(tracemalloc.take_snapshot().filter_traces(
+                    [tracemalloc.Filter(False, tracemalloc.__file__),
+                     tracemalloc.Filter(False, __file__)]))
+            return sample
+        controller.take_sample = timed_sample
+
+        # The virtual clock would start the next cycle at once; give
+        # the writer the idle time a real cycle leaves it
+        sleep = controller.clock.async_sleep
+
+        async def idle_sleep(seconds):
+            while not controller.persist_queue.empty():
+                await asyncio.sleep(0.0005)
+            await sleep(seconds)
+        controller.clock.async_sleep = idle_sleep
+
+        # Stamp log records on the virtual clock too, so the log is
+        # deduplicated and rotated as it would be on a tent
+        factory = logging.getLogRecordFactory()
+
+        def sim_record(*args, **kwargs):
+            record = factory(*args, **kwargs)
+            record.created = controller.clock.time()
+            record.msecs = record.created % 1 * 1000
+            return record
+        logging.setLogRecordFactory(sim_record)
+
+        if trace:
+            tracemalloc.start()
+        before = io_counters()
+        controller.main(cycles)
+        after = io_counters()
+        growth, line = 0, None
+        if trace:
+            tracemalloc.stop()
+            growth = sum(stat.size_diff for stat in
+                         heap[1].compare_to(heap[0], 'filename'))
+            source = os.path.dirname(os.path.abspath(__file__))
+            grown = [stat for stat in heap[1].compare_to(heap[0], 'lineno')
+                     if stat.traceback[0].filename.startswith(source)]
+            if grown and grown[0].size_diff > 0:
+                frame = grown[0].traceback[0]
+                line = '%s:%d +%d B' % (os.path.basename(frame.filename),
+                                         frame.lineno, grown[0].size_diff)
+        io = None
+        if before is not None and after is not None:
+            io = dict((name, after[name] - before[name]) for name in before)
+        return samples, stages, io, growth, line
+    finally:
+        logging.setLogRecordFactory(factory)
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def bench_soak(cycles=3000, warmup=1500):
+    """
+    Two simulated days of each tent's full control cycle over fake
+    I2C, GPIO, serial and outdoor feed backends on a virtual clock: time
+    per sample, median and 99th percentile cost of each stage, read and
+    write calls per cycle, and heap growth once warmed up, which would
+    catch per-cycle state that is never released. Returns the figures
+    for the regression check.
+    """
+
+    results = {}
+    for role in ('heat', 'control'):
+        samples, stages, io, _, _ = soak(role, cycles, warmup, False)
+        samples.sort()
+        results['%s_sample_us' % role] = \
+            samples[len(samples) // 2] * 1e6
+        print('soak: %-7s sample %.0f us (median) %.0f us (p99)' %
+              (role, samples[len(samples) // 2] * 1e6,
+               samples[int(len(samples) * 0.99)] * 1e6))
+        # Per-sensor timings are pooled into one line per stage
+        pooled = {}
+        for (name, labels), hist in stages.histograms.items():
+            # Cycle lengths are on the virtual clock
+            if name == 'cycle':
+                continue
+            key = ' '.join([name] + [value for label, value in labels
+                                     if label != 'address'])
+            pooled.setdefault(key, []).append(hist)
+        for key, hists in sorted(pooled.items()):
+            recent = sorted(value for hist in hists for value in hist.recent)
+            median = recent[len(recent) // 2]
+            results['%s_%s_us' % (role, key.replace(' ', '_'))] = \
+                median * 1e6
+            print('soak: %-7s %-18s %7.1f us (median) %7.1f us (p99)' %
+                  (role, key, median * 1e6,
+                   recent[int(len(recent) * 0.99)] * 1e6))
+        if io is not None:
+            results['%s_writes_per_cycle' % role] = \
+                float(io['syscw']) / cycles
+            print('soak: %-7s %.1f write calls (%.0f B) and %.1f read '
+                  'calls per cycle' %
+                  (role, float(io['syscw']) / cycles,
+                   float(io['wchar']) / cycles, float(io['syscr']) / cycles))
+
+        _, _, _, growth, line = soak(role, cycles, warmup, True)
+        per_kcycle = growth / 1024.0 / (cycles - warmup) * 1000
+        results['%s_heap_kb_per_kcycle' % role] = per_kcycle
+        print('soak: %-7s heap grew %.1f KB per 1000 cycles after %d '
+              'cycles%s' % (role, per_kcycle, warmup,
+                            ', most at %s' % line if line else ''))
+    return results
+
+
+def bench_metrics(repeat=100000):
+    """
+    Cost of timing one stage with metrics disabled and enabled.
+    """
+
+    for name, recorder in (('disabled', metrics.NullMetrics()),
+                           ('enabled', metrics.Metrics())):
+        def stage():
+            with recorder.stage('read', sensor='MCP9808'):
+                pass
+        print('metrics: %s %.2f us/stage' %
+              (name, timed(stage, repeat) * 1e6))
+
+
+def bench_relays(hours=24, interval=15):
+    """
+    GPIO writes and heater transitions of a simulated heat tent checked
+    every 15 s, against writing every pin each cycle, without and with
+    hysteresis and a minimum dwell; the transition log is checked
+    against the actuator's own count.
+    """
+
+    import asyncio
+    import actuator
+    from heatcontroller import Zone
+    import simulation
+    import strategy
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.mktime((2026, 1, 1, 0, 0, 0, 0, 0, -1))
+        cycles = hours * 3600 // interval
+        for band, dwell in ((0.0, 0), (0.0, 30), (0.25, 120)):
+            for path in recordwriter.history('relays.csv'):
+                os.remove(path)
+            zone = Zone('tent', strategy=strategy.Threshold(band=band))
+            controller, _, simulated = simulation.build(
+                'heat', [], start=start, seed=1, zones=[zone])
+            # Set once built, as the dwell is read when actuating
+            zone.min_dwell = dwell
+            controller.check_interval = interval
+            asyncio.run(controller.run(cycles))
+            if zone.strategy.state != zone.actuator.state:
+                print('relays: strategy has %s, relays %s' %
+                      (zone.strategy.state, zone.actuator.state))
+                sys.exit(1)
+
+            logged = actuator.summarize('relays.csv')['tent'][0]
+            if logged != zone.actuator.transitions:
+                print('relays: %d transitions logged, %d made' %
+                      (logged, zone.actuator.transitions))
+                sys.exit(1)
+            print('relays: band %.2f, dwell %3d s: %5d transitions, %5d '
+                  'GPIO writes (%d writing every cycle)' %
+                  (band, dwell, zone.actuator.transitions,
+                   simulated.gpio.writes, 3 * (cycles + 1)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def bench_replay(days=180):
+    """
+    Replaying a season of one-minute heat tent cycles, written as
+    sensors.csv histories, through the heater decision.
+    """
+
+    import random
+    import replay
+    rng = random.Random(1)
+    start = time.mktime((2019, 1, 1, 0, 0, 0, 0, 0, -1))
+    cycles = days * 1440
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for name, mean in (('heat', 20.0), ('control', 15.0)):
+            path = os.path.join(tmpdir, name + '.csv')
+            with open(path, 'w') as out:
+                for i in range(cycles):
+                    value = mean + 8 * rng.random()
+                    out.write('%s,%.4f,%.4f,410ppm\n' % (
+                        time.strftime(readings.ROW_FORMAT,
+                                      time.localtime(start + 60 * i)),
+                        value, value + 0.0625))
+            paths.append(path)
+
+        began = time.perf_counter()
+        stamps, indoor, outdoor = replay.align(
+            replay.load(paths[0], replay.indoor_mean),
+            replay.load(paths[1], readings.robust_mean))
+        loaded = time.perf_counter() - began
+
+        events = []
+        began = time.perf_counter()
+        replay.replay(stamps, indoor, outdoor, 4,
+                      lambda stamp, state: events.append(stamp))
+        elapsed = time.perf_counter() - began
+        print('replay: %d cycles loaded in %.2f s, replayed in %.2f s '
+              '(%.0f cycles/s), %d events' %
+              (len(stamps), loaded, elapsed, len(stamps) / elapsed,
+               len(events)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_zones(zones=8, cycles=1440):
+    """
+    A simulated day of one heat controller driving several zones
+    against a separate controller per zone, checking that each zone
+    holds its differential and stays off while scheduled off.
+    """
+
+    import asyncio
+    import simulation
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.mktime((2026, 1, 1, 0, 0, 0, 0, 0, -1))
+        schedule = [('00:00', 4), ('20:00', None)]
+        controller, _, _ = simulation.build_zones(
+            zones, start=start, seed=1, schedule=schedule)
+
+        # Heater states of every zone after each cycle
+        states = []
+        control = controller.control
+
+        def recorded_control(sample):
+            control(sample)
+            states.append((sample.stamp,
+                           [zone.heater for zone in controller.zones],
+                           [zone.indoor - controller.outdoor
+                            for zone in controller.zones]))
+        controller.control = recorded_control
+
+        began = time.perf_counter()
+        asyncio.run(controller.run(cycles))
+        shared = time.perf_counter() - began
+
+        began = time.perf_counter()
+        for i in range(zones):
+            os.mkdir('tent%d' % i)
+            os.chdir('tent%d' % i)
+            single, _, _ = simulation.build_zones(1, start=start, seed=1,
+                                                  schedule=schedule)
+            asyncio.run(single.run(cycles))
+            os.chdir(workdir)
+        separate = time.perf_counter() - began
+
+        heated = []
+        for stamp, heaters, gaps in states:
+            hour = time.localtime(stamp).tm_hour
+            if hour >= 20 and heaters != ["OFF"] * zones:
+                print('zones: heater on while scheduled off')
+                sys.exit(1)
+            if 2 <= hour < 20:
+                heated.extend(gaps)
+        print('zones: %d zones x %d cycles in %.2f s shared, %.2f s as '
+              'separate controllers; indoor-outdoor %.2f to %.2f while '
+              'heated' % (zones, cycles, shared, separate, min(heated),
+                          max(heated)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+# Limits on figures whatever the baseline: heap growth once warmed up
+LIMITS = {'heap_kb_per_kcycle': 128.0}
+
+# Timing changes, in microseconds, too small to tell from noise
+NOISE_US = 20.0
+
+BENCHMARKS = {
+    'co2': bench_co2,
+    'core': bench_core,
+    'fanout': bench_fanout,
+    'feed': bench_feed,
+    'logging': bench_logging,
+    'metrics': bench_metrics,
+    'parse': bench_parse,
+    'query': bench_query,
+    'reads': bench_reads,
+    'records': bench_records,
+    'relays': bench_relays,
+    'replay': bench_replay,
+    'restart': bench_restart,
+    'rollup': bench_rollup,
+    'scan': bench_scan,
+    'soak': bench_soak,
+    'startup': bench_startup,
+    'store': bench_store,
+    'strategies': bench_strategies,
+    'timer': bench_timer,
+    'zones': bench_zones,
+}
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Return a description of each figure that is past its limit, or
+    worse than the baseline by more than `tolerance` of it; timings
+    within NOISE_US of the baseline are never counted.
+    """
+
+    failures = []
+    for key, value in sorted(results.items()):
+        for suffix, limit in LIMITS.items():
+            if key.endswith(suffix) and value > limit:
+                failures.append('%s is %.1f, over the limit of %.1f' %
+                                (key, value, limit))
+        if key not in baseline or key.endswith(tuple(LIMITS)):
+            continue
+        allowed = baseline[key] * (1 + tolerance)
+        if key.endswith('_us'):
+            allowed = max(allowed, baseline[key] + NOISE_US)
+        if value > allowed:
+            failures.append('%s is %.1f, was %.1f' %
+                            (key, value, baseline[key]))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Off-device benchmarks for the thermostat '
+                    'controllers.')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='benchmark to run: %s (default: all)' %
+                             ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the figures to FILE as a baseline')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='exit non-zero if a figure is worse than '
+                             'in this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction a figure may exceed its baseline '
+                             'by (default: 0.25)')
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('no benchmark named %s' % name)
+
+    results = {}
+    for name in args.names or sorted(BENCHMARKS):
+        figures = BENCHMARKS[name]()
+        for key, value in (figures or {}).items():
+            results['%s_%s' % (name, key)] = value
+
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump(results, out, indent=1, sort_keys=True)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as saved:
+            baseline = json.load(saved)
+    failures = regressions(results, baseline, args.tolerance)
+    for failure in failures:
+        print('regression: %s' % failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
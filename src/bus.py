@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# I2C bus access for sensor detection
+
+import errno
+
+# Default address range probed, matching `i2cdetect -y 1`
+FIRST_ADDR = 0x03
+LAST_ADDR = 0x77
+
+# Address ranges where a quick write can corrupt EEPROMs or lock up
+# devices; i2cdetect probes these with a read byte instead.
+READ_PROBE_RANGES = ((0x30, 0x37), (0x50, 0x5f))
+
+
+class SMBusBackend(object):
+    """
+    Bus backend that talks to a Linux I2C adapter through smbus.
+    """
+
+    def __init__(self, busnum=1):
+        # Imported here so the module can be used off-device.
+        try:
+            import smbus
+        except ImportError:
+            import smbus2 as smbus
+
+        self.busnum = busnum
+        self.bus = smbus.SMBus(busnum)
+
+    def __repr__(self):
+        return "SMBus(%d)" % self.busnum
+
+    def write_quick(self, addr):
+        """
+        Issue an SMBus quick write to the given address.
+        """
+
+        self.bus.write_quick(addr)
+
+    def read_byte(self, addr):
+        """
+        Read a single byte from the given address.
+        """
+
+        return self.bus.read_byte(addr)
+
+    def close(self):
+        """
+        Release the bus file descriptor.
+        """
+
+        self.bus.close()
+
+
+class FakeBus(object):
+    """
+    In-memory bus backend used for testing and benchmarking
+    detection without I2C hardware attached.
+    """
+
+    def __init__(self, addresses=(), busnum=1):
+        self.busnum = busnum
+        self.devices = set(addresses)
+        self.transactions = 0
+
+    def __repr__(self):
+        return "FakeBus(%d)" % self.busnum
+
+    def attach(self, addr):
+        """
+        Simulate plugging a device into the bus.
+        """
+
+        self.devices.add(addr)
+
+    def detach(self, addr):
+        """
+        Simulate unplugging a device from the bus.
+        """
+
+        self.devices.discard(addr)
+
+    def write_quick(self, addr):
+        """
+        Acknowledge a quick write if a device is attached.
+        """
+
+        self.transactions += 1
+        if addr not in self.devices:
+            raise IOError(errno.ENXIO, "No such device or address")
+
+    def read_byte(self, addr):
+        """
+        Return a zero byte if a device is attached.
+        """
+
+        self.write_quick(addr)
+        return 0
+
+    def close(self):
+        pass
+
+
+def probe(bus, addr):
+    """
+    Return True if a device acknowledges at the given address.
+    Devices claimed by a kernel driver (UU in i2cdetect) fail
+    with EBUSY and are treated as absent.
+    """
+
+    try:
+        for low, high in READ_PROBE_RANGES:
+            if low <= addr <= high:
+                bus.read_byte(addr)
+                break
+        else:
+            bus.write_quick(addr)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def scan(bus, reserved=(), first=FIRST_ADDR, last=LAST_ADDR):
+    """
+    Probe every address in [first, last] that is not reserved
+    and return the set of addresses that responded.
+    """
+
+    reserved = set(reserved)
+    return set(addr for addr in range(first, last + 1)
+               if addr not in reserved and probe(bus, addr))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+# Background sampling of the MH-Z19 CO2 sensor
+
+import codecs
+import collections
+import logging
+import threading
+import time
+
+from metrics import NullMetrics
+
+
+class CO2Sampler(object):
+    """
+    Reads the CO2 sensor on its own cadence, in a background thread
+    once started or through poll() otherwise, so a slow or missing
+    sensor never holds up a control cycle. Recent samples are kept in
+    a ring buffer and the latest and smoothed values are available at
+    any time. While the sensor does not answer, the delay between
+    attempts doubles up to max_backoff seconds.
+
+    Zero point calibration runs when first due and then every
+    calibrate_every seconds, or when requested; the time of the last
+    one is kept in state_file so a restart does not calibrate again.
+    """
+
+    def __init__(self, sensor, interval=30, window=120, smoothing=10,
+                 max_backoff=600, calibrate_every=None,
+                 state_file='co2.calibrated', clock=time.time,
+                 metrics=None, logger=None):
+        # CO2 backend with read() and zero_point_calibration()
+        self.sensor = sensor
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.calibrate_every = calibrate_every
+        self.state_file = state_file
+        self.clock = clock
+        self.metrics = metrics or NullMetrics()
+        self.logger = logger or logging.getLogger("Controller")
+
+        # (timestamp, ppm) of the recent samples
+        self.samples = collections.deque(maxlen=window)
+        # Latest sample, replaced as a whole so readers need no lock
+        self.last = (None, None)
+
+        # Running total of the values being smoothed
+        self.smoothing = collections.deque(maxlen=smoothing)
+        self.total = 0
+
+        # Consecutive failed reads and when to read next
+        self.failures = 0
+        self.next_read = None
+
+        # Last calibration, and whether one has been asked for
+        self.calibrated = self.load_calibrated()
+        self.calibration_requested = False
+
+        self.thread = None
+        self.stopping = threading.Event()
+
+        # Reads and calibrations made, for benchmarking
+        self.reads = 0
+        self.calibrations = 0
+
+    def load_calibrated(self):
+        try:
+            with codecs.open(self.state_file, 'r', 'utf-8') as state:
+                return float(state.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def save_calibrated(self):
+        try:
+            with codecs.open(self.state_file, 'w', 'utf-8') as state:
+                state.write('%d\n' % self.calibrated)
+        except IOError:
+            self.logger.info('Unable to record the CO2 calibration time')
+
+    def latest(self, max_age=None):
+        """
+        Return the latest value in ppm, or None if there is none or it
+        is older than max_age seconds.
+        """
+
+        stamp, ppm = self.last
+        if stamp is None:
+            return None
+        if max_age is not None and self.clock() - stamp > max_age:
+            return None
+        return ppm
+
+    def smoothed(self):
+        """
+        Return the mean of the most recent values, or None.
+        """
+
+        if not self.smoothing:
+            return None
+        return float(self.total) / len(self.smoothing)
+
+    def request_calibration(self):
+        """
+        Run a zero point calibration before the next read. Only do so
+        while the sensor sits in fresh outdoor air.
+        """
+
+        self.calibration_requested = True
+
+    def calibration_due(self, now):
+        if self.calibration_requested:
+            return True
+        if self.calibrate_every is None:
+            return False
+        return (self.calibrated is None or
+                now - self.calibrated >= self.calibrate_every)
+
+    def calibrate(self, now):
+        self.calibration_requested = False
+        try:
+            self.sensor.zero_point_calibration()
+        except (IOError, OSError, TypeError, ValueError):
+            self.logger.info('CO2 calibration failed')
+            return
+        self.calibrations += 1
+        self.calibrated = now
+        self.save_calibrated()
+        self.logger.info('Calibrated CO2 to 400 ppm')
+
+    def poll(self):
+        """
+        Read the sensor if a read is due; returns the seconds until
+        the next one.
+        """
+
+        now = self.clock()
+        if self.next_read is not None and now < self.next_read:
+            return self.next_read - now
+
+        if self.calibration_due(now):
+            self.calibrate(now)
+
+        self.reads += 1
+        start = time.perf_counter()
+        try:
+            ppm = self.sensor.read()['co2']
+        except (IOError, OSError, TypeError, ValueError, KeyError):
+            # A backend returns None, hence a TypeError, on a failed read
+            ppm = None
+        self.metrics.observe('read', time.perf_counter() - start,
+                             sensor='MH-Z19')
+
+        if ppm is None:
+            self.failures += 1
+            if self.failures == 1:
+                self.logger.info('Unable to read CO2 data')
+            self.metrics.count('read_errors', sensor='MH-Z19')
+            delay = min(self.max_backoff,
+                        self.interval * 2 ** (self.failures - 1))
+        else:
+            if self.failures:
+                self.logger.info('CO2 sensor answering again after %d '
+                                 'failed reads', self.failures)
+            self.failures = 0
+            self.add(now, ppm)
+            delay = self.interval
+        self.next_read = now + delay
+        return delay
+
+    def add(self, stamp, ppm):
+        self.samples.append((stamp, ppm))
+        if len(self.smoothing) == self.smoothing.maxlen:
+            self.total -= self.smoothing[0]
+        self.smoothing.append(ppm)
+        self.total += ppm
+        self.last = (stamp, ppm)
+
+    def start(self):
+        """
+        Sample in a background thread until stop() is called.
+        """
+
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='co2')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.stopping.wait(self.poll())
+
+    def stop(self):
+        """
+        Stop the background thread and close the sensor's port.
+        """
+
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        close = getattr(self.sensor, 'close', None)
+        if close is not None:
+            close()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+# Declarative tent configuration
+#
+# A tent is described by an INI file, i.e. tent.ini:
+#
+#   [tent]
+#   role = heat
+#   sensors = MCP9808
+#   reserved = 68
+#   pins = 17 27 22
+#   control_ip = 192.168.6.1
+#   temperature_diff = 4
+#   band = 0.5
+#
+#   [zone south]
+#   pins = 5 6 13
+#   addresses = 1a 1b
+#   schedule = 06:00 6, 22:00 3
+#   strategy = pid
+#
+# or by the same settings as a JSON object, zones being a list of
+# objects with a "name" and schedules lists of ["HH:MM", diff] pairs.
+# Only the modules of the configured role, sensor types and hardware
+# are imported, so a control tent never loads the relay code and no
+# driver is loaded for hardware the tent does not have.
+
+import codecs
+import configparser
+import importlib
+import json
+
+# Controller class of each tent role, imported when built
+ROLES = {'heat': ('heatcontroller', 'HeatController'),
+         'control': ('controlcontroller', 'ControlController')}
+
+# Sensor classes by the name used in the configuration
+SENSOR_TYPES = {'MCP9808': ('sensor', 'MCP9808')}
+
+# Settings of a tent and their defaults: a control tent with MCP9808
+# sensors and an RTC module at 0x68
+DEFAULTS = {
+    'role': 'control',
+    'sensors': ['MCP9808'],
+    # Hexadecimal I2C addresses of devices that are not temperature
+    # sensors, i.e. "68"
+    'reserved': ['68'],
+    # Per-sensor offsets, see sensorhealth.load_calibration()
+    'calibration': 'calibration',
+    # Fan, stage one and stage two relay pins of a heat tent
+    'pins': [17, 27, 22],
+    # Control tent publishing the outdoor temperature, and how
+    'control_ip': '192.168.6.1',
+    'feed': 'multicast',
+    # Heat tents allowed to subscribe to a control tent's TCP feed
+    'heat_tents': None,
+    'temperature_diff': 4,
+    'check_interval': 60,
+    # I2C errors in a row before a reboot, and reboots before the
+    # tent stays up with failing sensors
+    'error_max': 3,
+    'reboot_max': 5,
+    # Days of raw readings to keep; none keeps them all
+    'retention_days': None,
+    'strategy': 'threshold',
+    # Degrees past the differential before the threshold strategy
+    # turns a running heater off
+    'band': 0.0,
+    # Thermal model of the tent for the model strategy, as fitted to
+    # its recorded history by evaluate.py: heat loss per hour and the
+    # degrees per hour added by stage one and stage two
+    'model': None,
+    # Heat zones; none drives a single zone from every sensor
+    'zones': [],
+}
+
+# Settings of each zone and their defaults, None being the tent's
+ZONE_DEFAULTS = {
+    'name': None,
+    'pins': None,
+    'addresses': None,
+    'bus': None,
+    'temperature_diff': None,
+    'schedule': None,
+    'strategy': None,
+    'band': None,
+    'model': None,
+    'min_dwell': 30,
+}
+
+
+def words(text):
+    """
+    Split a comma- or space-separated INI value into its words.
+    """
+
+    return text.replace(',', ' ').split()
+
+
+def parse_schedule(text):
+    """
+    Parse "06:00 6, 22:00 off" into [("06:00", 6.0), ("22:00", None)].
+    """
+
+    schedule = []
+    for change in text.split(','):
+        fields = change.split()
+        if len(fields) != 2:
+            raise ValueError('Bad schedule entry %r' % change)
+        diff = None if fields[1] == 'off' else float(fields[1])
+        schedule.append((fields[0], diff))
+    return schedule
+
+
+# Conversion of each INI value from text
+CONVERSIONS = {
+    'sensors': words,
+    'reserved': words,
+    'pins': lambda text: [int(pin) for pin in words(text)],
+    'heat_tents': words,
+    'temperature_diff': float,
+    'check_interval': float,
+    'error_max': int,
+    'reboot_max': int,
+    'retention_days': float,
+    'addresses': lambda text: [int(addr, 16) for addr in words(text)],
+    'schedule': parse_schedule,
+    'min_dwell': float,
+    'band': float,
+    'model': lambda text: [float(value) for value in words(text)],
+}
+
+
+def read_ini(text):
+    """
+    Return the settings in INI text: the [tent] section and a
+    [zone NAME] section per zone.
+    """
+
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_string(text)
+    settings = {'zones': []}
+    for section in parser.sections():
+        values = {}
+        for key, value in parser.items(section):
+            values[key] = CONVERSIONS.get(key, str)(value)
+        if section == 'tent':
+            settings.update(values)
+        elif section.startswith('zone '):
+            values['name'] = section[len('zone '):].strip()
+            settings['zones'].append(values)
+        else:
+            raise ValueError('Unknown section [%s]' % section)
+    return settings
+
+
+def read_json(text):
+    """
+    Return the settings in JSON text. Zone addresses may be given as
+    hexadecimal strings.
+    """
+
+    settings = json.loads(text)
+    if not isinstance(settings, dict):
+        raise ValueError('The configuration must be a JSON object')
+    for zone in settings.get('zones') or []:
+        if zone.get('addresses') is not None:
+            zone['addresses'] = [int(addr, 16) if isinstance(addr, str)
+                                 else addr for addr in zone['addresses']]
+        if zone.get('schedule') is not None:
+            zone['schedule'] = [tuple(change) for change in zone['schedule']]
+    return settings
+
+
+def load(filename=None):
+    """
+    Read a tent's settings from a .json or INI file, with the defaults
+    for any not given, or just the defaults without a filename. Raises
+    ValueError if a setting is unknown or invalid.
+    """
+
+    settings = {}
+    if filename is not None:
+        with codecs.open(filename, 'r', 'utf-8') as config:
+            text = config.read()
+        if filename.endswith('.json'):
+            settings = read_json(text)
+        else:
+            settings = read_ini(text)
+    return validate(settings)
+
+
+def validate(settings):
+    """
+    Return settings merged over the defaults, checking every setting.
+    """
+
+    unknown = set(settings) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('Unknown settings: %s' % ', '.join(sorted(unknown)))
+    merged = dict(DEFAULTS)
+    merged.update(settings)
+
+    if merged['role'] not in ROLES:
+        raise ValueError('role must be one of %s' % ', '.join(sorted(ROLES)))
+    for name in merged['sensors']:
+        if name not in SENSOR_TYPES:
+            raise ValueError('Unknown sensor type %r' % name)
+    for addr in merged['reserved']:
+        int(addr, 16)
+    if merged['feed'] not in ('multicast', 'tcp'):
+        raise ValueError('feed must be multicast or tcp')
+
+    zones = []
+    for zone in merged['zones'] or []:
+        unknown = set(zone) - set(ZONE_DEFAULTS)
+        if unknown:
+            raise ValueError('Unknown zone settings: %s' %
+                             ', '.join(sorted(unknown)))
+        values = dict(ZONE_DEFAULTS)
+        values.update(zone)
+        if not values['name']:
+            raise ValueError('Every zone needs a name')
+        zones.append(values)
+    merged['zones'] = zones
+
+    for pins in [merged['pins']] + [zone['pins'] for zone in zones]:
+        if pins is not None and len(pins) != 3:
+            raise ValueError('Relay pins are fan, stage one and stage two')
+    for model in [merged['model']] + [zone['model'] for zone in zones]:
+        if model is not None and (len(model) != 3 or model[0] <= 0):
+            raise ValueError('A model is a positive heat loss per hour and '
+                             'the stage one and two heat per hour')
+    return merged
+
+
+def import_name(module, name):
+    return getattr(importlib.import_module(module), name)
+
+
+def make_strategy(name, band=0.0, model=None):
+    """
+    Return a new instance of the named strategy with default settings
+    and, for the threshold strategy, a hysteresis band. The model
+    strategy needs the tent's fitted model settings; the defaults
+    describe the simulated tent, not a real one.
+    """
+
+    from strategy import STRATEGIES, ThermalModel
+    if name not in STRATEGIES:
+        raise ValueError('Unknown strategy %r' % name)
+    if name == 'threshold':
+        return STRATEGIES[name](band=band)
+    if name == 'model':
+        if model is None:
+            raise ValueError('The model strategy needs the tent\'s model, '
+                             'as fitted by evaluate.py')
+        loss, stage_one, stage_two = model
+        return STRATEGIES[name](ThermalModel(
+            loss / 3600.0, {"ST1": stage_one / 3600.0,
+                            "ST2": stage_two / 3600.0}))
+    return STRATEGIES[name]()
+
+
+def build(settings, hardware=None, sensor_list=None, **controller_args):
+    """
+    Return the controller for validated settings, importing only the
+    modules it needs. Real hardware and the configured sensor types
+    are used unless a hardware.Hardware or a list of sensors, i.e.
+    simulated ones, is given.
+    """
+
+    if sensor_list is None:
+        from sensorhealth import load_calibration
+        calibration = load_calibration(settings['calibration'])
+        sensor_list = [import_name(*SENSOR_TYPES[name])(
+            settings['reserved'], calibration=calibration)
+            for name in settings['sensors']]
+
+    controller_class = import_name(*ROLES[settings['role']])
+    if settings['role'] == 'control':
+        controller = controller_class(
+            sensor_list, feed=settings['feed'],
+            heat_tents=settings['heat_tents'], hardware=hardware,
+            **controller_args)
+    else:
+        from heatcontroller import Zone
+        zones = [Zone(zone['name'], pins=zone['pins'] or settings['pins'],
+                      addresses=zone['addresses'], bus_id=zone['bus'],
+                      temperature_diff=zone['temperature_diff'],
+                      schedule=zone['schedule'],
+                      strategy=make_strategy(
+                          zone['strategy'] or settings['strategy'],
+                          settings['band'] if zone['band'] is None
+                          else zone['band'],
+                          zone['model'] or settings['model']),
+                      min_dwell=zone['min_dwell'])
+                 for zone in settings['zones']]
+        if not zones:
+            zones = [Zone('tent', pins=settings['pins'],
+                          strategy=make_strategy(settings['strategy'],
+                                                 settings['band'],
+                                                 settings['model']))]
+        controller = controller_class(
+            sensor_list, feed=settings['feed'], hardware=hardware,
+            zones=zones, control_ip=settings['control_ip'],
+            **controller_args)
+        controller.temperature_diff = settings['temperature_diff']
+    controller.check_interval = settings['check_interval']
+    controller.retention_days = settings['retention_days']
+    controller.error_max = settings['error_max']
+    controller.reboot_max = settings['reboot_max']
+    return controller
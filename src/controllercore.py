@@ -0,0 +1,558 @@
+#!/usr/bin/env python
+
+# Event-driven core shared by the heat and control tent controllers
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import logging
+import threading
+import time
+
+from co2sampler import CO2Sampler
+from cycletimer import CycleTimer
+from hardware import real as real_hardware
+import logpipeline
+from metrics import NullMetrics
+from readscheduler import ReadScheduler
+from recordstore import RecordStore, drop_days
+from recordwriter import RecordWriter
+from rollup import Rollups, prune, retention_cutoff
+from sensor import average, format_readings
+import snapshot
+import watchdog
+
+# Samples waiting to be written before the oldest are dropped
+PERSIST_BACKLOG = 60
+
+# One cycle's sensor data: when it was taken, the cycle number and
+# whether it is logged, every sensor.Reading and those of each bus,
+# the values that were read in sensors.csv format, the averaged indoor
+# temperature (0 if no sensor could be read) and the CO2 value in ppm
+# or None
+Sample = collections.namedtuple(
+    'Sample', 'stamp cycle log_cycle readings by_bus fields indoor co2')
+
+
+def offer(queue, item):
+    """
+    Put item on an asyncio queue without waiting, dropping the oldest
+    queued item if the queue is full. Returns the dropped item or None.
+    """
+
+    dropped = None
+    if queue.full():
+        dropped = queue.get_nowait()
+    queue.put_nowait(item)
+    return dropped
+
+
+def sensor_key(sen):
+    """
+    Name of a sensor type in a snapshot, i.e. "MCP9808 i2c-1".
+    """
+
+    return '%s %s' % (sen, sen.bus_id)
+
+
+class ControllerCore(object):
+    """
+    Runs a tent controller as asyncio tasks linked by queues. The
+    sensing task takes one Sample per cycle and hands it to every
+    subscribed task: persistence, which writes the records to disk,
+    and the tasks a tent adds through tasks(), i.e. actuation or
+    publishing. Blocking sensor reads and file writes run in worker
+    threads, and tasks that only need the freshest sample subscribe
+    with a queue of one, so a slow SD card or peer never holds up
+    another task.
+    """
+
+    def __init__(self, sensor_list, metrics=None, hardware=None, gpio=False):
+        """
+        Initializes the variables shared by every tent. Pass a
+        metrics.Metrics to record per-stage cycle timings, and a
+        hardware.Hardware to run on simulated GPIO, CO2 sensor and
+        clock.
+        """
+
+        # Designate the type of sensor we are using.
+        self.sensors = sensor_list
+
+        # GPIO, CO2 sensor and clock, real unless given
+        self.hardware = hardware or real_hardware(gpio=gpio)
+        self.clock = self.hardware.clock
+        self.co2 = self.hardware.co2
+
+        # Keep track of the number of each type of sensors connected.
+        self.num_sensors = [None] * len(self.sensors)
+
+        # Per-stage timings, error counts and heater state; a no-op
+        # unless metrics are enabled
+        self.metrics = metrics or NullMetrics()
+        for sen in self.sensors:
+            sen.metrics = self.metrics
+
+        # Log file, written as JSON lines by a background thread and
+        # rotated daily or at log_max_bytes to gzip-compressed files
+        self.log_file = 'control.log'
+        self.log_max_bytes = 1048576
+
+        # Interval between sensors.csv records, in seconds; the
+        # checking interval may be shorter without logging more often
+        self.log_interval = 60
+
+        # Starts each cycle at a fixed deadline so the time spent in
+        # a cycle does not stretch its period; it keeps the
+        # temperature checking interval, 60 seconds
+        self.timer = CycleTimer(60, clock=self.clock.monotonic,
+                                sleep=self.clock.sleep, wall=self.clock.time)
+
+        # List of sensors connected to the system
+        self.sensor_list = []
+
+        # Initialize the self.indoor temperature
+        self.indoor = 0
+
+        # Initialize self.heater status to OFF
+        self.heater = "OFF"
+
+        # Buffered writer for the individual sensor readings;
+        # rotated daily to sensors.csv.YYYY-MM-DD
+        self.sensor_readings = RecordWriter('sensors.csv',
+                                            clock=self.clock.time)
+
+        # The same readings, one fixed-width record per sensor, in
+        # the binary store for analysis
+        self.sensor_records = RecordStore('sensors.bin',
+                                          clock=self.clock.time)
+
+        # Days to keep the raw readings, in rotated sensors.csv files
+        # and the binary store; None keeps them all
+        self.retention_days = None
+        self.pruned_day = None
+
+        # 5-minute, hourly and daily statistics of every sensor for
+        # long-term retention
+        self.rollups = Rollups()
+
+        # Serializes the writers between the persistence task and a
+        # reboot requested from the sensing thread
+        self.persist_lock = threading.Lock()
+
+        # Instantiate the logging for debugging purposes
+        self.logger = logging.getLogger("Controller")
+
+        # Count I/O errors and reboots in memory; the state file
+        # is only rewritten when the error state changes. It keeps
+        # error_max and reboot_max, 3 I2C errors before a reboot and
+        # at most 5 reboots.
+        self.watchdog = watchdog.Watchdog(3, 5, clock=self.clock.time,
+                                          reboot=self.reboot,
+                                          logger=self.logger)
+
+        # Seconds any single sensor read may take before it is
+        # abandoned so a hung sensor cannot stall the cycle
+        self.read_timeout = 10
+
+        # Runs the reads of the sensor types concurrently, and the
+        # detection of sensors under the same per-bus locks
+        self.scheduler = ReadScheduler(self.read_timeout)
+
+        # Reads the CO2 sensor on its own cadence so a slow or missing
+        # sensor never delays a cycle; the zero point is calibrated on
+        # the first start and then weekly, not at every restart
+        self.co2_sampler = CO2Sampler(self.co2, calibrate_every=7 * 86400,
+                                      clock=self.clock.time,
+                                      metrics=self.metrics,
+                                      logger=self.logger)
+
+        # Age in seconds after which a CO2 value is no longer recorded
+        self.co2_max_age = 120
+
+        # Compact snapshot of the state that would otherwise be lost
+        # on a restart, written every snapshot_interval seconds and
+        # restored at startup if taken within snapshot_max_age
+        self.snapshot_file = 'state.bin'
+        self.snapshot_interval = 60
+        self.snapshot_max_age = 600
+        self.snapshot_taken = None
+
+        # Queues of the tasks that receive each sample
+        self.queues = []
+        self.persist_queue = None
+
+        # Worker threads of a running controller
+        self.sense_worker = None
+        self.persist_worker = None
+
+    @property
+    def error_max(self):
+        """
+        Maximum number of allowable I2C errors before reboot.
+        """
+
+        return self.watchdog.error_max
+
+    @error_max.setter
+    def error_max(self, value):
+        self.watchdog.error_max = value
+
+    @property
+    def reboot_max(self):
+        """
+        Maximum number of allowable reboots.
+        """
+
+        return self.watchdog.reboot_max
+
+    @reboot_max.setter
+    def reboot_max(self, value):
+        self.watchdog.reboot_max = value
+
+    @property
+    def check_interval(self):
+        """
+        Temperature checking interval, in seconds; the outputs may be
+        driven more often than sensors.csv is written every
+        log_interval.
+        """
+
+        return self.timer.interval
+
+    @check_interval.setter
+    def check_interval(self, seconds):
+        self.timer.interval = seconds
+
+    def reboot(self):
+        """
+        Flush the pending sensor records and reboot the system.
+        """
+
+        self.close()
+        self.save_snapshot()
+        self.hardware.reboot()
+
+    def snapshot(self):
+        """
+        Return the state to keep across a restart as a
+        snapshot.Snapshot.
+        """
+
+        return snapshot.Snapshot(
+            self.clock.time(), None, None, self.watchdog.errors,
+            self.watchdog.reboots,
+            [(sensor_key(sen), sen.addresses()) for sen in self.sensors],
+            [])
+
+    def save_snapshot(self):
+        """
+        Write a snapshot of the controller's state.
+        """
+
+        state = self.snapshot()
+        with self.persist_lock:
+            try:
+                snapshot.save(self.snapshot_file, state)
+            except (IOError, OSError):
+                self.logger.info('Unable to save the state snapshot')
+        self.snapshot_taken = state.stamp
+
+    def restore(self):
+        """
+        Restore the state saved before a restart if the snapshot is
+        fresh, and return the snapshot.Snapshot or None.
+        """
+
+        state = snapshot.load(self.snapshot_file, self.snapshot_max_age,
+                              self.clock.time())
+        if state is None:
+            return None
+
+        # Sensors detected before the restart are used until the next
+        # scan instead of scanning the bus first
+        addresses = dict(state.sensors)
+        for sen in self.sensors:
+            if sensor_key(sen) in addresses:
+                try:
+                    self.scheduler.guarded(
+                        sen.bus_id,
+                        functools.partial(sen.restore,
+                                          addresses[sensor_key(sen)]),
+                        time.monotonic() + self.read_timeout)
+                except IOError:
+                    self.logger.info('Error restoring %s sensors', str(sen))
+
+        # Error counts not yet in the watchdog's own state file
+        if state.stamp > self.watchdog.since:
+            self.watchdog.errors = state.errors
+            self.watchdog.reboots = state.reboots
+
+        self.logger.info('Restored state from %d s ago',
+                         int(self.clock.time() - state.stamp))
+        return state
+
+    # Main loop of the program.
+    def main(self, cycles=None):
+        """
+        Configure the logger and record the types of
+        sensors that have been detected by the controller.
+        Runs forever unless a number of cycles is given.
+        """
+
+        log_listener = logpipeline.start(self.log_file,
+                                         max_bytes=self.log_max_bytes)
+
+        self.logger.info('SYSTEM ONLINE')
+
+        # Log the types of sensors we have detected in the system
+        for sen in self.sensors:
+            self.logger.info('Detected %s sensors', str(sen))
+
+        try:
+            asyncio.run(self.run(cycles))
+        finally:
+            # Write out the queued log records
+            log_listener.stop()
+
+    async def run(self, cycles=None):
+        """
+        Run the tasks until `cycles` samples have been taken and
+        handled, or forever.
+        """
+
+        self.loop = asyncio.get_running_loop()
+        # Sensor reads and file writes each get a worker thread so
+        # a slow SD card cannot delay the next sample
+        self.sense_worker = concurrent.futures.ThreadPoolExecutor(1)
+        self.persist_worker = concurrent.futures.ThreadPoolExecutor(1)
+
+        # Pick up where the controller left off before a restart
+        self.restore()
+
+        if self.hardware.background:
+            self.co2_sampler.start()
+
+        self.queues = []
+        self.persist_queue = self.subscribe(PERSIST_BACKLOG)
+        tasks = [asyncio.ensure_future(task)
+                 for task in [self.persist()] + self.tasks()]
+        try:
+            await self.sense(cycles)
+        finally:
+            # Let every task finish what is queued, then stop
+            for queue in self.queues:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+            await self.loop.run_in_executor(self.persist_worker, self.close)
+            self.save_snapshot()
+            self.co2_sampler.stop()
+            self.sense_worker.shutdown()
+            self.persist_worker.shutdown()
+            self.sense_worker = self.persist_worker = None
+
+    def subscribe(self, maxsize=1):
+        """
+        Return a queue that receives every sample; with the default
+        size of one it only ever holds the freshest sample.
+        """
+
+        queue = asyncio.Queue(maxsize)
+        self.queues.append(queue)
+        return queue
+
+    def tasks(self):
+        """
+        Return the coroutines of the tent's own tasks.
+        """
+
+        return []
+
+    async def sense(self, cycles):
+        """
+        Take a sample at each cycle deadline and hand it to the
+        subscribed tasks.
+        """
+
+        completed = 0
+        while cycles is None or completed < cycles:
+            completed += 1
+
+            # Wait for the next cycle deadline
+            cycle = await self.timer.wait_async(self.clock.async_sleep)
+            log_cycle = self.timer.due(self.log_interval)
+            if self.timer.durations:
+                self.metrics.observe('cycle', self.timer.durations[-1])
+
+            sample = await self.loop.run_in_executor(
+                self.sense_worker, self.take_sample, cycle, log_cycle)
+            for queue in self.queues:
+                if (offer(queue, sample) is not None and
+                        queue is self.persist_queue):
+                    self.logger.info('Records backlogged; dropped a sample')
+                    self.metrics.count('dropped_samples')
+
+    def detect(self):
+        """
+        Detect the sensors that are currently connected.
+        """
+
+        for i in range(0, len(self.sensors)):
+            try:
+                with self.metrics.stage('detect',
+                                        sensor=str(self.sensors[i])):
+                    # Never probe a bus while a read holds it
+                    self.scheduler.guarded(
+                        self.sensors[i].bus_id, self.sensors[i].detect,
+                        time.monotonic() + self.read_timeout)
+                self.num_sensors[i] = self.sensors[i].num_sensors
+            except IOError:
+                self.logger.info('Error detecting %s sensors',
+                                 str(self.sensors[i]))
+
+    def take_sample(self, cycle, log_cycle):
+        """
+        Read every sensor type and the CO2 sensor and return a Sample.
+        Runs in the sensing worker thread.
+        """
+
+        self.detect()
+
+        self.logger.info('Building sensors record')
+        stamp = self.clock.time()
+        records = []
+        by_bus = {}
+
+        # Read sensor data from all types of connected sensors.
+        self.logger.info('Reading sensors from Pi')
+        total_indoor = 0
+        total_readings = ""
+        error_flag = 0
+        # Read every sensor type in parallel, each sensor within
+        # read_timeout; a type is only given up on as a whole once
+        # every sensor sharing its bus could have timed out
+        jobs = [(sen.bus_id, functools.partial(sen.read, self.read_timeout))
+                for sen in self.sensors]
+        self.scheduler.timeout = self.read_timeout * (
+            len(self.sensors) + sum(sen.num_sensors()
+                                    for sen in self.sensors))
+        results = self.scheduler.run(jobs)
+        for sen, result in zip(self.sensors, results):
+            self.metrics.observe('read', result.elapsed, sensor=str(sen))
+            try:
+                readings = result.get()
+                records.extend(readings)
+                by_bus.setdefault(sen.bus_id, []).extend(readings)
+                # Flagged sensors are left out of the average
+                total_indoor += average(readings)
+                total_readings += format_readings(readings)
+            except IOError:
+                self.logger.info('Error reading a sensor.')
+                self.metrics.count('read_errors', sensor=str(sen))
+                error_flag += 1
+                self.watchdog.record_error()
+
+        # No I/O error detected this time -> reset counters
+        if not error_flag:
+            self.watchdog.record_success()
+
+        self.logger.info('Detected indoor temp of %.2f',
+                         total_indoor / len(self.sensors))
+
+        # Latest CO2 value from the sampler, read here when it has no
+        # thread of its own
+        if self.co2_sampler.thread is None:
+            self.co2_sampler.poll()
+        co2_val = self.co2_sampler.latest(self.co2_max_age)
+        if co2_val is not None:
+            self.logger.info('Logging %d ppm to file', co2_val)
+            self.metrics.gauge('co2_smoothed', self.co2_sampler.smoothed())
+        else:
+            self.logger.info('No recent CO2 data')
+
+        # Average temperature readings for accuracy, rounded to
+        # three decimal places
+        indoor = round(total_indoor / len(self.sensors), 3)
+
+        # Log the individual readings if we have any sensor data
+        fields = total_readings if error_flag != len(self.sensors) else None
+        return Sample(stamp, cycle, log_cycle, records, by_bus, fields,
+                      indoor, co2_val)
+
+    async def persist(self):
+        """
+        Write each sample to disk in the persistence worker thread.
+        """
+
+        while True:
+            sample = await self.persist_queue.get()
+            if sample is None:
+                return
+            await self.loop.run_in_executor(self.persist_worker,
+                                            self.write_sample, sample)
+
+    def write_sample(self, sample):
+        """
+        Record a sample: a sensors.csv row and binary records on log
+        cycles, and the rollups every cycle.
+        """
+
+        with self.persist_lock:
+            if sample.log_cycle:
+                # Queue the row; the writer flushes rows in batches
+                row = []
+                if sample.fields is not None:
+                    row.append(sample.fields)
+                if sample.co2 is not None:
+                    row.append("," + str(sample.co2) + "ppm")
+                with self.metrics.stage('write'):
+                    self.sensor_readings.write_row(
+                        time.localtime(sample.stamp), *row)
+                    self.sensor_records.write_row(
+                        sample.stamp, sample.readings, sample.co2)
+
+            # Fold every cycle's readings into the rollups
+            with self.metrics.stage('rollup'):
+                self.rollups.add(sample.stamp, sample.readings, sample.co2)
+
+            if self.retention_days is not None:
+                self.prune(sample.stamp)
+
+        if sample.log_cycle:
+            self.metrics.gauge('cycle_overruns', self.timer.overruns)
+            self.metrics.export()
+
+        if (self.snapshot_taken is None or
+                sample.stamp - self.snapshot_taken >= self.snapshot_interval):
+            self.save_snapshot()
+
+    def prune(self, stamp):
+        """
+        Once a day, delete the raw readings older than retention_days:
+        rotated sensors.csv files and the days they cover in the binary
+        store. Called with the persist_lock held.
+        """
+
+        cutoff = retention_cutoff(self.retention_days, stamp)
+        if cutoff == self.pruned_day:
+            return
+        self.pruned_day = cutoff
+        prune(self.sensor_readings.filename, self.retention_days, stamp)
+        # The store is opened again by its next write
+        self.sensor_records.close()
+        try:
+            drop_days(self.sensor_records.filename, cutoff)
+        except (IOError, OSError):
+            self.logger.info('Unable to prune %s',
+                             self.sensor_records.filename)
+
+    def close(self):
+        """
+        Flush and close the record writers and write out the rollup
+        buckets still open.
+        """
+
+        with self.persist_lock:
+            self.sensor_readings.close()
+            self.sensor_records.close()
+            self.rollups.close()
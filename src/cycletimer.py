@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# Fixed-rate timing for the control loop
+
+import collections
+import math
+import time
+
+# What to do when a cycle runs past the next deadline: wait for the
+# next slot on the grid, or start at once and drop any further slots
+POLICIES = ('skip', 'compress')
+
+
+class CycleTimer(object):
+    """
+    Starts control cycles at fixed deadlines on a monotonic clock so
+    the time spent inside a cycle does not add to its period. With
+    align set, deadlines fall on wall-clock multiples of the interval
+    so tents sharing an interval sample at the same moments; the
+    first cycle still starts at once, in the slot already under way.
+    """
+
+    def __init__(self, interval, policy='skip', align=True, window=1440,
+                 clock=time.monotonic, sleep=time.sleep, wall=time.time):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of %s' % (POLICIES,))
+
+        self.interval = interval
+        self.policy = policy
+        self.align = align
+        self.clock = clock
+        self.sleep = sleep
+        self.wall = wall
+
+        # Interval the cycles are numbered by; interval may be changed
+        # between cycles
+        self.spacing = interval
+
+        # Deadline of cycle zero, of the current cycle and its start
+        self.origin = None
+        self.deadline = None
+        self.started = None
+        self.cycle = -1
+        # Cycles started
+        self.count = 0
+
+        # Last slot of each period reported by due()
+        self.last_due = {}
+
+        # Cycles that ran past the next deadline and slots dropped
+        self.overruns = 0
+        self.skipped = 0
+
+        # Recent start lateness and cycle durations, in seconds
+        self.lateness = collections.deque(maxlen=window)
+        self.durations = collections.deque(maxlen=window)
+
+    def wait(self):
+        """
+        Block until the next cycle is due and return its number.
+        The first call returns at once.
+        """
+
+        delay = self.schedule()
+        if delay > 0:
+            self.sleep(delay)
+        return self.begin()
+
+    async def wait_async(self, sleep):
+        """
+        Like wait(), but awaits the coroutine function sleep(seconds)
+        so other tasks run until the cycle is due.
+        """
+
+        delay = self.schedule()
+        if delay > 0:
+            await sleep(delay)
+        return self.begin()
+
+    def schedule(self):
+        """
+        Set the deadline of the next cycle and return the seconds
+        until it is due.
+        """
+
+        now = self.clock()
+        if self.origin is None:
+            self.origin = now
+            self.spacing = self.interval
+            if self.align:
+                # Start of the current slot, so the first cycle need
+                # not wait for the next one after a restart
+                self.origin -= self.wall() % self.interval
+            self.deadline = self.origin
+        else:
+            self.durations.append(now - self.started)
+            if self.interval != self.spacing:
+                # Number the following cycles by the new interval, from
+                # the same origin if the current deadline falls on it
+                self.spacing = self.interval
+                if (self.deadline - self.origin) % self.interval:
+                    self.origin = self.deadline - self.cycle * self.interval
+                    self.last_due = {}
+            self.deadline += self.interval
+            if now > self.deadline:
+                self.overruns += 1
+                # Number of slots that have already started
+                missed = int(math.ceil((now - self.deadline) /
+                                       self.interval))
+                if self.policy == 'skip':
+                    self.deadline += missed * self.interval
+                    self.skipped += missed
+                else:
+                    self.deadline += (missed - 1) * self.interval
+                    self.skipped += missed - 1
+
+        return self.deadline - now
+
+    def begin(self):
+        """
+        Start the cycle scheduled last and return its number.
+        """
+
+        self.started = self.clock()
+        self.count += 1
+        # The first cycle starts within its slot, not late
+        if self.cycle >= 0:
+            self.lateness.append(max(0.0, self.started - self.deadline))
+        self.cycle = int(round((self.deadline - self.origin) / self.interval))
+        return self.cycle
+
+    def due(self, period):
+        """
+        Return True for the first cycle in each `period` seconds,
+        i.e. to log once a minute while controlling faster.
+        """
+
+        every = max(1, int(round(period / float(self.interval))))
+        # Compare slot indexes so a skipped slot is not lost
+        slot = self.cycle // every
+        if self.last_due.get(period) == slot:
+            return False
+        self.last_due[period] = slot
+        return True
+
+    def stats(self):
+        """
+        Return the cycle jitter statistics over the recent window.
+        """
+
+        late = sorted(self.lateness)
+        durations = list(self.durations)
+        return {
+            'cycles': self.count,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'lateness_mean': sum(late) / len(late) if late else 0.0,
+            'lateness_p99': late[int(len(late) * 0.99)] if late else 0.0,
+            'lateness_max': late[-1] if late else 0.0,
+            'duration_mean': (sum(durations) / len(durations)
+                              if durations else 0.0),
+            'duration_max': max(durations) if durations else 0.0,
+        }
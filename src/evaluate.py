@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+# Offline evaluation of heater control strategies
+#
+# Usage: python evaluate.py HEAT_CSV CONTROL_CSV [--diff 4]
+#            [--strategy pid --strategy model ...] [--recorded-diff 4]
+#
+# A thermal model of the heat tent is fitted to its recorded history.
+# The heater states are first taken from a replay of the threshold
+# control the tent ran with at --recorded-diff, then from whichever
+# state best explains each temperature change. Each strategy then drives the
+# fitted model through the recorded outdoor temperatures and is scored
+# by how closely it holds the differential and how often it switches
+# the relays.
+
+import argparse
+import collections
+
+from actuator import RELAY_LEVELS
+from readings import robust_mean
+from replay import align, indoor_mean, load
+from strategy import SENSOR_FAULT, STRATEGIES, Threshold, ThermalModel
+
+# Root mean square and mean shortfall of the differential, in degrees,
+# relay switch count and cycles spent in each heater state
+Score = collections.namedtuple('Score', 'rms_error shortfall switches '
+                                        'cycles')
+
+
+def recorded_states(stamps, indoor, outdoor, temperature_diff):
+    """
+    Heater state after each recorded cycle, as the threshold control
+    set it, or None while the sensors were failing.
+    """
+
+    strategy = Threshold()
+    return [strategy.step(stamp, inside, outside, temperature_diff)
+            for stamp, inside, outside in zip(stamps, indoor, outdoor)]
+
+
+def infer_states(stamps, indoor, outdoor, states, model):
+    """
+    Relabel each cycle with the state, among those in states, that
+    best predicts the next indoor temperature. Cycles whose state is
+    None, i.e. sensor faults, keep it.
+    """
+
+    candidates = sorted(set(state for state in states
+                            if state is not None))
+    inferred = list(states)
+    for i in range(len(stamps) - 1):
+        if states[i] is None:
+            continue
+        inside, after = indoor[i], indoor[i + 1]
+        step = stamps[i + 1] - stamps[i]
+        inferred[i] = min(candidates, key=lambda state: abs(
+            model.predict(inside, outdoor[i], state, step) - after))
+    return inferred
+
+
+def fit_history(stamps, indoor, outdoor, temperature_diff, rounds=5):
+    """
+    Fit a ThermalModel to a recorded heat tent history run with the
+    threshold control at temperature_diff. A replay gives the first
+    guess of the heater states, which misses cycles where the tent
+    saw a slightly different outdoor temperature than was recorded;
+    the states are then inferred from the model and the model refitted
+    until they settle.
+    """
+
+    states = recorded_states(stamps, indoor, outdoor, temperature_diff)
+    model = ThermalModel.fit(stamps, indoor, outdoor, states)
+    for _ in range(rounds):
+        inferred = infer_states(stamps, indoor, outdoor, states, model)
+        if inferred == states:
+            break
+        states = inferred
+        model = ThermalModel.fit(stamps, indoor, outdoor, states)
+    return model
+
+
+def evaluate(stamps, outdoor, model, strategy, temperature_diff,
+             indoor=None):
+    """
+    Drive a ThermalModel with a strategy.Strategy through the outdoor
+    temperatures at stamps and return its Score. The model starts at
+    the indoor temperature given, or at the wanted differential.
+    Missing and faulty outdoor readings repeat the last good one.
+    """
+
+    state = "OFF"
+    cycles = dict((name, 0) for name in RELAY_LEVELS)
+    switches = 0
+    squares = 0.0
+    shortfall = 0.0
+    scored = 0
+    inside = indoor
+    previous = None
+    last_stamp = None
+    for stamp, outside in zip(stamps, outdoor):
+        if outside == SENSOR_FAULT or outside != outside:
+            outside = previous
+        if outside is None:
+            continue
+        if inside is None:
+            inside = outside + temperature_diff
+        else:
+            inside = model.predict(inside, previous, state,
+                                   stamp - last_stamp)
+        last_stamp = stamp
+        previous = outside
+
+        chosen = strategy.step(stamp, round(inside, 3), outside,
+                               temperature_diff)
+        if chosen is not None and chosen != state:
+            switches += sum(before != after for before, after in
+                            zip(RELAY_LEVELS[state], RELAY_LEVELS[chosen]))
+            state = chosen
+        cycles[state] += 1
+
+        error = inside - outside - temperature_diff
+        squares += error * error
+        shortfall += max(0.0, -error)
+        scored += 1
+
+    if not scored:
+        return Score(0.0, 0.0, switches, cycles)
+    return Score((squares / scored) ** 0.5, shortfall / scored, switches,
+                 cycles)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Score heater control strategies against a thermal '
+                    'model fitted to recorded sensor histories.')
+    parser.add_argument('heat', help="heat tent's sensors.csv")
+    parser.add_argument('control', help="control tent's sensors.csv")
+    parser.add_argument('--diff', type=float, default=4,
+                        help='temperature differential to hold '
+                             '(default: 4)')
+    parser.add_argument('--strategy', choices=sorted(STRATEGIES),
+                        action='append',
+                        help='strategy to score, with default settings; '
+                             'may be repeated (default: all)')
+    parser.add_argument('--recorded-diff', type=float, default=4,
+                        help='differential the heat tent was recorded '
+                             'with (default: 4)')
+    parser.add_argument('--max-age', type=float, default=300,
+                        help='seconds after which outdoor readings are '
+                             'stale (default: 300)')
+    args = parser.parse_args(argv)
+
+    stamps, indoor, outdoor = align(load(args.heat, indoor_mean),
+                                    load(args.control, robust_mean),
+                                    args.max_age)
+    model = fit_history(stamps, indoor, outdoor, args.recorded_diff)
+    print('fitted %r' % model)
+    # The same model per hour, as the tent's configuration takes it
+    print('model = %.4g %.4g %.4g' % (model.loss * 3600,
+                                      model.rates["ST1"] * 3600,
+                                      model.rates["ST2"] * 3600))
+
+    print('strategy,rms_error,shortfall,switches,OFF,FAN,ST1,ST2')
+    for name in args.strategy or sorted(STRATEGIES):
+        if name == 'model':
+            strategy = STRATEGIES[name](model)
+        else:
+            strategy = STRATEGIES[name]()
+        score = evaluate(stamps, outdoor, model, strategy, args.diff)
+        print('%s,%.3f,%.3f,%d,%d,%d,%d,%d' % (
+            name, score.rms_error, score.shortfall, score.switches,
+            score.cycles["OFF"], score.cycles["FAN"], score.cycles["ST1"],
+            score.cycles["ST2"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+# Hardware backends for GPIO, the CO2 sensor and the clock, with
+# simulated counterparts for running the controllers off a Pi
+
+import asyncio
+import math
+import random
+import threading
+import time
+
+import bus
+import watchdog
+
+# Seconds in a simulated day, used for the outdoor temperature cycle
+DAY = 86400.0
+
+
+class SystemClock(object):
+    """
+    Wall and monotonic time from the operating system.
+    """
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    async def async_sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    def localtime(self):
+        return time.localtime()
+
+
+class SimClock(object):
+    """
+    Virtual clock for simulation; sleeping advances time instantly.
+    """
+
+    def __init__(self, start=None):
+        self.now = time.time() if start is None else start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+    async def async_sleep(self, seconds):
+        # Let the tasks woken by the current cycle run before
+        # time moves on
+        await asyncio.sleep(0)
+        self.sleep(seconds)
+
+    def localtime(self):
+        return time.localtime(self.now)
+
+
+class RPiGPIO(object):
+    """
+    GPIO backend driving the Raspberry Pi pins through RPi.GPIO.
+    """
+
+    def __init__(self):
+        # Imported here so the controllers can be loaded off a Pi.
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+
+        # Use the Broadcom SOC channel number
+        GPIO.setmode(GPIO.BCM)
+
+    def setup_output(self, pin):
+        """
+        Configure a pin as an output.
+        """
+
+        self.GPIO.setup(pin, self.GPIO.OUT)
+
+    def output(self, pin, high):
+        """
+        Drive a pin HIGH if high is true, otherwise LOW.
+        """
+
+        self.GPIO.output(pin, self.GPIO.HIGH if high else self.GPIO.LOW)
+
+
+class SimGPIO(object):
+    """
+    Simulated GPIO that records pin levels and counts writes.
+    """
+
+    def __init__(self):
+        self.pins = {}
+        self.writes = 0
+
+    def setup_output(self, pin):
+        self.pins.setdefault(pin, False)
+
+    def output(self, pin, high):
+        if pin not in self.pins:
+            raise RuntimeError('Pin %d is not set up as an output' % pin)
+        self.pins[pin] = bool(high)
+        self.writes += 1
+
+
+class MHZ19Serial(object):
+    """
+    CO2 backend talking to the MH-Z19 over a serial port that is kept
+    open between reads. The port is reopened after an error.
+    """
+
+    # Read the gas concentration; calibrate the zero point
+    READ = b'\xff\x01\x86\x00\x00\x00\x00\x00\x79'
+    ZERO = b'\xff\x01\x87\x00\x00\x00\x00\x00\x78'
+
+    def __init__(self, port='/dev/serial0', timeout=1.0):
+        self.port = port
+        self.timeout = timeout
+        self.serial = None
+
+    def open(self):
+        # Imported on first use so startup does not load pyserial.
+        if self.serial is None:
+            import serial
+            self.serial = serial.Serial(self.port, baudrate=9600,
+                                        timeout=self.timeout)
+        return self.serial
+
+    def command(self, frame):
+        try:
+            port = self.open()
+            port.reset_input_buffer()
+            port.write(frame)
+            return port.read(9)
+        except (IOError, OSError):
+            self.close()
+            raise
+
+    def read(self):
+        """
+        Return {'co2': ppm}, or None if the sensor did not answer.
+        """
+
+        reply = bytearray(self.command(self.READ))
+        if (len(reply) != 9 or reply[0] != 0xff or reply[1] != 0x86 or
+                (0x100 - sum(reply[1:8])) & 0xff != reply[8]):
+            return None
+        return {'co2': reply[2] * 256 + reply[3]}
+
+    def zero_point_calibration(self):
+        """
+        Calibrate the current CO2 level as 400 ppm.
+        """
+
+        self.command(self.ZERO)
+
+    def close(self):
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            finally:
+                self.serial = None
+
+
+class SimCO2(object):
+    """
+    Simulated CO2 sensor with noise, latency and dropped reads.
+    """
+
+    def __init__(self, ppm=410, noise=5.0, latency=0.0, failure_rate=0.0,
+                 seed=None):
+        self.ppm = ppm
+        self.noise = noise
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.reads = 0
+        self.calibrations = 0
+
+    def read(self):
+        self.reads += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.random.random() < self.failure_rate:
+            # MHZ19Serial returns None when the serial read fails
+            return None
+        return {'co2': int(round(self.ppm +
+                                 self.random.gauss(0, self.noise)))}
+
+    def zero_point_calibration(self):
+        self.calibrations += 1
+
+
+class SimTent(object):
+    """
+    First-order thermal model of a tent. The indoor temperature
+    relaxes toward a daily outdoor cycle and is raised by the heater
+    according to which relay pins are HIGH on the simulated GPIO.
+    """
+
+    def __init__(self, clock, gpio=None, pins=(17, 27, 22), indoor=None,
+                 mean_outdoor=15.0, swing=8.0, loss=1.0 / 3600,
+                 heat_rates=(0.0, 10.0 / 3600, 20.0 / 3600)):
+        self.clock = clock
+        self.gpio = gpio
+        # Fan, stage one and stage two relay pins
+        self.pins = pins
+        self.mean_outdoor = mean_outdoor
+        self.swing = swing
+        # Fraction of the indoor/outdoor difference lost per second
+        self.loss = loss
+        # Degrees per second added by each heater stage
+        self.heat_rates = heat_rates
+
+        self.updated = clock.time()
+        self.indoor = self.outdoor() if indoor is None else indoor
+        # Sensors on different buses read the model concurrently
+        self.lock = threading.Lock()
+
+    def outdoor(self, when=None):
+        """
+        Outdoor temperature, coldest at 6:00 and warmest at 18:00.
+        """
+
+        when = self.clock.time() if when is None else when
+        phase = 2 * math.pi * ((when % DAY) - DAY / 4) / DAY
+        return self.mean_outdoor - self.swing * math.cos(phase)
+
+    def stage(self):
+        """
+        Heater stage currently commanded through the relays.
+        """
+
+        if self.gpio is None:
+            return 0
+        fan, stage_one, stage_two = [self.gpio.pins.get(pin, False)
+                                     for pin in self.pins]
+        if not fan:
+            return 0
+        if stage_two:
+            return 2
+        return 1 if stage_one else 0
+
+    def temperature(self):
+        """
+        Advance the model to the current time and return the indoor
+        temperature.
+        """
+
+        with self.lock:
+            now = self.clock.time()
+            rate = self.heat_rates[self.stage()]
+            while self.updated < now:
+                step = min(60.0, now - self.updated)
+                self.updated += step
+                self.indoor += ((self.outdoor(self.updated) - self.indoor) *
+                                self.loss + rate) * step
+            return self.indoor
+
+
+class SimMCP9808Device(object):
+    """
+    Simulated MCP9808 handle reading the tent model, with the same
+    begin()/readTempC() interface as the Adafruit driver.
+    """
+
+    def __init__(self, tent, address, offset=0.0, noise=0.05, latency=0.0,
+                 failure_rate=0.0, rng=None, i2c_bus=None):
+        self.tent = tent
+        self.address = address
+        # Bus the sensor is attached to; reads fail once detached
+        self.bus = i2c_bus
+        self.offset = offset
+        self.noise = noise
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = rng or random.Random(address)
+
+    def begin(self):
+        return True
+
+    def readTempC(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if (self.random.random() < self.failure_rate or
+           (self.bus is not None and self.address not in self.bus.devices)):
+            raise IOError(121, 'Remote I/O error')
+        # The MCP9808 reports in steps of 0.0625 degrees
+        value = (self.tent.temperature() + self.offset +
+                 self.random.gauss(0, self.noise))
+        return round(value * 16) / 16.0
+
+
+class SimBus(bus.FakeBus):
+    """
+    Simulated I2C bus with MCP9808 sensors attached to a tent model.
+    Sensors can be attached and detached to exercise hot-plugging.
+    """
+
+    def __init__(self, tent, addresses=(), busnum=1, latency=0.0,
+                 failure_rate=0.0, seed=None):
+        bus.FakeBus.__init__(self, addresses, busnum)
+        self.tent = tent
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+
+    def open_sensor(self, addr):
+        """
+        Return a simulated driver handle for the sensor at addr.
+        """
+
+        return SimMCP9808Device(self.tent, addr,
+                                offset=self.random.uniform(-0.25, 0.25),
+                                latency=self.latency,
+                                failure_rate=self.failure_rate,
+                                rng=random.Random(self.random.random()),
+                                i2c_bus=self)
+
+
+class SimOutdoorFeed(object):
+    """
+    Stands in for the control tent's outdoor feed in simulation.
+    """
+
+    def __init__(self, tent, sensors=4, noise=0.1, seed=None):
+        self.tent = tent
+        self.sensors = sensors
+        self.noise = noise
+        self.random = random.Random(seed)
+
+    def latest(self):
+        outdoor = self.tent.outdoor()
+        return [outdoor + self.random.gauss(0, self.noise)
+                for _ in range(self.sensors)], 0.0
+
+    def publish(self, readings):
+        pass
+
+
+class Hardware(object):
+    """
+    The hardware a controller drives: GPIO, CO2 sensor, clock and
+    the action taken when the watchdog reboots the system.
+    """
+
+    def __init__(self, gpio=None, co2=None, clock=None, reboot=None):
+        self.gpio = gpio
+        self.co2 = co2
+        self.clock = clock or SystemClock()
+        self.reboot = reboot or watchdog.system_reboot
+        # Whether samplers may run in their own threads; on a virtual
+        # clock they are polled from the control cycle instead
+        self.background = True
+
+
+def real(gpio=True):
+    """
+    Hardware of a Raspberry Pi tent. Control tents have no relays.
+    """
+
+    return Hardware(gpio=RPiGPIO() if gpio else None, co2=MHZ19Serial())
+
+
+def simulated(clock=None, co2=None):
+    """
+    Simulated hardware on a virtual clock; reboots are only counted.
+    """
+
+    clock = clock or SimClock()
+    hardware = Hardware(gpio=SimGPIO(), co2=co2 or SimCO2(), clock=clock)
+    hardware.background = False
+    hardware.reboots = 0
+
+    def reboot():
+        hardware.reboots += 1
+    hardware.reboot = reboot
+    return hardware
@@ -5,325 +5,349 @@
 # Adapted and modified by: Dan Wagner
 # Agronomy Research, 2018-2019
 
-import logging
-import sys
+import bisect
 import time
-import RPi.GPIO as GPIO
-import codecs
-import subprocess
-import string
-import mh_z19
 
+from actuator import RelayActuator
+from controllercore import ControllerCore
+from outdoorfeed import OutdoorClient, OutdoorSubscriber
+from readings import OutdoorAggregator
+from recordwriter import RecordWriter
+from sensor import average
+from strategy import SENSOR_FAULT, Threshold
 
-class HeatController:
+
+# Heater state reported by the heater_stage gauge; the fan alone
+# gives no heat
+HEATER_LEVELS = {"OFF": 0, "FAN": 0, "ST1": 1, "ST2": 2, "SENSOR": -1}
+
+
+def minute_of_day(text):
     """
-    Controller class that manages the Thermostat system
+    Convert a local "HH:MM" time to minutes after midnight.
     """
-    def __init__(self, sensor_list):
-        """
-        Initializes the controller's variables and list of sensors.
-        """
 
-        # Designate the type of sensor we are using.
-        self.sensors = sensor_list
+    hours, minutes = text.split(':')
+    minute = int(hours) * 60 + int(minutes)
+    if not 0 <= minute < 1440:
+        raise ValueError('Bad time of day %r' % text)
+    return minute
 
-        # Keep track of the number of each type of sensors connected.
-        self.num_sensors = [None] * len(self.sensors)
 
-        # Format for logging information
-        self.format = "%(asctime)-15s %(message)s"
+class Zone(object):
+    """
+    A tent, or part of one, heated through its own fan, stage one and
+    stage two relays from the sensors selected by I2C address and/or
+    bus. The schedule lists ("HH:MM", differential) changes over the
+    day; a differential of None keeps the heater off from that time.
+    The strategy, a strategy.Strategy, chooses the heater stage, and
+    the relays keep each state for at least min_dwell seconds.
+    """
 
-        # Temperature differential for tent
-        self.temperature_diff = 4
+    def __init__(self, name, pins=(17, 27, 22), addresses=None, bus_id=None,
+                 temperature_diff=None, schedule=None, strategy=None,
+                 min_dwell=30):
+        self.name = name
 
-        # Temperature checking interval, in seconds
-        self.check_interval = 60
+        # Chooses the heater stage; each zone needs its own instance
+        self.strategy = strategy or Threshold()
 
-        # IP address of the control tent for outdoor temperature monitoring
-        self.control_ip = '192.168.6.1'
+        # Fan, stage one and stage two relay pins, driven through a
+        # RelayActuator once the controller sets them up
+        self.pins = tuple(pins)
+        self.min_dwell = min_dwell
+        self.actuator = None
 
-        # File location for outdoor temperature from server
-        # Includes the colon for scp (pi@ip:dir)
-        self.control_dir = ':/home/pi/thermostat-controllers/src/outdoor .'
+        # Sensors of the zone: integer addresses, i.e. 0x18, and/or a
+        # bus such as 'i2c-1'; with neither, every sensor
+        self.addresses = (frozenset(addresses) if addresses is not None
+                          else None)
+        self.bus_id = bus_id
 
-        # List of sensors connected to the system
-        self.sensor_list = []
+        # Differential outside the schedule; None uses the controller's
+        self.temperature_diff = temperature_diff
 
-        # Initialize the self.indoor temperature
-        self.indoor = 0
+        # Schedule as sorted minutes after midnight and differentials
+        changes = sorted((minute_of_day(start), diff)
+                         for start, diff in schedule or ())
+        self.starts = [start for start, _ in changes]
+        self.diffs = [diff for _, diff in changes]
 
-        # Initialize self.heater status to OFF
+        self.indoor = 0
         self.heater = "OFF"
 
-        # Set up the relay signal pin
-        self.signal_pin = 17
+    def diff_at(self, stamp, default):
+        """
+        Differential called for at stamp; default is used when the
+        zone has neither a schedule nor a differential of its own.
+        """
 
-        # Set up the stage one pin
-        self.stage_one_pin = 27
+        if not self.starts:
+            return (default if self.temperature_diff is None
+                    else self.temperature_diff)
+        when = time.localtime(stamp)
+        # Before the first change of the day the last one still holds
+        i = bisect.bisect_right(self.starts,
+                                when.tm_hour * 60 + when.tm_min) - 1
+        return self.diffs[i]
 
-        # Set up the stage two pin
-        self.stage_two_pin = 22
+    def select(self, sample):
+        """
+        Return the readings of the zone's sensors in a sample.
+        """
 
-        # Use the Broadcom SOC channel number
-        GPIO.setmode(GPIO.BCM)
+        if self.bus_id is None:
+            readings = sample.readings
+        else:
+            readings = sample.by_bus.get(self.bus_id, [])
+        if self.addresses is not None:
+            readings = [r for r in readings if r.address in self.addresses]
+        return readings
 
-        # Set it as an output pin
-        GPIO.setup(self.signal_pin, GPIO.OUT)
-        GPIO.setup(self.stage_one_pin, GPIO.OUT)
-        GPIO.setup(self.stage_two_pin, GPIO.OUT)
+    def measure(self, sample):
+        """
+        Averaged indoor temperature of the zone, rounded to three
+        decimal places, or 0 if none of its sensors could be read.
+        """
 
-        # Pull it low for safety
-        GPIO.output(self.signal_pin, GPIO.LOW)
-        GPIO.output(self.stage_one_pin, GPIO.LOW)
-        GPIO.output(self.stage_two_pin, GPIO.LOW)
+        if self.addresses is None and self.bus_id is None:
+            return sample.indoor
+        try:
+            return round(average(self.select(sample)), 3)
+        except IOError:
+            return 0
 
-        # Delimit the next day's individual sensor readings via blank line
-        self.sensor_readings = codecs.open('sensors.csv', 'a', 'utf-8')
-        self.sensor_readings.write('\n')
-        self.sensor_readings.close()
 
-        # Instantiate the logging for debugging purposes
-        self.logger = logging.getLogger("Controller")
+class HeatController(ControllerCore):
+    """
+    Controller class that manages the Thermostat system
+    """
+    def __init__(self, sensor_list, feed='multicast', metrics=None,
+                 hardware=None, outdoor_feed=None, zones=None,
+                 control_ip='192.168.6.1'):
+        """
+        Initializes the controller's variables and list of sensors.
+        The outdoor feed is received by multicast or, with feed='tcp',
+        from the control tent's feed server, unless an outdoor_feed
+        is given. Pass a metrics.Metrics to record per-stage cycle
+        timings, and a hardware.Hardware to run on simulated GPIO,
+        CO2 sensor and clock. A list of Zones drives several relay
+        groups from the one set of sensor reads; by default a single
+        zone uses every sensor and pins 17, 27 and 22. control_ip is
+        the address of the control tent.
+        """
 
-        # Record number of reboots the system has experienced
-        self.reboots = ''
+        ControllerCore.__init__(self, sensor_list, metrics=metrics,
+                                hardware=hardware, gpio=True)
 
-        # Record the number of recent I/O errors
-        self.io_errors = ''
+        # Temperature differential for tent
+        self.temperature_diff = 4
 
-        # Maximum number of allowable reboots
-        self.reboot_max = 5
+        # IP address of the control tent for outdoor temperature monitoring
+        self.control_ip = control_ip
+
+        # Age in seconds after which outdoor readings are considered stale
+        self.outdoor_max_age = 300
+
+        # Latest outdoor readings pushed by the control tent
+        if outdoor_feed is not None:
+            self.outdoor_feed = outdoor_feed
+        elif feed == 'tcp':
+            self.outdoor_feed = OutdoorClient(self.control_ip)
+        else:
+            self.outdoor_feed = OutdoorSubscriber(source=self.control_ip)
+
+        # Combines the outdoor readings, rejecting outlying sensors,
+        # and keeps the last good value
+        self.outdoor_average = OutdoorAggregator(initial=0.0,
+                                                 clock=self.clock.time)
+        self.outdoor = 0.0
+
+        # Zones heated by this controller, each with its own relays
+        self.zones = zones or [Zone('tent')]
+        names = [zone.name for zone in self.zones]
+        if len(set(names)) != len(names):
+            raise ValueError('Zone names must be unique')
+        pins = [pin for zone in self.zones for pin in zone.pins]
+        if len(set(pins)) != len(pins):
+            raise ValueError('Zones must not share relay pins')
+
+        # Relay signal, stage one and stage two pins of the first zone
+        self.signal_pin, self.stage_one_pin, self.stage_two_pin = \
+            self.zones[0].pins
+
+        # Relay transitions, one "timestamp,zone,from,to,held" row per
+        # change written by the persistence worker; rotated daily to
+        # relays.csv.YYYY-MM-DD
+        self.transition_log = RecordWriter('relays.csv', flush_rows=1,
+                                           clock=self.clock.time)
+
+        # Set them as output pins, only written when their level
+        # changes, and pull them low for safety
+        self.gpio = self.hardware.gpio
+        for zone in self.zones:
+            zone.actuator = RelayActuator(self.gpio, zone.pins, zone.name,
+                                          journal=self.journal,
+                                          clock=self.clock.time,
+                                          logger=self.logger)
+            zone.actuator.apply("OFF", force=True)
+
+    def journal(self, stamp, fields):
+        """
+        Hand a relay transition to the persistence worker so switching
+        the relays never waits on the SD card.
+        """
 
-        # Maximum number of allowable I2C errors before reboot
-        self.error_max = 3
+        if self.persist_worker is None:
+            self.write_transition(stamp, fields)
+        else:
+            self.persist_worker.submit(self.write_transition, stamp, fields)
 
-    # Main loop of the program.
-    def main(self):
+    def write_transition(self, stamp, fields):
+        """
+        Append a relay transition to relays.csv.
+        """
 
+        with self.persist_lock:
+            try:
+                self.transition_log.write_row(time.localtime(stamp), fields)
+            except (IOError, OSError):
+                self.logger.info('Unable to record a relay transition')
+
+    def close(self):
+        # Also write out the relay transitions
+        ControllerCore.close(self)
+        with self.persist_lock:
+            self.transition_log.close()
+
+    def snapshot(self):
+        # Also keep the outdoor value and each zone's relay state
+        state = ControllerCore.snapshot(self)
+        return state._replace(
+            outdoor=self.outdoor_average.value,
+            outdoor_updated=self.outdoor_average.updated,
+            zones=[(zone.name, zone.actuator.state, zone.strategy.since)
+                   for zone in self.zones])
+
+    def restore(self):
         """
-        Configure the logger and record the types of
-        sensors that have been detected by the controller.
+        Also return the relays to their state before the restart and
+        take up the last outdoor value.
         """
 
-        self.logger.basicConfig = logging.basicConfig(format=self.format, filename='control.log',
-                            level=logging.INFO)
+        state = ControllerCore.restore(self)
+        if state is None:
+            return None
+
+        if state.outdoor is not None:
+            self.outdoor_average.value = state.outdoor
+            self.outdoor_average.updated = state.outdoor_updated
+            self.outdoor = state.outdoor
+
+        zones = dict((name, (relays, since))
+                     for name, relays, since in state.zones)
+        for zone in self.zones:
+            if zone.name not in zones:
+                continue
+            relays, since = zones[zone.name]
+            zone.heater = zone.actuator.apply(relays, force=True)
+            # Minimum on and off times carry on from before the restart
+            zone.strategy.state = relays
+            zone.strategy.since = since
+        self.heater = self.zones[0].heater
+        return state
+
+    def set_relays(self, state, zone=None, stamp=None):
+        """
+        Drive the fan, stage one and stage two relays of a zone, the
+        first by default, for a heater state. Returns the state the
+        relays are in, which stays the previous one until it has been
+        held for the zone's min_dwell.
+        """
 
-        self.logger.info('SYSTEM ONLINE')
-        
-        # Initialize the logging string for future use
-        logging_str = 'Average retrieved temperature: ' + repr(0.00)
+        zone = zone or self.zones[0]
+        return zone.actuator.apply(state, stamp, min_dwell=zone.min_dwell)
 
-        # Log the types of sensors we have detected in the system
-        for sen in self.sensors:
-            self.logger.info('Detected %s sensors', str(sen))
+    def tasks(self):
+        # Actuation only ever acts on the freshest sample
+        return [self.actuate(self.subscribe())]
 
-        # Calibrate current CO2 to 410ppm
-        mh_z19.zero_point_calibration()
+    async def actuate(self, queue):
+        """
+        Switch the heater on each new sample, independently of how
+        long the sample takes to be written to disk.
+        """
 
         while True:
-            # Detect the sensors that are currently connected
-            for i in range(0, len(self.sensors)):
-                try:
-                    self.sensors[i].detect()
-                    self.num_sensors[i] = self.sensors[i].num_sensors
-                except IOError:
-                    self.logger.info('Error detecting %s sensors',
-                                     str(self.sensors[i]))
+            sample = await queue.get()
+            if sample is None:
+                return
+            self.control(sample)
 
-            try:
-                # Open the sensor readings file and write current timestamp.
-                self.logger.info('Opening sensors file for records')
-                self.sensor_readings = codecs.open('sensors.csv', 'a', 'utf-8')
-                self.sensor_readings.write(time.strftime("%Y/%m/%d %H:%M:%S",
-                                                         time.localtime()))
-
-                # Read sensor data from all types of connected sensors.
-                self.logger.info('Reading sensors from Pi')
-                total_indoor = 0
-                total_readings = ""
-                error_flag = 0
-                io_flag = 0
-                for sen in self.sensors:
-                    try:
-                        self.indoor, readings = sen.read()
-                        total_indoor += self.indoor
-                        total_readings += readings
-                    except (IOError, ZeroDivisionError):
-                        self.logger.info('Error reading a sensor.')
-                        error_flag += 1
-                        io_flag = 1
-                        # Read in error and reboot values for updates
-                        self.io_errors = codecs.open('io_error', 'r', 'utf-8')
-                        num_errors = int(self.io_errors.read())
-                        self.io_errors.close()
-                        self.reboots = codecs.open('reboots', 'r', 'utf-8')
-                        num_reboots = int(self.reboots.read())
-                        self.reboots.close()
-                        # If maximum reboots not reached, then reboot
-                        if (num_errors >= self.error_max and
-                           num_reboots < self.reboot_max):
-                            self.logger.info('Maximum I/O errors (%d);' +
-                                             ' rebooting.', num_errors)
-                            self.io_errors = codecs.open('io_error',
-                                                         'w')
-                            num_reboots += 1
-                            self.io_errors.write('0')
-                            self.io_errors.close()
-                            self.reboots = codecs.open('reboots', 'w')
-                            self.reboots.write((str(num_reboots)))
-                            self.reboots.close()
-                            self.sensor_readings.close()
-
-                            proc = subprocess.Popen('reboot',
-                                                    stdout=subprocess.PIPE,
-                                                    shell=True)
-                            out, err = proc.communicate()
-
-                        # If maximum reboots reached, stay on
-                        elif num_reboots >= self.reboot_max:
-                            num_errors += 1
-                            self.logger.info('Max reboots (%d) reached;' +
-                                             ' I/O error #%d occurred',
-                                             num_reboots, num_errors)
-                            self.io_errors = codecs.open('io_error',
-                                                         'w')
-                            self.io_errors.write((str(num_errors)))
-                            self.io_errors.close()
-
-                        # If maximums not reached, record the error
-                        elif (num_reboots < self.reboot_max and
-                              num_errors < self.error_max):
-                            num_errors += 1
-                            self.logger.info('I/O Error #%d occurred',
-                                             num_errors)
-                            self.io_errors = codecs.open('io_error',
-                                                         'w')
-                            self.io_errors.write((str(num_errors)))
-                            self.io_errors.close()
-
-                # No I/O error detected this time -> reset counters
-                if not io_flag:
-                    self.logger.info('No I/O error detected; ' +
-                                     'resetting number of errors and reboots')
-                    self.io_errors = codecs.open('io_error', 'w')
-                    self.io_errors.write('0')
-                    self.io_errors.close()
-                    self.reboots = codecs.open('reboots', 'w')
-                    self.reboots.write('0')
-                    self.reboots.close()
-
-                self.logger.info('Detected indoor temp of %.2f',
-                                 total_indoor / len(self.sensors))
-
-                # Log the individual readings if we have any sensor data
-                if error_flag != len(self.sensors):
-                    self.sensor_readings.write(total_readings)
-
-                self.logger.info('Reading CO2 data')
-                try:
-                    # Read CO2 sensor data and log to file
-                    co2_val = mh_z19.read()['co2']
-                    fmt_string = "," + str(co2_val) + "ppm"
-                    self.logger.info('Logging %d ppm to file', co2_val)
-                    self.sensor_readings.write(fmt_string)
-                except TypeError:
-                    self.logger.info('Unable to read CO2 data')
-
-                # Write a new line for the next reading interval
-                self.sensor_readings.write('\n')
-
-                # Close the sensor readings file
-                self.sensor_readings.close()
-
-                # Average temperature readings for accuracy
-                self.indoor = total_indoor / len(self.sensors)
-
-                # Round to three decimal places
-                self.indoor = round(self.indoor, 3)
-
-                self.logger.info('Retrieving outdoor temp from control tent')
-                # Retrieve outdoor temp from the control tent and parse it
-                out_proc = subprocess.Popen('sudo scp -o ConnectTimeout=10 pi@' +
-                                            self.control_ip + self.control_dir,
-                                            stdout=subprocess.PIPE,
-                                            shell=True)
-                out, err = out_proc.communicate()
-
-                try:
-                    out_proc.terminate()
-                except OSError:
-                    pass
-
-                # Open retrieved file, read the line, convert and round.
-                outdoor_temps = codecs.open('outdoor', 'r')
-                temps = outdoor_temps.read().split(',')
-                outdoor_temps.close()
-                out_vals = []
-
-                # Initialize the logging string for future use
-                # Remove any NULL characters received from the control tent
-                # If any occur, remove them and still record that temperature
-                for t in temps:
-                    try:
-                        out_vals.append(float(t))
-                    except:
-                        valid_parts = []
-                        for char in t:
-                            if char in string.printable:
-                                valid_parts.append(char)
-                        if len(valid_parts) > 0:
-                            joined = "".join(v for v in valid_parts)
-                            out_vals.append(float(joined))
-                        
-                # Convert the line to a list of floating point values
-                out_list = list(map(float, out_vals))
-                # Compute the average of the outdoor temperature for comparison
-                # If an error occurred in parsing the outdoor, use the previous reading
-                if len(out_list) > 0:
-                    outdoor = sum(out_list) / len(out_list)
-                else:
-                    start_point = logging_str.find(':') + 1
-                    prev_outdoor = float(logging_str[start_point:])
-                    outdoor = prev_outdoor
-
-                self.outdoor = round(outdoor, 3)
-                logging_str = 'Average retrieved temperature: ' + repr(self.outdoor)
-                self.logger.info(logging_str)
-
-                if self.indoor == 0 and self.outdoor == 0:
-                    # both sensors disconnected while running
-                    raise RuntimeError
-
-            except RuntimeError as ex:
-                # Exception occurred with sensor: notify via GUI
-                self.indoor = 90
-                self.outdoor = 90
-                self.heater = "SENSOR"
-
-                # Record exception information
-                self.logger.info('%s', repr(sys.exc_info()))
-                print((str(ex)))
-
-            # If indoor temperature is below differential then
-            # engage Stage 2 since the purge period and Stage 1
-            # won't be enough to maintain our differential
-            if (self.indoor - self.outdoor < self.temperature_diff and
-               self.indoor != 90 and self.outdoor != 90):
-                self.heater = "ST2"
-                GPIO.output(self.signal_pin, GPIO.HIGH)
-                GPIO.output(self.stage_one_pin, GPIO.HIGH)
-                GPIO.output(self.stage_two_pin, GPIO.HIGH)
-
-            else:
-                # Indoors >= outdoors -- turn off heater.
-                if (self.indoor != 90 and self.outdoor != 90):
-                    self.heater = "OFF"
-                    GPIO.output(self.signal_pin, GPIO.LOW)
-                    GPIO.output(self.stage_one_pin, GPIO.LOW)
-                    GPIO.output(self.stage_two_pin, GPIO.LOW)
+    def control(self, sample):
+        """
+        Combine a sample with the latest outdoor temperature and
+        drive the relays of every zone accordingly.
+        """
 
-            self.logger.info('%.2f inside, %.2f outside, heater %s',
-                             self.indoor, self.outdoor, self.heater)
+        self.logger.info('Retrieving outdoor temp from control tent')
+        with self.metrics.stage('outdoor'):
+            # Latest readings published by the control tent;
+            # this never waits on the network.
+            out_list, age = self.outdoor_feed.latest()
+            if out_list is None:
+                self.logger.info('No outdoor temp received yet')
+                out_list = []
+            elif age > self.outdoor_max_age:
+                self.logger.info('Outdoor temp is stale (%d s old)', age)
+                out_list = []
+            if age is not None:
+                self.metrics.gauge('outdoor_age_seconds', age)
+
+            # Compute the average of the outdoor temperature
+            # If no readings were received, use the previous value
+            self.outdoor = self.outdoor_average.update(out_list)
+        self.logger.info('Average retrieved temperature: %r', self.outdoor)
+
+        for zone in self.zones:
+            self.control_zone(zone, sample)
+
+        # The first zone stands for the tent in the status display
+        self.indoor = self.zones[0].indoor
+        self.heater = self.zones[0].heater
+
+    def control_zone(self, zone, sample):
+        """
+        Switch one zone's heater from its own sensors and schedule.
+        """
 
-            # Sleep system until the next check cycle.
-            time.sleep(self.check_interval)
+        zone.indoor = zone.measure(sample)
+        outdoor = self.outdoor
+        if zone.indoor == 0 and outdoor == 0:
+            # Both sensors disconnected while running: notify via GUI
+            self.logger.info('Indoor and outdoor sensors are not reading')
+            zone.indoor = SENSOR_FAULT
+            outdoor = SENSOR_FAULT
+            zone.heater = "SENSOR"
+
+        # Only label the metrics when there is more than one zone
+        labels = {'zone': zone.name} if len(self.zones) > 1 else {}
+        with self.metrics.stage('actuate', **labels):
+            # A differential of None means heating is scheduled off
+            diff = zone.diff_at(sample.stamp, self.temperature_diff)
+            state = zone.strategy.step(sample.stamp, zone.indoor, outdoor,
+                                       diff)
+            if state is not None:
+                zone.heater = self.set_relays(state, zone, sample.stamp)
+                # The minimum on, off and purge times follow the
+                # relays, which may still hold the previous state
+                zone.strategy.settle(zone.heater)
+        self.metrics.gauge('heater_stage', HEATER_LEVELS[zone.heater],
+                           **labels)
+
+        if labels:
+            self.logger.info('Zone %s: %.2f inside, %.2f outside, heater %s',
+                             zone.name, zone.indoor, outdoor, zone.heater)
+        else:
+            self.logger.info('%.2f inside, %.2f outside, heater %s',
+                             zone.indoor, outdoor, zone.heater)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+# Asynchronous JSON-lines logging for the controllers
+#
+# Usage: python logpipeline.py [control.log]
+#
+# Log records are handed to a background thread through a bounded
+# queue, so a cycle never waits on the SD card, and written to
+# control.log one compact JSON object per line:
+#
+#   {"t":1562896800.125,"m":"%.2f inside, %.2f outside, heater %s",
+#    "a":[21.5,17,"OFF"]}
+#
+# "t" is the time in seconds since the epoch, "m" the message template
+# and "a" its arguments, "l" the level unless it is INFO, "r" the
+# repeats suppressed and "x" an exception traceback. The template and
+# its arguments are kept apart so the log can be filtered without
+# parsing text. A message repeated with the same arguments is written
+# at most once per dedupe window, with the number of repeats
+# suppressed since. The log is rotated at local midnight or when it
+# reaches max_bytes, and rotated files are gzip-compressed to
+# control.log.1.gz, control.log.2.gz and so on. Run this module to
+# print a log, rotated files included, as plain text.
+
+import argparse
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import time
+
+# Records waiting for the writer thread before new ones are dropped
+QUEUE_SIZE = 10000
+
+# Start of each line, followed by the time of the record
+TIME_PREFIX = '{"t":'
+
+# Level of the records written without one
+DEFAULT_LEVEL = 'INFO'
+
+
+def plain(value):
+    """
+    Return value as a JSON-serializable number, string or None.
+    """
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records with their arguments kept apart from the template,
+    and drops records rather than block when the writer falls behind.
+    """
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Freeze the arguments now; they may change once queued
+        record = logging.makeLogRecord(record.__dict__)
+        if isinstance(record.args, dict):
+            record.args = (dict((key, plain(value)) for key, value in
+                                record.args.items()),)
+        elif record.args:
+            record.args = tuple(plain(arg) for arg in record.args)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as one compact JSON line.
+    """
+
+    def format(self, record):
+        # Dictionaries keep their order, so "t" stays first
+        entry = {'t': round(record.created, 3)}
+        if record.levelname != DEFAULT_LEVEL:
+            entry['l'] = record.levelname
+        entry['m'] = str(record.msg)
+        if record.args:
+            entry['a'] = list(record.args)
+        if getattr(record, 'repeated', 0):
+            entry['r'] = record.repeated
+        if record.exc_text:
+            entry['x'] = record.exc_text
+        return json.dumps(entry, separators=(',', ':'))
+
+
+class DedupeFilter(logging.Filter):
+    """
+    Passes a message, identified by its template and arguments, at most
+    once per window seconds, noting on it how many were suppressed.
+    """
+
+    def __init__(self, window=300, max_keys=1024):
+        logging.Filter.__init__(self)
+        self.window = window
+        self.max_keys = max_keys
+        # (level, template, arguments) -> [time last passed, suppressed]
+        self.seen = {}
+        # When entries past the window were last dropped
+        self.pruned = None
+
+    def filter(self, record):
+        if self.window <= 0:
+            return True
+        try:
+            key = (record.levelno, str(record.msg), record.args)
+            hash(key)
+        except TypeError:
+            return True
+        entry = self.seen.get(key)
+        if entry is not None and record.created - entry[0] < self.window:
+            entry[1] += 1
+            return False
+
+        record.repeated = entry[1] if entry is not None else 0
+        self.prune(record.created)
+        if len(self.seen) >= self.max_keys:
+            self.seen.clear()
+        self.seen[key] = [record.created, 0]
+        return True
+
+    def prune(self, now):
+        """
+        Once per window, forget messages last passed more than a window
+        ago; they have not been seen since, and would pass again anyway.
+        """
+
+        if self.pruned is not None and now - self.pruned < self.window:
+            return
+        self.pruned = now
+        for key, (passed, _) in list(self.seen.items()):
+            if now - passed >= self.window:
+                del self.seen[key]
+
+
+class CompressingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotates the log at local midnight or once it reaches max_bytes,
+    gzip-compressing the rotated files and keeping `backups` of them.
+    """
+
+    def __init__(self, filename, max_bytes=1048576, backups=30):
+        logging.handlers.RotatingFileHandler.__init__(
+            self, filename, maxBytes=max_bytes, backupCount=backups,
+            encoding='utf-8')
+        self.namer = lambda name: name + '.gz'
+        self.rotator = compress
+        self.day = None
+        if os.path.exists(self.baseFilename):
+            self.day = time.localtime(
+                os.path.getmtime(self.baseFilename))[:3]
+
+    def shouldRollover(self, record):
+        day = time.localtime(record.created)[:3]
+        if self.day is None:
+            self.day = day
+        if day != self.day:
+            self.day = day
+            return os.path.exists(self.baseFilename) and \
+                os.path.getsize(self.baseFilename) > 0
+        return logging.handlers.RotatingFileHandler.shouldRollover(
+            self, record)
+
+
+def compress(source, dest):
+    """
+    Gzip source to dest, keeping its modification time, and remove it.
+    """
+
+    with open(source, 'rb') as data, gzip.open(dest, 'wb') as packed:
+        shutil.copyfileobj(data, packed)
+    info = os.stat(source)
+    os.utime(dest, (info.st_atime, info.st_mtime))
+    os.remove(source)
+
+
+def start(filename='control.log', level=logging.INFO, dedupe=300,
+          max_bytes=1048576, backups=30):
+    """
+    Route the root logger through the pipeline and return the listener
+    running the writer thread; call stop() on it to flush and close.
+    """
+
+    log_queue = queue.Queue(QUEUE_SIZE)
+    handler = CompressingFileHandler(filename, max_bytes, backups)
+    handler.setFormatter(JSONFormatter())
+    handler.addFilter(DedupeFilter(dedupe))
+    listener = Listener(log_queue, handler)
+
+    root = logging.getLogger()
+    root.addHandler(listener.queue_handler)
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+class Listener(logging.handlers.QueueListener):
+    """
+    Writer thread of the pipeline; stop() also detaches it from the
+    root logger.
+    """
+
+    def __init__(self, log_queue, handler):
+        logging.handlers.QueueListener.__init__(self, log_queue, handler)
+        self.queue_handler = StructuredQueueHandler(log_queue)
+
+    def stop(self):
+        logging.getLogger().removeHandler(self.queue_handler)
+        logging.handlers.QueueListener.stop(self)
+        for handler in self.handlers:
+            handler.close()
+
+
+def history(filename='control.log'):
+    """
+    Return the rotated logs, oldest first, followed by the current one.
+    """
+
+    rotated = []
+    number = 1
+    while os.path.exists('%s.%d.gz' % (filename, number)):
+        rotated.append('%s.%d.gz' % (filename, number))
+        number += 1
+    rotated.reverse()
+    if os.path.exists(filename):
+        rotated.append(filename)
+    return rotated
+
+
+def open_log(path):
+    """
+    Open a current or rotated log for reading bytes.
+    """
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def render(line):
+    """
+    Return a JSON log line as "time level message" text; lines in the
+    older plain text format are returned as they are.
+    """
+
+    if not line.startswith(TIME_PREFIX):
+        return line.rstrip('\n')
+    try:
+        entry = json.loads(line)
+        message = entry['m']
+        if 'a' in entry:
+            args = entry['a']
+            message = message % (args[0] if len(args) == 1 and
+                                 isinstance(args[0], dict) else tuple(args))
+        millis = int(round(entry['t'] * 1000))
+    except (ValueError, KeyError, TypeError):
+        return line.rstrip('\n')
+    text = '%s.%03d %s %s' % (
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(millis // 1000)),
+        millis % 1000, entry.get('l', DEFAULT_LEVEL), message)
+    if entry.get('r'):
+        text += ' (%d repeats suppressed)' % entry['r']
+    if 'x' in entry:
+        text += '\n' + entry['x']
+    return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Print a JSON-lines controller log as text.')
+    parser.add_argument('log', nargs='?', default='control.log',
+                        help='log file (default: control.log)')
+    args = parser.parse_args(argv)
+
+    for path in history(args.log):
+        with open_log(path) as data:
+            for line in data:
+                sys.stdout.write(
+                    render(line.decode('utf-8', 'replace')) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,66 @@
-# from heatcontroller import HeatController
-from controlcontroller import ControlController
+import os
+import sys
 
-# (1) Change sensor type here
-from sensor import MCP9808
+import config
 
-# (2) Change sensor type here
-# List representation for use if the system will
-# contain multiple types of temperature sensors.
+# Usage: python main.py [tent.ini | tent.json]
+#        python main.py --simulate [heat | control] [cycles]
+#
+# The tent is described by a configuration file (see config.py): its
+# role, the types of sensor connected, the reserved I2C addresses
+# that are used by components other than temperature sensors, i.e.
+# "68" for the RTC module, the relay pins, heat zones and the control
+# tent's address. tent.ini or tent.json is read when no file is
+# given; without either, the tent is a control tent with MCP9808
+# sensors. Per-sensor offsets are read from the "calibration" file,
+# i.e. a line "18 -0.125" lowers the readings of the sensor at 0x18.
+#
+# A heat tent with two zones, the second on a schedule and a PID
+# controller checked every 15 s:
+#
+#   [tent]
+#   role = heat
+#   reserved = 68
+#   check_interval = 15
+#
+#   [zone north]
+#   pins = 17 27 22
+#   addresses = 18 19
+#
+#   [zone south]
+#   pins = 5 6 13
+#   addresses = 1a 1b
+#   temperature_diff = 6
+#   schedule = 06:00 6, 22:00 3
+#   strategy = pid
+#
+# To support another type of sensor, implement the Sensor superclass
+# in sensor.py and list it in config.SENSOR_TYPES.
 
 
-# List of reserved i2c addresses
-# that are used by components
-# other than temperature sensors.
-# Make sure that each of the elements
-# in this list are hexadecimal strings
-# i.e. "1a".
-reserved = ["68"]
+def find_config():
+    for filename in ('tent.ini', 'tent.json'):
+        if os.path.exists(filename):
+            return filename
+    return None
 
-# You must include a Python implementation that
-# uses the Sensor superclass for the
-# type of sensor in your system (see sensor.py)
-sensor = [MCP9808(reserved)]
 
-# Initialize the controller program
-# tent_control = HeatController(sensor)
+# Run a heat or control tent on simulated hardware with a virtual
+# clock instead, i.e. `python main.py --simulate heat 10080` for a
+# week of cycles.
+if len(sys.argv) > 1 and sys.argv[1] == '--simulate':
+    import simulation
+    role = sys.argv[2] if len(sys.argv) > 2 else 'heat'
+    cycles = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    tent_control, _, _ = simulation.build(
+        role, config.load(find_config())['reserved'])
+    tent_control.main(cycles)
+    sys.exit(0)
 
-tent_control = ControlController(sensor)
+# Initialize the controller program; only the drivers of the
+# configured hardware are imported
+settings = config.load(sys.argv[1] if len(sys.argv) > 1 else find_config())
+tent_control = config.build(settings)
 
 # Enter the main control loop
 tent_control.main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+# Cycle timing instrumentation and metrics export
+
+import bisect
+import collections
+import os
+import threading
+import time
+
+# Upper bounds, in seconds, of the stage duration histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0, 30.0)
+
+
+def format_labels(labels, extra=()):
+    """
+    Render label pairs in Prometheus text format, i.e. {stage="read"}.
+    """
+
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % pair for pair in pairs) + '}'
+
+
+class Histogram(object):
+    """
+    Cumulative bucket counts for export plus a rolling window of
+    recent observations for quantiles.
+    """
+
+    def __init__(self, window):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q):
+        """
+        Return the q quantile of the rolling window.
+        """
+
+        ordered = sorted(self.recent)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class Stage(object):
+    """
+    Context manager timing one stage of the cycle. An exception
+    raised inside the stage is also counted as an error.
+    """
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = self.metrics.clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, self.metrics.clock() - self.start,
+                             **self.labels)
+        if exc_type is not None:
+            self.metrics.count('errors', stage=self.name, **self.labels)
+        return False
+
+
+class Metrics(object):
+    """
+    Records per-stage durations, error counts and gauges such as the
+    heater state in memory and exports them to a file in Prometheus
+    text format, suitable for the node_exporter textfile collector.
+    """
+
+    def __init__(self, path='metrics.prom', prefix='thermostat',
+                 window=1440, clock=time.perf_counter):
+        self.path = path
+        self.prefix = prefix
+        self.window = window
+        self.clock = clock
+
+        self.histograms = {}
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def stage(self, name, **labels):
+        """
+        Return a context manager timing the named stage.
+        """
+
+        return Stage(self, name, labels)
+
+    def observe(self, name, seconds, **labels):
+        """
+        Record the duration of one run of the named stage.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.window)
+            self.histograms[key].observe(seconds)
+
+    def count(self, name, amount=1, **labels):
+        """
+        Increase the named counter.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += amount
+
+    def gauge(self, name, value, **labels):
+        """
+        Set the named gauge to its current value.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def render(self):
+        """
+        Return all metrics in Prometheus text format.
+        """
+
+        lines = []
+        stage = self.prefix + '_stage_seconds'
+        with self.lock:
+            if self.histograms:
+                lines.append('# TYPE %s histogram' % stage)
+            for (name, labels), hist in sorted(self.histograms.items()):
+                labels = (('stage', name),) + labels
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), hist.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        stage, format_labels(labels, [('le', bound)]),
+                        cumulative))
+                lines.append('%s_sum%s %.6f' % (stage, format_labels(labels),
+                                                 hist.total))
+                lines.append('%s_count%s %d' % (stage, format_labels(labels),
+                                                 hist.count))
+
+            # Quantiles over the rolling window of recent cycles
+            recent = self.prefix + '_stage_recent_seconds'
+            if self.histograms:
+                lines.append('# TYPE %s gauge' % recent)
+            for (name, labels), hist in sorted(self.histograms.items()):
+                labels = (('stage', name),) + labels
+                for q in (0.5, 0.99):
+                    lines.append('%s%s %.6f' % (
+                        recent, format_labels(labels, [('quantile', q)]),
+                        hist.quantile(q)))
+
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('%s_%s_total%s %d' % (
+                    self.prefix, name, format_labels(labels), value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append('%s_%s%s %s' % (self.prefix, name,
+                                             format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        """
+        Atomically replace the metrics file with the current values.
+        """
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            out.write(self.render())
+        os.rename(tmp_path, self.path)
+
+
+class NullStage(object):
+    """
+    Stage that records nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class NullMetrics(object):
+    """
+    Stand-in used when metrics are disabled; every call is a no-op.
+    """
+
+    null_stage = NullStage()
+
+    def stage(self, name, **labels):
+        return self.null_stage
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def count(self, name, amount=1, **labels):
+        pass
+
+    def gauge(self, name, value, **labels):
+        pass
+
+    def export(self):
+        pass
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+# Outdoor temperature feed from the control tent to the heat tents
+
+import logging
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from readings import parse_readings
+
+# Multicast group and port the control tent publishes on
+MULTICAST_GROUP = '239.6.1.1'
+FEED_PORT = 5007
+
+# Frames are short; a tent with more than this many bytes queued is
+# too far behind and only receives the newest frame.
+MAX_PENDING = 4096
+
+
+def encode_frame(seq, stamp, readings):
+    """
+    Encode one outdoor sample as a newline-delimited ASCII frame:
+    sequence number, publish time and comma-separated readings.
+    """
+
+    return ('%d %.6f %s\n' % (seq, stamp,
+                              ','.join(repr(v) for v in readings))
+            ).encode('ascii')
+
+
+def decode_frame(frame):
+    """
+    Decode a frame into (seq, stamp, readings).
+    Raises ValueError for malformed frames.
+    """
+
+    parts = frame.decode('ascii', 'ignore').split()
+    if len(parts) == 2:
+        # No sensors answered at the control tent
+        parts.append('')
+    if len(parts) != 3:
+        raise ValueError('Malformed outdoor frame')
+    readings = parse_readings(parts[2])
+    return int(parts[0]), float(parts[1]), readings
+
+
+class OutdoorPublisher(object):
+    """
+    Publishes outdoor readings from the control tent to every
+    subscribed heat tent with a single multicast datagram.
+    Sending never blocks the control cycle.
+    """
+
+    def __init__(self, group=MULTICAST_GROUP, port=FEED_PORT, ttl=1,
+                 clock=time.time):
+        self.address = (group, port)
+        self.clock = clock
+        self.seq = 0
+        self.logger = logging.getLogger("Controller")
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                  socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setblocking(False)
+
+    def publish(self, readings):
+        """
+        Send the latest outdoor readings to all subscribers.
+        """
+
+        self.seq += 1
+        try:
+            self.sock.sendto(encode_frame(self.seq, self.clock(), readings),
+                             self.address)
+        except (IOError, OSError):
+            self.logger.info('Unable to publish outdoor readings')
+
+    def close(self):
+        self.sock.close()
+
+
+class FeedReceiver(object):
+    """
+    Keeps the latest outdoor sample received from the control tent
+    in memory along with the time it arrived.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+
+        # Latest sample and the local time it was received
+        self.values = None
+        self.received = None
+        self.seq = None
+        self.stamp = None
+        self.lock = threading.Lock()
+
+    def handle(self, frame):
+        """
+        Store a received frame if it is newer than the current sample.
+        """
+
+        try:
+            seq, stamp, values = decode_frame(frame)
+        except ValueError:
+            return
+        with self.lock:
+            # Drop reordered frames; a restarted publisher resets
+            # its sequence but its publish time still moves forward.
+            if self.stamp is not None and (stamp, seq) <= (self.stamp,
+                                                           self.seq):
+                return
+            self.seq = seq
+            self.stamp = stamp
+            self.values = values
+            self.received = self.clock()
+
+    def latest(self):
+        """
+        Return (readings, age in seconds) of the newest sample,
+        or (None, None) if nothing has been received yet.
+        """
+
+        with self.lock:
+            if self.values is None:
+                return None, None
+            return list(self.values), self.clock() - self.received
+
+
+class OutdoorSubscriber(FeedReceiver):
+    """
+    Receives multicast outdoor readings in a background thread.
+    """
+
+    def __init__(self, group=MULTICAST_GROUP, port=FEED_PORT,
+                 source=None, clock=time.time):
+        FeedReceiver.__init__(self, clock)
+        self.group = group
+        self.port = port
+        # Only accept frames sent from this address, if given
+        self.source = source
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                  socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', port))
+        membership = struct.pack('4sl', socket.inet_aton(group),
+                                 socket.INADDR_ANY)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                             membership)
+        self.sock.settimeout(1.0)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='outdoor-feed')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        Receive frames until stopped.
+        """
+
+        while self.running:
+            try:
+                frame, sender = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except (IOError, OSError):
+                if self.running:
+                    time.sleep(1.0)
+                continue
+            if self.source is not None and sender[0] != self.source:
+                continue
+            self.handle(frame)
+
+    def stop(self):
+        """
+        Stop the receive thread and close the socket.
+        """
+
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+
+class OutdoorServer(object):
+    """
+    Serves outdoor readings from the control tent over persistent TCP
+    connections. Each heat tent connects once and every published
+    sample is encoded once and pushed to all connected tents from a
+    single selector thread. A tent that connects is sent the latest
+    sample straight away.
+    """
+
+    def __init__(self, host='', port=FEED_PORT, tents=None,
+                 clock=time.time):
+        # Addresses of the heat tents allowed to subscribe, if given
+        self.tents = set(tents) if tents is not None else None
+        self.clock = clock
+        self.seq = 0
+        self.logger = logging.getLogger("Controller")
+
+        # Connected tents and the bytes still queued for each
+        self.clients = {}
+        self.latest_frame = None
+        self.outbox = None
+        self.lock = threading.Lock()
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+
+        # Wakes the selector thread when a sample is published
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.wake_send.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.selector.register(self.wake_recv, selectors.EVENT_READ)
+
+        # CPU seconds used by the selector thread once stopped
+        self.cpu_time = 0.0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='outdoor-server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, readings):
+        """
+        Queue the latest outdoor readings for every connected tent.
+        """
+
+        self.seq += 1
+        with self.lock:
+            self.outbox = encode_frame(self.seq, self.clock(), readings)
+        try:
+            self.wake_send.send(b'x')
+        except (IOError, OSError):
+            # Wake-up already pending
+            pass
+
+    def run(self):
+        """
+        Accept tents and fan out published frames until stopped.
+        """
+
+        while self.running:
+            for key, mask in self.selector.select(timeout=1.0):
+                sock = key.fileobj
+                if sock is self.listener:
+                    self.accept()
+                elif sock is self.wake_recv:
+                    self.fan_out()
+                elif mask & selectors.EVENT_READ:
+                    self.receive(sock)
+                elif mask & selectors.EVENT_WRITE:
+                    self.send(sock)
+        self.cpu_time = time.thread_time()
+
+    def accept(self):
+        """
+        Register a newly connected tent.
+        """
+
+        try:
+            sock, addr = self.listener.accept()
+        except (IOError, OSError):
+            return
+        if self.tents is not None and addr[0] not in self.tents:
+            self.logger.info('Rejected outdoor feed client %s', addr[0])
+            sock.close()
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.clients[sock] = bytearray(self.latest_frame or b'')
+        self.selector.register(sock, selectors.EVENT_READ)
+        if self.latest_frame:
+            self.send(sock)
+
+    def fan_out(self):
+        """
+        Queue the newest frame for all tents and write it out.
+        """
+
+        try:
+            while self.wake_recv.recv(4096):
+                pass
+        except (IOError, OSError):
+            pass
+        with self.lock:
+            frame, self.outbox = self.outbox, None
+        if frame is None:
+            return
+        self.latest_frame = frame
+        for sock in list(self.clients):
+            pending = self.clients[sock]
+            if len(pending) + len(frame) > MAX_PENDING:
+                # Tent is too far behind; only the newest frame matters
+                del pending[:]
+            pending += frame
+            self.send(sock)
+
+    def send(self, sock):
+        """
+        Write as much queued data to a tent as its socket accepts.
+        """
+
+        pending = self.clients[sock]
+        try:
+            sent = sock.send(pending)
+        except (IOError, OSError):
+            self.drop(sock)
+            return
+        del pending[:sent]
+        events = selectors.EVENT_READ
+        if pending:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(sock).events != events:
+            self.selector.modify(sock, events)
+
+    def receive(self, sock):
+        """
+        Tents never send data; a readable socket means it closed.
+        """
+
+        try:
+            data = sock.recv(256)
+        except (IOError, OSError):
+            data = b''
+        if not data:
+            self.drop(sock)
+
+    def drop(self, sock):
+        """
+        Forget a disconnected tent.
+        """
+
+        self.selector.unregister(sock)
+        del self.clients[sock]
+        sock.close()
+
+    def close(self):
+        """
+        Stop serving and disconnect every tent.
+        """
+
+        self.running = False
+        self.wake_send.send(b'x')
+        self.thread.join()
+        for sock in list(self.clients):
+            self.drop(sock)
+        self.selector.close()
+        self.listener.close()
+        self.wake_recv.close()
+        self.wake_send.close()
+
+
+class OutdoorClient(FeedReceiver):
+    """
+    Receives outdoor readings from the control tent's OutdoorServer
+    over one persistent TCP connection, reconnecting with backoff.
+    """
+
+    def __init__(self, host, port=FEED_PORT, clock=time.time,
+                 max_backoff=60):
+        FeedReceiver.__init__(self, clock)
+        self.address = (host, port)
+        self.max_backoff = max_backoff
+        self.sock = None
+
+        # Set by stop() to cut short a reconnect backoff
+        self.stopping = threading.Event()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='outdoor-feed')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        Connect to the control tent and read frames until stopped.
+        """
+
+        backoff = 1
+        while self.running:
+            try:
+                self.sock = socket.create_connection(self.address, timeout=10)
+                self.sock.settimeout(1.0)
+                backoff = 1
+                self.receive()
+            except (IOError, OSError):
+                pass
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+            if self.running:
+                self.stopping.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def receive(self):
+        """
+        Split the stream into newline-delimited frames.
+        """
+
+        buffered = b''
+        while self.running:
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                continue
+            if not data:
+                return
+            buffered += data
+            while b'\n' in buffered:
+                frame, buffered = buffered.split(b'\n', 1)
+                self.handle(frame)
+
+    def stop(self):
+        """
+        Stop the receive thread and close the connection.
+        """
+
+        self.running = False
+        self.stopping.set()
+        self.thread.join()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+# Time-range queries over the recorded sensor data
+#
+# Usage: python query.py START END [--source sensors.csv] [--format json]
+#
+# i.e. python query.py "2019-07-12 02:00" "2019-07-12 04:00" prints the
+# sensors.csv rows recorded between 02:00 and 04:00 on July 12 followed
+# by the count, min, mean and max of each sensor. The source may also be
+# the binary store (sensors.bin) or the controller log (control.log).
+#
+# Text files are searched through a sparse index of the timestamp and
+# byte offset of the first line in each block of the file, kept next to
+# it as FILE.idx and extended as the file grows, so a query only reads
+# the blocks holding the requested range.
+
+import argparse
+import bisect
+import json
+import os
+import struct
+import sys
+import time
+
+import logpipeline
+from readings import parse_fields, parse_stamp, strip_unprintable
+from recordwriter import DAY_FORMAT, ROW_FORMAT, history
+
+# Bytes between sparse index entries
+BLOCK = 65536
+
+# Inode and size of the indexed part of the file
+INDEX_HEADER = struct.Struct('<QQ')
+
+# Timestamp and byte offset of the first line of a block
+INDEX_ENTRY = struct.Struct('<dQ')
+
+# Start of a JSON-lines control.log line, before the timestamp in
+# seconds since the epoch
+JSON_PREFIX = logpipeline.TIME_PREFIX.encode('ascii')
+
+# Accepted formats for the START and END arguments
+TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d",
+                ROW_FORMAT, "%Y/%m/%d %H:%M", "%Y/%m/%d")
+
+
+def parse_time(text):
+    """
+    Convert a local date and time, i.e. "2019-07-12 02:00", to seconds
+    since the epoch.
+    """
+
+    for fmt in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            continue
+    raise ValueError('Unrecognised time %r' % text)
+
+
+def row_stamp(line):
+    """
+    Timestamp of a sensors.csv line, or None if it has none.
+    """
+
+    try:
+        return parse_stamp(line[:19].decode('ascii'))
+    except (ValueError, UnicodeDecodeError, OverflowError):
+        return None
+
+
+def log_stamp(line):
+    """
+    Timestamp of a control.log line, JSON or plain text, or None for
+    continuation lines.
+    """
+
+    try:
+        if line.startswith(JSON_PREFIX):
+            return float(line[len(JSON_PREFIX):].split(b',', 1)[0])
+        return parse_stamp(line[:19].decode('ascii').replace('-', '/'))
+    except (ValueError, UnicodeDecodeError, OverflowError):
+        return None
+
+
+class SparseIndex(object):
+    """
+    Timestamps and offsets of the first line starting in each block
+    of a time-ordered text file. The index is saved to FILE.idx and
+    only the part of the file written since is read to extend it; a
+    file that was replaced is indexed again from the start.
+    """
+
+    def __init__(self, path, stamp=row_stamp, block=BLOCK):
+        self.path = path
+        self.stamp = stamp
+        self.block = block
+        self.index_path = path + '.idx'
+        self.inode = None
+        self.size = 0
+        self.stamps = []
+        self.offsets = []
+
+    def load(self):
+        try:
+            with open(self.index_path, 'rb') as index:
+                data = index.read()
+        except IOError:
+            return
+        if len(data) < INDEX_HEADER.size:
+            return
+        self.inode, self.size = INDEX_HEADER.unpack_from(data)
+        data = data[INDEX_HEADER.size:]
+        data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+        for stamp, offset in INDEX_ENTRY.iter_unpack(data):
+            self.stamps.append(stamp)
+            self.offsets.append(offset)
+
+    def save(self):
+        """
+        Atomically replace the index file; skipped if the directory
+        is not writable.
+        """
+
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as index:
+                index.write(INDEX_HEADER.pack(self.inode, self.size))
+                index.write(b''.join(
+                    INDEX_ENTRY.pack(stamp, offset)
+                    for stamp, offset in zip(self.stamps, self.offsets)))
+            os.rename(tmp_path, self.index_path)
+        except (IOError, OSError):
+            pass
+
+    def update(self):
+        """
+        Bring the index up to date with the file.
+        """
+
+        self.load()
+        info = os.stat(self.path)
+        if info.st_ino != self.inode or info.st_size < self.size:
+            # Replaced or truncated: start over
+            self.inode = info.st_ino
+            self.size = 0
+            self.stamps = []
+            self.offsets = []
+        if info.st_size == self.size:
+            return
+
+        boundary = (self.offsets[-1] + self.block if self.offsets
+                    else 0)
+        offset = self.size
+        with open(self.path, 'rb') as data:
+            data.seek(offset)
+            for line in data:
+                if not line.endswith(b'\n'):
+                    # Index only complete lines
+                    break
+                if offset >= boundary:
+                    stamp = self.stamp(line)
+                    if stamp is not None:
+                        self.stamps.append(stamp)
+                        self.offsets.append(offset)
+                        boundary = offset + self.block
+                offset += len(line)
+        self.size = offset
+        self.save()
+
+    def seek(self, start):
+        """
+        Return the offset of a line at or before the first line
+        stamped start or later.
+        """
+
+        i = bisect.bisect_left(self.stamps, start) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+    def lines(self, start, end):
+        """
+        Yield (timestamp, line) for the lines stamped from start to
+        end; lines without a timestamp carry the previous one.
+        """
+
+        with open(self.path, 'rb') as data:
+            data.seek(self.seek(start))
+            stamp = None
+            for line in data:
+                stamp = self.stamp(line) or stamp
+                if stamp is None or stamp < start:
+                    continue
+                if stamp > end:
+                    break
+                yield stamp, line
+
+
+def csv_files(filename, start, end):
+    """
+    Return the sensors.csv history files that can hold rows between
+    start and end. Rotated files are named after the day of their rows.
+    """
+
+    first = time.strftime(DAY_FORMAT, time.localtime(start))
+    last = time.strftime(DAY_FORMAT, time.localtime(end))
+    files = []
+    for path in history(filename):
+        day = path[len(filename) + 1:]
+        if path == filename or first <= day <= last:
+            files.append(path)
+    return files
+
+
+def csv_rows(filename, start, end):
+    """
+    Yield (timestamp, [(sensor, value)], co2) for the sensors.csv rows
+    between start and end. Sensors are numbered by column.
+    """
+
+    for path in csv_files(filename, start, end):
+        index = SparseIndex(path)
+        index.update()
+        for stamp, line in index.lines(start, end):
+            fields = strip_unprintable(line.decode('utf-8', 'replace'))
+            fields = fields.strip().split(',')[1:]
+            co2 = None
+            if fields and fields[-1].endswith('ppm'):
+                try:
+                    co2 = int(fields.pop()[:-3])
+                except ValueError:
+                    pass
+            values = parse_fields(fields)
+            yield stamp, [(str(i + 1), value)
+                          for i, value in enumerate(values)], co2
+
+
+def store_rows(filename, start, end):
+    """
+    Yield rows as csv_rows() does from the binary record store, with
+    sensors named by their hexadecimal address.
+    """
+
+    import recordstore
+    reader = recordstore.RecordReader(filename)
+    try:
+        # Records are in time order; find the first one by bisection
+        low, high = 0, len(reader)
+        while low < high:
+            middle = (low + high) // 2
+            if recordstore.RECORD.unpack_from(
+                    reader.map, recordstore.HEADER.size +
+                    middle * recordstore.RECORD.size)[0] < start:
+                low = middle + 1
+            else:
+                high = middle
+
+        stamp = None
+        readings = []
+        co2 = None
+        for when, address, status, value in reader.records(low):
+            if when != stamp:
+                if stamp is not None:
+                    yield stamp, readings, co2
+                if when > end:
+                    return
+                stamp = when
+                readings = []
+                co2 = None
+            if status == recordstore.FAILED:
+                continue
+            if address == recordstore.CO2_ADDRESS:
+                co2 = int(value)
+            else:
+                readings.append(('%02x' % address,
+                                 value / recordstore.SCALE))
+        if stamp is not None:
+            yield stamp, readings, co2
+    finally:
+        reader.close()
+
+
+class Summary(object):
+    """
+    Count, min, mean and max of each sensor over the queried rows.
+    """
+
+    def __init__(self):
+        # Sensor name -> [count, min, max, total]
+        self.sensors = {}
+
+    def add(self, name, value):
+        stats = self.sensors.get(name)
+        if stats is None:
+            self.sensors[name] = [1, value, value, value]
+            return
+        stats[0] += 1
+        if value < stats[1]:
+            stats[1] = value
+        if value > stats[2]:
+            stats[2] = value
+        stats[3] += value
+
+    def items(self):
+        """
+        Return (sensor, count, min, mean, max) in sensor order, with
+        CO2 last.
+        """
+
+        names = sorted(self.sensors, key=lambda name: (
+            name == 'co2', len(name), name))
+        return [(name, stats[0], stats[1], stats[3] / stats[0], stats[2])
+                for name, stats in ((name, self.sensors[name])
+                                    for name in names)]
+
+
+def write_csv(rows, out):
+    """
+    Write rows in the sensors.csv layout followed by a blank line and
+    a per-sensor summary; returns the number of rows.
+    """
+
+    summary = Summary()
+    count = 0
+    for stamp, readings, co2 in rows:
+        fields = []
+        for name, value in readings:
+            summary.add(name, value)
+            fields.append(',' + repr(round(value, 4)))
+        if co2 is not None:
+            summary.add('co2', co2)
+            fields.append(',%dppm' % co2)
+        out.write(time.strftime(ROW_FORMAT, time.localtime(stamp)) +
+                  ''.join(fields) + '\n')
+        count += 1
+
+    out.write('\nsensor,count,min,mean,max\n')
+    for name, number, low, mean, high in summary.items():
+        out.write('%s,%d,%r,%.3f,%r\n' % (name, number, round(low, 4),
+                                         mean, round(high, 4)))
+    return count
+
+
+def write_json(rows, out):
+    """
+    Write one JSON object per row followed by a summary object;
+    returns the number of rows.
+    """
+
+    summary = Summary()
+    count = 0
+    for stamp, readings, co2 in rows:
+        for name, value in readings:
+            summary.add(name, value)
+        if co2 is not None:
+            summary.add('co2', co2)
+        out.write(json.dumps({
+            'time': time.strftime(ROW_FORMAT, time.localtime(stamp)),
+            'readings': dict((name, round(value, 4))
+                             for name, value in readings),
+            'co2': co2}) + '\n')
+        count += 1
+
+    out.write(json.dumps({'summary': dict(
+        (name, {'count': number, 'min': low, 'mean': round(mean, 3),
+                'max': high})
+        for name, number, low, mean, high in summary.items())}) + '\n')
+    return count
+
+
+def log_lines(filename, start, end, out, fmt='csv'):
+    """
+    Write the control.log lines between start and end, rotated logs
+    included, as text or, with fmt='json', as the JSON lines.
+    """
+
+    for path in logpipeline.history(filename):
+        if path == filename:
+            index = SparseIndex(filename, stamp=log_stamp)
+            index.update()
+            lines = index.lines(start, end)
+        elif os.path.getmtime(path) < start:
+            # Rotated logs keep the time of their last record
+            continue
+        else:
+            lines = rotated_lines(path, start, end)
+        for _, line in lines:
+            line = line.decode('utf-8', 'replace')
+            if fmt == 'json':
+                out.write(line)
+            else:
+                out.write(logpipeline.render(line) + '\n')
+
+
+def rotated_lines(path, start, end):
+    """
+    Yield (timestamp, line) for the lines of a compressed log stamped
+    from start to end.
+    """
+
+    stamp = None
+    with logpipeline.open_log(path) as data:
+        for line in data:
+            stamp = log_stamp(line) or stamp
+            if stamp is None or stamp < start:
+                continue
+            if stamp > end:
+                break
+            yield stamp, line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Print the sensor data recorded in a time range.')
+    parser.add_argument('start', help='local start time, i.e. '
+                                      '"2019-07-12 02:00"')
+    parser.add_argument('end', help='local end time (inclusive)')
+    parser.add_argument('--source', default='sensors.csv',
+                        help='sensors.csv, a binary store (.bin) or '
+                             'control.log (default: sensors.csv)')
+    parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+    args = parser.parse_args(argv)
+
+    start = parse_time(args.start)
+    end = parse_time(args.end)
+    if args.source.endswith('.log'):
+        log_lines(args.source, start, end, sys.stdout, args.format)
+        return
+    if args.source.endswith('.bin'):
+        rows = store_rows(args.source, start, end)
+    else:
+        rows = csv_rows(args.source, start, end)
+    if args.format == 'json':
+        write_json(rows, sys.stdout)
+    else:
+        write_csv(rows, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
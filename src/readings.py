@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# Parsing and aggregation of temperature readings
+
+import functools
+import string
+import time
+
+# Translation table deleting non-printable characters (NULL, etc)
+UNPRINTABLE = dict.fromkeys(i for i in range(256)
+                            if chr(i) not in string.printable)
+
+# Timestamp at the start of each sensors.csv row
+ROW_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+
+def strip_unprintable(text):
+    """
+    Remove non-printable characters from text in a single pass.
+    """
+
+    return text.translate(UNPRINTABLE)
+
+
+def parse_readings(text):
+    """
+    Parse comma-separated readings, i.e. the outdoor file, into a
+    list of floats. Non-printable characters are removed from fields
+    that do not parse and fields that are not numbers are skipped.
+    """
+
+    return parse_fields(text.split(','))
+
+
+def parse_fields(fields):
+    """
+    Parse already split reading fields as parse_readings() does.
+    """
+
+    values = []
+    for field in fields:
+        try:
+            values.append(float(field))
+        except ValueError:
+            # Retry once without the non-printable characters
+            try:
+                values.append(float(strip_unprintable(field)))
+            except ValueError:
+                continue
+    return values
+
+
+@functools.lru_cache(maxsize=64)
+def hour_start(prefix):
+    """
+    Seconds since the epoch at the start of the local hour given as
+    "YYYY/mm/dd HH"; rows share an hour so this is rarely computed.
+    """
+
+    fields = (int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]),
+              int(prefix[11:13]))
+    if not (1 <= fields[1] <= 12 and 1 <= fields[2] <= 31 and
+            0 <= fields[3] < 24):
+        raise ValueError('Bad timestamp %r' % prefix)
+    return time.mktime(fields + (0, 0, 0, 0, -1))
+
+
+def parse_stamp(text):
+    """
+    Convert a ROW_FORMAT timestamp to seconds since the epoch in
+    local time. Slicing the fixed-width fields avoids the cost of
+    time.strptime when loading long histories.
+    """
+
+    if (len(text) != 19 or text[4] != '/' or text[7] != '/' or
+            text[13] != ':' or text[16] != ':'):
+        raise ValueError('Bad timestamp %r' % text)
+    minute = int(text[14:16])
+    second = int(text[17:19])
+    if not (0 <= minute < 60 and 0 <= second <= 61):
+        raise ValueError('Bad timestamp %r' % text)
+    return hour_start(text[:13]) + minute * 60 + second
+
+
+def parse_row(line):
+    """
+    Parse one sensors.csv row into (timestamp, readings, co2).
+    The timestamp is seconds since the epoch in local time and co2
+    is None if the row has no "ppm" field. Returns None for blank
+    or malformed rows.
+    """
+
+    line = line.strip()
+    if not (line.isascii() and line.isprintable()):
+        line = strip_unprintable(line).strip()
+    fields = line.split(',')
+    try:
+        stamp = parse_stamp(fields[0])
+    except (ValueError, OverflowError):
+        return None
+
+    co2 = None
+    if fields[-1].endswith('ppm'):
+        try:
+            co2 = int(fields.pop()[:-3])
+        except ValueError:
+            pass
+    return stamp, parse_fields(fields[1:]), co2
+
+
+def robust_mean(values, trim=0.25, max_deviation=5.0):
+    """
+    Average readings from several sensors while rejecting outliers.
+    Values further than max_deviation degrees from the median are
+    discarded, then the remainder is averaged with `trim` of each
+    tail removed. Returns None if there are no values.
+    """
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    count = len(ordered)
+    median = (ordered[(count - 1) // 2] + ordered[count // 2]) / 2.0
+    if (abs(ordered[0] - median) <= max_deviation and
+            abs(ordered[-1] - median) <= max_deviation):
+        # Usually no reading is an outlier
+        kept = ordered
+    else:
+        kept = [v for v in ordered if abs(v - median) <= max_deviation]
+    if not kept:
+        # Readings disagree too much to single out the outliers
+        return median
+    cut = int(len(kept) * trim)
+    if cut:
+        kept = kept[cut:-cut]
+    return sum(kept) / len(kept)
+
+
+class OutdoorAggregator(object):
+    """
+    Combines the outdoor sensor readings into one value and keeps
+    the last good value, with the time it was computed, for cycles
+    in which no readings are available.
+    """
+
+    def __init__(self, initial=None, trim=0.25, max_deviation=5.0,
+                 clock=time.time):
+        self.trim = trim
+        self.max_deviation = max_deviation
+        self.clock = clock
+
+        # Last good outdoor value and when it was computed
+        self.value = initial
+        self.updated = None
+
+    def update(self, values):
+        """
+        Aggregate a new set of readings and return the outdoor value.
+        With no readings the previous value is returned unchanged.
+        """
+
+        outdoor = robust_mean(values, self.trim, self.max_deviation)
+        if outdoor is not None:
+            self.value = round(outdoor, 3)
+            self.updated = self.clock()
+        return self.value
+
+    def age(self):
+        """
+        Seconds since the last good value, or None if there is none.
+        """
+
+        if self.updated is None:
+            return None
+        return self.clock() - self.updated
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# Concurrent sensor read scheduling
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+
+
+class ReadTimeout(IOError):
+    """
+    Raised when a read does not finish before its deadline.
+    Subclasses IOError so the controllers treat it like any
+    other failed sensor read.
+    """
+    pass
+
+
+class ReadResult(object):
+    """
+    Outcome of a single scheduled read.
+    """
+
+    def __init__(self, value=None, error=None, elapsed=0.0):
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    def get(self):
+        """
+        Return the value read, or raise the error that occurred.
+        """
+
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class BusReader(object):
+    """
+    Runs the reads of one bus in a worker thread, one at a time, so
+    the caller can stop waiting for a single slow read. A read given
+    up on keeps the bus until it returns, and the next read waits for
+    it instead of running alongside it.
+    """
+
+    def __init__(self):
+        self.pool = None
+        # Read given up on that may still be running
+        self.pending = None
+
+    def busy(self):
+        """
+        Return True while a read given up on is still running.
+        """
+
+        return self.pending is not None and not self.pending.done()
+
+    def call(self, func, timeout, deadline):
+        """
+        Return func() run in the worker thread. Raises ReadTimeout if
+        it takes longer than timeout seconds, or if a read given up on
+        still holds the bus at deadline, a time.monotonic() value.
+        """
+
+        if self.pending is not None:
+            wait([self.pending], max(0.0, deadline - time.monotonic()))
+            if not self.pending.done():
+                raise ReadTimeout('Bus held by a read past its deadline')
+            self.pending = None
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=1)
+        future = self.pool.submit(func)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            self.pending = future
+            raise ReadTimeout('Read exceeded %.1f s' % timeout)
+
+
+class ReadScheduler(object):
+    """
+    Runs sensor reads concurrently across buses. Reads that share
+    a bus are serialized by a per-bus lock so a single I2C bus or
+    serial port is never driven by two threads at once.
+    """
+
+    def __init__(self, timeout=5.0, max_workers=4):
+        # Seconds each read may take, measured from the start of run()
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.locks = {}
+        self.locks_guard = threading.Lock()
+
+    def lock_for(self, bus_id):
+        """
+        Return the lock serializing access to the given bus.
+        """
+
+        with self.locks_guard:
+            if bus_id not in self.locks:
+                self.locks[bus_id] = threading.Lock()
+            return self.locks[bus_id]
+
+    def guarded(self, bus_id, func, deadline):
+        """
+        Run func while holding its bus lock and time the call.
+        """
+
+        lock = self.lock_for(bus_id)
+        if not lock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise ReadTimeout('Bus %s busy past read deadline' % bus_id)
+        try:
+            start = time.monotonic()
+            value = func()
+            return value, time.monotonic() - start
+        finally:
+            lock.release()
+
+    def run(self, jobs):
+        """
+        Run each (bus_id, func) job and return a list of ReadResult
+        in job order. A job that is still running at its deadline
+        is reported as a ReadTimeout and left to finish in the
+        background while holding its bus.
+        """
+
+        deadline = time.monotonic() + self.timeout
+        futures = [self.pool.submit(self.guarded, bus_id, func, deadline)
+                   for bus_id, func in jobs]
+
+        results = []
+        for future in futures:
+            try:
+                value, elapsed = future.result(
+                    timeout=max(0.0, deadline - time.monotonic()))
+                results.append(ReadResult(value, elapsed=elapsed))
+            except TimeoutError:
+                results.append(ReadResult(
+                    error=ReadTimeout('Read exceeded %.1f s' % self.timeout),
+                    elapsed=self.timeout))
+            except Exception as ex:
+                results.append(ReadResult(error=ex))
+        return results
+
+    def shutdown(self):
+        """
+        Stop accepting reads and release idle worker threads.
+        """
+
+        self.pool.shutdown(wait=False)
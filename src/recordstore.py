@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+
+# Append-only binary store for the sensor records
+#
+# Usage: python recordstore.py sensors.bin [--day YYYY-MM-DD] > sensors.csv
+# Converts the store back to the sensors.csv layout.
+#
+# The store is a 16 byte header followed by fixed-width 8 byte
+# records of (timestamp, address, status, value), one per sensor
+# reading and one for the CO2 reading of each row, so it can be
+# memory-mapped and read in place, i.e. as a NumPy array through
+# RecordReader.array(). Timestamps are whole seconds, as in
+# sensors.csv, and temperatures are stored in 1/128 degrees, which
+# holds MCP9808 and DS18B20 readings exactly. Failed sensor readings
+# are not stored. A separate index file holds the number of the first
+# record of each day.
+
+import argparse
+import mmap
+import os
+import shutil
+import struct
+import sys
+import time
+
+from recordwriter import DAY_FORMAT, FSYNC_POLICIES, ROW_FORMAT
+# Record status of a reading, as reported by the sensor
+from sensorhealth import FAILED, OK
+
+# File magic, format version and record size
+HEADER = struct.Struct('<8sII')
+MAGIC = b'TENTREC\x00'
+VERSION = 2
+
+# Seconds since the epoch, sensor address, status, value
+RECORD = struct.Struct('<IBBh')
+
+# Stored temperatures are in 1/SCALE degrees, CO2 readings in ppm
+SCALE = 128
+# Stored values are clamped to the range of a record's value
+VALUE_MIN, VALUE_MAX = -0x8000, 0x7fff
+
+# Day as YYYY-MM-DD and the number of its first record
+INDEX_ENTRY = struct.Struct('<10s6xQ')
+
+# Address under which CO2 readings (in ppm) are stored; I2C
+# addresses are at most 0x77
+CO2_ADDRESS = 0xff
+
+
+# NumPy layout of a record, for reading the store without copying
+DTYPE_FIELDS = [('timestamp', '<u4'), ('address', 'u1'),
+                ('status', 'u1'), ('value', '<i2')]
+
+
+def clamp(value):
+    """
+    Round a scaled value to the nearest one a record can hold.
+    """
+
+    return min(max(int(round(value)), VALUE_MIN), VALUE_MAX)
+
+
+def record_day(stamp):
+    """
+    Local day of a timestamp, as used for the sensors.csv rotation.
+    """
+
+    return time.strftime(DAY_FORMAT, time.localtime(stamp))
+
+
+def day_bounds(stamp):
+    """
+    Return the local day of a timestamp with the timestamps at which
+    that day starts and the next one begins.
+    """
+
+    when = time.localtime(stamp)
+    start = time.mktime(when[:3] + (0, 0, 0, 0, 0, -1))
+    end = time.mktime(when[:2] + (when[2] + 1, 0, 0, 0, 0, 0, -1))
+    return time.strftime(DAY_FORMAT, when), start, end
+
+
+def read_index(filename):
+    """
+    Return the (day, first record) entries of a store's index.
+    """
+
+    entries = []
+    try:
+        with open(filename + '.idx', 'rb') as index:
+            data = index.read()
+    except IOError:
+        return entries
+    # Ignore a partly written last entry
+    data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+    for day, first in INDEX_ENTRY.iter_unpack(data):
+        entries.append((day.decode('ascii'), first))
+    return entries
+
+
+class RecordStore(object):
+    """
+    Appends sensor readings to the binary store in batches, with the
+    same flush and fsync policies as the sensors.csv RecordWriter.
+    Records written by a run that was cut short are truncated to
+    whole records and the day index is completed on open.
+    """
+
+    def __init__(self, filename='sensors.bin', flush_rows=5,
+                 flush_interval=300, fsync='flush', clock=time.time):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync must be one of %s' % (FSYNC_POLICIES,))
+
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.clock = clock
+
+        # Packed records waiting to be written, in rows
+        self.pending = bytearray()
+        self.pending_rows = 0
+        self.last_flush = clock()
+
+        # Day index entries waiting to be written
+        self.pending_index = []
+
+        self.file = None
+        self.index = None
+        # Records in the file, and the day of the last one with the
+        # timestamps it spans
+        self.count = 0
+        self.day = None
+        self.day_start = self.day_end = None
+
+        # Counters for benchmarking write amplification
+        self.rows = 0
+        self.writes = 0
+        self.fsyncs = 0
+        self.bytes = 0
+
+    def open(self):
+        """
+        Open the store for appending, creating it if needed.
+        """
+
+        exists = os.path.exists(self.filename)
+        self.file = open(self.filename, 'r+b' if exists else 'w+b')
+        if exists and os.path.getsize(self.filename) >= HEADER.size:
+            magic, version, size = HEADER.unpack(
+                self.file.read(HEADER.size))
+            if magic != MAGIC or size != RECORD.size:
+                self.file.close()
+                self.file = None
+                if magic != MAGIC:
+                    raise IOError('%s is not a record store' %
+                                  self.filename)
+                # Keep a store of an earlier version aside, with its
+                # index, and start a new one
+                for suffix in ('', '.idx'):
+                    if os.path.exists(self.filename + suffix):
+                        os.rename(self.filename + suffix, '%s.v%d%s' % (
+                            self.filename, version, suffix))
+                return self.open()
+        else:
+            self.file.truncate(0)
+            self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+
+        # Drop a partly written last record
+        self.count = (self.file.seek(0, os.SEEK_END) -
+                      HEADER.size) // RECORD.size
+        self.file.truncate(HEADER.size + self.count * RECORD.size)
+
+        # Drop index entries past the last record, or partly written
+        entries = [entry for entry in read_index(self.filename)
+                   if entry[1] < self.count]
+        self.index = open(self.filename + '.idx', 'ab')
+        self.index.truncate(len(entries) * INDEX_ENTRY.size)
+
+        # Index any days written after the last index entry
+        self.day = entries[-1][0] if entries else None
+        first = entries[-1][1] if entries else 0
+        self.file.seek(HEADER.size + first * RECORD.size)
+        number = first
+        for record in RECORD.iter_unpack(self.file.read()):
+            day = record_day(record[0])
+            if day != self.day:
+                self.pending_index.append((day, number))
+                self.day = day
+            number += 1
+        self.file.seek(0, os.SEEK_END)
+        self.write_index()
+
+    def write_row(self, stamp, readings, co2=None):
+        """
+        Queue the readings of one cycle taken at `stamp`, in seconds
+        since the epoch. readings holds sensor.Reading tuples and co2
+        is the CO2 reading in ppm or None if it failed.
+        """
+
+        if self.file is None:
+            self.open()
+
+        if self.day_start is None or not (
+                self.day_start <= stamp < self.day_end):
+            day, self.day_start, self.day_end = day_bounds(stamp)
+            if day != self.day:
+                self.pending_index.append(
+                    (day, self.count + len(self.pending) // RECORD.size))
+                self.day = day
+
+        try:
+            self.pending += self.pack_row(int(stamp), readings, co2)
+        except struct.error:
+            # A value is out of range; clamp every value of the row
+            self.pending += self.pack_row(int(stamp), readings, co2, clamp)
+        self.pending_rows += 1
+        self.rows += 1
+
+        if (self.fsync == 'always' or
+           self.pending_rows >= self.flush_rows or
+           self.clock() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    @staticmethod
+    def pack_row(stamp, readings, co2, convert=round):
+        """
+        Return the records of one row. Failed readings are left out,
+        but the CO2 record is always there so a row without readings
+        is still recorded.
+        """
+
+        row = bytearray()
+        for reading in readings:
+            if reading.value is not None:
+                row += RECORD.pack(stamp, reading.address, reading.status,
+                                   convert(reading.value * SCALE))
+        if co2 is None:
+            row += RECORD.pack(stamp, CO2_ADDRESS, FAILED, 0)
+        else:
+            row += RECORD.pack(stamp, CO2_ADDRESS, OK, convert(co2))
+        return row
+
+    def flush(self):
+        """
+        Write all pending records in one call, then the index entries
+        for any days they start, and apply the fsync policy.
+        """
+
+        self.last_flush = self.clock()
+        if not self.pending or self.file is None:
+            return
+
+        data = bytes(self.pending)
+        del self.pending[:]
+        self.pending_rows = 0
+        self.file.write(data)
+        self.file.flush()
+        self.count += len(data) // RECORD.size
+        self.writes += 1
+        self.bytes += len(data)
+
+        if self.fsync != 'never':
+            os.fsync(self.file.fileno())
+            self.fsyncs += 1
+
+        # Index entries only ever point at records on disk
+        self.write_index()
+
+    def write_index(self):
+        if not self.pending_index:
+            return
+        self.index.write(b''.join(
+            INDEX_ENTRY.pack(day.encode('ascii'), first)
+            for day, first in self.pending_index))
+        self.index.flush()
+        del self.pending_index[:]
+        if self.fsync != 'never':
+            os.fsync(self.index.fileno())
+
+    def close(self):
+        """
+        Flush pending records and close the store.
+        """
+
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.index.close()
+            self.file = None
+            self.index = None
+
+
+def drop_days(filename, before):
+    """
+    Drop the records of the days before `before`, a YYYY-MM-DD day,
+    by rewriting the store and its index without them, and return
+    the number of records dropped. The store must not be open for
+    writing.
+    """
+
+    if not os.path.exists(filename):
+        return 0
+    # Complete the index of a store cut short first
+    store = RecordStore(filename, fsync='never')
+    store.open()
+    count = store.count
+    store.close()
+
+    entries = read_index(filename)
+    kept = [(day, number) for day, number in entries if day >= before]
+    first = kept[0][1] if kept else count
+    if first == 0:
+        return 0
+
+    tmp_file = filename + '.tmp'
+    with open(filename, 'rb') as old, open(tmp_file, 'wb') as new:
+        new.write(old.read(HEADER.size))
+        old.seek(HEADER.size + first * RECORD.size)
+        shutil.copyfileobj(old, new)
+        new.flush()
+        os.fsync(new.fileno())
+    # A store without an index is indexed again when it is opened, so
+    # the store stays consistent if this is cut short
+    os.remove(filename + '.idx')
+    os.rename(tmp_file, filename)
+    with open(tmp_file, 'wb') as index:
+        index.write(b''.join(
+            INDEX_ENTRY.pack(day.encode('ascii'), number - first)
+            for day, number in kept))
+        index.flush()
+        os.fsync(index.fileno())
+    os.rename(tmp_file, filename + '.idx')
+    return first
+
+
+class RecordReader(object):
+    """
+    Read-only view of a record store through a memory map, so
+    records are unpacked in place rather than read into memory.
+    """
+
+    def __init__(self, filename='sensors.bin'):
+        self.filename = filename
+        with open(filename, 'rb') as store:
+            self.map = mmap.mmap(store.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size = HEADER.unpack_from(self.map)
+        if magic != MAGIC or size != RECORD.size:
+            self.map.close()
+            raise IOError('%s is not a record store' % filename)
+        self.count = (len(self.map) - HEADER.size) // RECORD.size
+        self.index = [entry for entry in read_index(filename)
+                      if entry[1] < self.count]
+
+    def __len__(self):
+        return self.count
+
+    def days(self):
+        """
+        Return the days held in the store, oldest first.
+        """
+
+        return [day for day, _ in self.index]
+
+    def day_range(self, day):
+        """
+        Return the (start, stop) record numbers of a YYYY-MM-DD day.
+        """
+
+        for i, (entry, first) in enumerate(self.index):
+            if entry == day:
+                stop = (self.index[i + 1][1] if i + 1 < len(self.index)
+                        else self.count)
+                return first, stop
+        return 0, 0
+
+    def records(self, start=0, stop=None):
+        """
+        Iterate over (timestamp, address, status, value) records, with
+        values as stored: temperatures in 1/SCALE degrees and CO2
+        readings in ppm.
+        """
+
+        stop = self.count if stop is None else min(stop, self.count)
+        if start >= stop:
+            return iter(())
+        view = memoryview(self.map)[HEADER.size + start * RECORD.size:
+                                    HEADER.size + stop * RECORD.size]
+        return RECORD.iter_unpack(view)
+
+    def array(self):
+        """
+        Return the records as a NumPy structured array backed by the
+        memory map, with values as stored, i.e. temperatures in
+        1/SCALE degrees; requires numpy.
+        """
+
+        import numpy
+        return numpy.frombuffer(self.map, dtype=numpy.dtype(DTYPE_FIELDS),
+                                count=self.count, offset=HEADER.size)
+
+    def close(self):
+        self.map.close()
+
+
+def format_value(value):
+    # MCP9808 readings are multiples of 1/16 and convert back exactly;
+    # calibrated readings are within 1/256 degree.
+    return repr(round(value, 4))
+
+
+def export_csv(reader, out, start=0, stop=None):
+    """
+    Write records in the sensors.csv layout, one row per timestamp
+    with the readings that did not fail followed by the CO2 value in
+    ppm.
+    Records are streamed; only one row is held at a time.
+    """
+
+    stamp = None
+    fields = []
+    co2 = ''
+    for when, address, status, value in reader.records(start, stop):
+        if when != stamp:
+            if stamp is not None:
+                out.write(time.strftime(ROW_FORMAT, time.localtime(stamp)) +
+                          ''.join(fields) + co2 + '\n')
+            stamp = when
+            del fields[:]
+            co2 = ''
+        if status == FAILED:
+            continue
+        if address == CO2_ADDRESS:
+            co2 = ',%dppm' % value
+        else:
+            fields.append(',' + format_value(value / SCALE))
+    if stamp is not None:
+        out.write(time.strftime(ROW_FORMAT, time.localtime(stamp)) +
+                  ''.join(fields) + co2 + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert a binary record store to the sensors.csv '
+                    'layout.')
+    parser.add_argument('store', help='record store, i.e. sensors.bin')
+    parser.add_argument('--day', help='only export this YYYY-MM-DD day')
+    args = parser.parse_args(argv)
+
+    reader = RecordReader(args.store)
+    try:
+        start, stop = 0, None
+        if args.day:
+            start, stop = reader.day_range(args.day)
+        export_csv(reader, sys.stdout, start, stop)
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# Buffered writer for the sensors.csv records
+
+import codecs
+import glob
+import os
+import time
+
+# Timestamp written at the start of each row
+ROW_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+# Suffix of rotated files, i.e. sensors.csv.2019-07-12
+DAY_FORMAT = "%Y-%m-%d"
+
+# When to fsync the file: never, after each batch flush, or every row
+FSYNC_POLICIES = ('never', 'flush', 'always')
+
+
+class RecordWriter(object):
+    """
+    Keeps the sensor records file open and writes rows in batches.
+    Each row is built in a single buffer; batches are flushed once
+    flush_rows rows are pending or flush_interval seconds have
+    passed since the last flush. The file is rotated at the first
+    row of each new day.
+    """
+
+    def __init__(self, filename='sensors.csv', flush_rows=5,
+                 flush_interval=300, fsync='flush', clock=time.time):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync must be one of %s' % (FSYNC_POLICIES,))
+
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.clock = clock
+
+        # Rows waiting to be written
+        self.pending = []
+        self.last_flush = clock()
+
+        # Open file and the day its rows belong to
+        self.file = None
+        self.day = None
+
+        # Counters for benchmarking write amplification
+        self.rows = 0
+        self.writes = 0
+        self.fsyncs = 0
+        self.bytes = 0
+
+    def write_row(self, when, *fields):
+        """
+        Queue one row made of the timestamp `when` (a struct_time)
+        followed by the already comma-prefixed fields.
+        """
+
+        day = time.strftime(DAY_FORMAT, when)
+        if day != self.day:
+            self.rotate(day)
+
+        self.pending.append(time.strftime(ROW_FORMAT, when) +
+                            ''.join(fields) + '\n')
+        self.rows += 1
+
+        if (self.fsync == 'always' or
+           len(self.pending) >= self.flush_rows or
+           self.clock() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write all pending rows in one call and apply the fsync policy.
+        """
+
+        self.last_flush = self.clock()
+        if not self.pending or self.file is None:
+            return
+
+        data = ''.join(self.pending)
+        del self.pending[:]
+        self.file.write(data)
+        self.file.flush()
+        self.writes += 1
+        self.bytes += len(data)
+
+        if self.fsync != 'never':
+            os.fsync(self.file.fileno())
+            self.fsyncs += 1
+
+    def rotate(self, day):
+        """
+        Flush and close the current file, move it aside if it holds
+        an earlier day's rows, and open a fresh file for `day`.
+        """
+
+        file_day = self.day
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        if os.path.exists(self.filename):
+            if file_day is None:
+                # File left from a previous run: use its last write
+                file_day = time.strftime(DAY_FORMAT, time.localtime(
+                    os.path.getmtime(self.filename)))
+            if file_day != day:
+                os.rename(self.filename, self.filename + '.' + file_day)
+
+        self.file = codecs.open(self.filename, 'a', 'utf-8')
+        self.day = day
+
+    def close(self):
+        """
+        Flush pending rows and close the file.
+        """
+
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.day = None
+
+
+def history(filename='sensors.csv'):
+    """
+    Return the record files for filename in time order: the rotated
+    daily files followed by the file currently being written.
+    """
+
+    files = sorted(glob.glob(glob.escape(filename) + '.????-??-??'))
+    if os.path.exists(filename):
+        files.append(filename)
+    return files
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# Replays recorded sensor histories through the heat tent control logic
+#
+# Usage: python replay.py HEAT_CSV CONTROL_CSV [--diff 4 --diff 5 ...]
+#
+# HEAT_CSV and CONTROL_CSV are the sensors.csv files of a heat tent and
+# of the control tent; their rotated sensors.csv.YYYY-MM-DD files are
+# read as well. Each heater decision that changes the heater state is
+# written as one "timestamp,diff,state" line. The control strategy is
+# the controller's threshold unless --strategy names another one.
+
+import argparse
+from array import array
+import sys
+import time
+
+from readings import parse_row, robust_mean, ROW_FORMAT
+from recordwriter import history
+from strategy import SENSOR_FAULT, STRATEGIES, Threshold
+
+# Marks a row without readings in the loaded histories
+MISSING = float('nan')
+
+
+def load(filename, combine):
+    """
+    Load the rows of a sensors.csv history, oldest first, into arrays
+    of timestamps and of the readings combined by combine(); rows
+    without readings get MISSING.
+    """
+
+    stamps = array('d')
+    values = array('d')
+    for path in history(filename):
+        with open(path) as records:
+            for line in records:
+                row = parse_row(line)
+                if row is None:
+                    continue
+                stamp, readings, _ = row
+                value = combine(readings) if readings else None
+                stamps.append(stamp)
+                values.append(MISSING if value is None else value)
+    return stamps, values
+
+
+def indoor_mean(readings):
+    """
+    Indoor temperature as the heat tent computes it.
+    """
+
+    return sum(readings) / len(readings)
+
+
+def align(heat, control, max_age=300):
+    """
+    Pair each heat tent row with the outdoor temperature the heat
+    tent would have had at that moment: the latest control tent
+    reading no older than max_age, or else the last good value.
+    Returns arrays of timestamps, indoor and outdoor temperatures.
+    """
+
+    heat_stamps, heat_values = heat
+    control_stamps, control_values = control
+
+    indoor = array('d')
+    outdoor = array('d')
+    # Last good outdoor value, as kept by OutdoorAggregator
+    previous = 0.0
+    latest = -1
+    count = len(control_stamps)
+    for stamp, value in zip(heat_stamps, heat_values):
+        while latest + 1 < count and control_stamps[latest + 1] <= stamp:
+            latest += 1
+        if latest >= 0 and stamp - control_stamps[latest] <= max_age:
+            reading = control_values[latest]
+            if reading == reading:
+                previous = round(reading, 3)
+
+        # A heat tent with no readings averages to zero
+        value = 0.0 if value != value else round(value, 3)
+        if value == 0 and previous == 0:
+            # Both sensors disconnected; the controller reports a fault
+            value = SENSOR_FAULT
+            outdoor.append(SENSOR_FAULT)
+        else:
+            outdoor.append(previous)
+        indoor.append(value)
+    return heat_stamps, indoor, outdoor
+
+
+def replay(stamps, indoor, outdoor, temperature_diff, emit=None,
+           strategy=None):
+    """
+    Run the heater decision of a strategy.Strategy, Threshold by
+    default, for every cycle and call emit(timestamp, state) whenever
+    the heater state changes. Returns the number of cycles spent in
+    each heater state.
+    """
+
+    strategy = strategy or Threshold()
+    cycles = {"OFF": 0, "FAN": 0, "ST1": 0, "ST2": 0, "SENSOR": 0}
+    # The controller pulls the relays low at startup
+    heater = "OFF"
+    for stamp, inside, outside in zip(stamps, indoor, outdoor):
+        state = strategy.step(stamp, inside, outside, temperature_diff)
+        if state is None:
+            state = "SENSOR"
+        if state != heater:
+            heater = state
+            if emit is not None:
+                emit(stamp, state)
+        cycles[heater] += 1
+    return cycles
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay recorded sensor histories through the heat '
+                    'tent control logic.')
+    parser.add_argument('heat', help="heat tent's sensors.csv")
+    parser.add_argument('control', help="control tent's sensors.csv")
+    parser.add_argument('--diff', type=float, action='append',
+                        help='temperature differential to replay; may be '
+                             'repeated (default: 4)')
+    parser.add_argument('--max-age', type=float, default=300,
+                        help='seconds after which outdoor readings are '
+                             'stale (default: 300)')
+    parser.add_argument('--strategy', choices=sorted(STRATEGIES),
+                        default='threshold',
+                        help='control strategy, with default settings '
+                             '(default: threshold)')
+    parser.add_argument('--events', default='-',
+                        help='file for the heater events (default: stdout)')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    stamps, indoor, outdoor = align(load(args.heat, indoor_mean),
+                                    load(args.control, robust_mean),
+                                    args.max_age)
+    loaded = time.perf_counter() - start
+
+    out = sys.stdout if args.events == '-' else open(args.events, 'w')
+    try:
+        for diff in args.diff or [4]:
+            def emit(stamp, state):
+                out.write('%s,%g,%s\n' % (
+                    time.strftime(ROW_FORMAT, time.localtime(stamp)),
+                    diff, state))
+
+            start = time.perf_counter()
+            cycles = replay(stamps, indoor, outdoor, diff, emit,
+                            STRATEGIES[args.strategy]())
+            elapsed = time.perf_counter() - start
+            sys.stderr.write(
+                'diff %g: %d cycles in %.2f s, OFF %d, FAN %d, ST1 %d, '
+                'ST2 %d, SENSOR %d\n' %
+                (diff, len(stamps), elapsed, cycles["OFF"], cycles["FAN"],
+                 cycles["ST1"], cycles["ST2"], cycles["SENSOR"]))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write('loaded %d rows in %.2f s\n' % (len(stamps), loaded))
+
+
+if __name__ == '__main__':
+    main()
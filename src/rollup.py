@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+# Downsampled rollups of the sensor readings for long-term retention
+#
+# Each cycle's readings are folded into running statistics for the
+# current 5-minute, hourly and daily bucket. When a bucket ends, one
+# "start,sensor,count,mean,min,max,std" line per sensor is appended to
+# rollup-5min.csv, rollup-hourly.csv or rollup-daily.csv. Buckets are
+# aligned to local time. The open buckets are written when the
+# controller stops, and a bucket still open when it starts again is
+# read back and continued, so a restart does not lose the day.
+
+import glob
+import math
+import os
+import time
+
+from recordwriter import DAY_FORMAT, ROW_FORMAT
+from sensorhealth import OK
+
+# Name and length in seconds of each rollup resolution
+RESOLUTIONS = (('5min', 300), ('hourly', 3600), ('daily', 86400))
+
+# Header of the rollup files
+HEADER = 'start,sensor,count,mean,min,max,std\n'
+
+# Bytes at the end of a rollup file searched for an unfinished bucket
+RESUME_BYTES = 65536
+
+
+def bucket_start(stamp, period):
+    """
+    Start of the local-time bucket of `period` seconds holding stamp.
+    Daily buckets start at local midnight, including across DST changes.
+    """
+
+    when = time.localtime(stamp)
+    if period >= 86400:
+        return time.mktime(when[:3] + (0, 0, 0, 0, 0, -1))
+    return stamp - (stamp + when.tm_gmtoff) % period
+
+
+class RunningStats(object):
+    """
+    Count, mean, min, max and standard deviation of a stream of values
+    in constant memory, using Welford's online algorithm.
+    """
+
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def std(self):
+        """
+        Population standard deviation of the values seen.
+        """
+
+        return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+
+class Rollup(object):
+    """
+    Running statistics of every sensor over the current bucket of one
+    resolution, written out when a reading falls in a later bucket.
+    """
+
+    def __init__(self, name, period, path):
+        self.name = name
+        self.period = period
+        self.path = path
+
+        # Start and end of the current bucket
+        self.start = None
+        self.end = None
+        # Sensor name -> RunningStats for the current bucket
+        self.stats = {}
+
+        # Buckets written, for benchmarking
+        self.buckets = 0
+
+    def add(self, stamp, readings):
+        """
+        Fold (sensor, value) readings taken at stamp into the bucket.
+        """
+
+        if self.start is None or not self.start <= stamp < self.end:
+            starting = self.start is None
+            self.write()
+            self.start = bucket_start(stamp, self.period)
+            # Next bucket of the same resolution, i.e. next midnight
+            self.end = bucket_start(self.start + self.period * 1.5,
+                                    self.period)
+            if starting:
+                self.resume()
+        for name, value in readings:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = RunningStats()
+            stats.add(value)
+
+    def resume(self):
+        """
+        Continue the current bucket if the end of the rollup file holds
+        it, as written when the controller last stopped: its lines are
+        read back into the running statistics and removed from the file.
+        """
+
+        if not os.path.exists(self.path):
+            return
+        start = time.strftime(ROW_FORMAT, time.localtime(self.start))
+        with open(self.path, 'r+b') as rollup:
+            # The last bucket is at most a line per sensor
+            offset = max(0, rollup.seek(0, os.SEEK_END) - RESUME_BYTES)
+            rollup.seek(offset)
+            tail = rollup.read()
+            cut = None
+            for line in tail.splitlines(True):
+                if line.startswith(start.encode('ascii') + b','):
+                    if cut is None:
+                        cut = offset
+                    self.load(line.decode('ascii'))
+                elif cut is not None:
+                    # Not the last bucket after all
+                    self.stats = {}
+                    cut = None
+                offset += len(line)
+            if cut is not None:
+                rollup.truncate(cut)
+
+    def load(self, line):
+        """
+        Restore the running statistics of one sensor from a rollup line.
+        """
+
+        _, name, count, mean, low, high, std = line.strip().split(',')
+        stats = self.stats[name] = RunningStats()
+        stats.count = int(count)
+        stats.mean = float(mean)
+        stats.m2 = float(std) ** 2 * stats.count
+        stats.min = float(low)
+        stats.max = float(high)
+
+    def write(self):
+        """
+        Append the statistics of the finished bucket to the rollup file.
+        """
+
+        if not self.stats:
+            return
+        start = time.strftime(ROW_FORMAT, time.localtime(self.start))
+        lines = ['%s,%s,%d,%.4f,%r,%r,%.4f\n' % (
+            start, name, stats.count, stats.mean, stats.min, stats.max,
+            stats.std())
+            for name, stats in sorted(self.stats.items())]
+        new = not os.path.exists(self.path)
+        with open(self.path, 'a') as out:
+            if new:
+                out.write(HEADER)
+            out.write(''.join(lines))
+        self.stats = {}
+        self.buckets += 1
+
+
+def prune(filename='sensors.csv', retention_days=90, now=None):
+    """
+    Delete rotated raw files, i.e. sensors.csv.2019-07-12, and their
+    query indexes, once they are older than retention_days. Returns
+    the deleted files.
+    """
+
+    cutoff = retention_cutoff(retention_days, now)
+    deleted = []
+    for path in sorted(glob.glob(glob.escape(filename) + '.????-??-??')):
+        if path[len(filename) + 1:] >= cutoff:
+            break
+        for old in (path, path + '.idx'):
+            if os.path.exists(old):
+                os.remove(old)
+                deleted.append(old)
+    return deleted
+
+
+def retention_cutoff(retention_days, now=None):
+    """
+    First day, as YYYY-MM-DD, kept by a retention of retention_days.
+    """
+
+    now = time.time() if now is None else now
+    return time.strftime(DAY_FORMAT,
+                         time.localtime(now - retention_days * 86400))
+
+
+class Rollups(object):
+    """
+    Feeds each cycle's readings to the rollups of every resolution.
+    """
+
+    def __init__(self, prefix='rollup'):
+        self.rollups = [Rollup(name, period, '%s-%s.csv' % (prefix, name))
+                        for name, period in RESOLUTIONS]
+
+    def add(self, stamp, readings, co2=None):
+        """
+        Add one cycle: sensor.Reading tuples, of which only those of
+        healthy sensors are used, and the CO2 value in ppm or None.
+        """
+
+        values = [('%02x' % r.address, r.value) for r in readings
+                  if r.status == OK]
+        if co2 is not None:
+            values.append(('co2', co2))
+        for rollup in self.rollups:
+            rollup.add(stamp, values)
+
+    def close(self):
+        """
+        Write the open bucket of every resolution, to be continued by
+        the next run if it is still open then.
+        """
+
+        for rollup in self.rollups:
+            rollup.write()
+            rollup.start = rollup.end = None
@@ -1,10 +1,53 @@
 from abc import ABCMeta, abstractmethod
-import subprocess
-import Adafruit_MCP9808.MCP9808 as mcp9808
+import collections
+import time
+import bus
+from metrics import NullMetrics
+from readscheduler import BusReader
+from sensorhealth import OK, SensorHealth
 
 # Include other subclasses for types of sensors to the end of the file
 # This position is denoted by another comment
 
+# One sensor's reading: its address, the calibrated value (None if the
+# read failed), the seconds the read took and a sensorhealth status
+Reading = collections.namedtuple('Reading', 'address value latency status')
+
+
+def healthy_values(readings):
+    """
+    Return the values of the healthy sensors or, if every sensor that
+    answered is flagged, of all of them so a tent is not left without
+    a temperature.
+    """
+
+    values = [r.value for r in readings if r.status == OK]
+    if not values:
+        values = [r.value for r in readings if r.value is not None]
+    return values
+
+
+def average(readings):
+    """
+    Average the readings of healthy sensors, as chosen by
+    healthy_values(). Raises IOError if no sensor answered.
+    """
+
+    values = healthy_values(readings)
+    if not values:
+        raise IOError('No sensor could be read')
+    return sum(values) / len(values)
+
+
+def format_readings(readings):
+    """
+    Return the values that were read in sensors.csv format, i.e.
+    ",20.0625,20.125".
+    """
+
+    return ''.join("," + repr(r.value) for r in readings
+                   if r.value is not None)
+
 
 class Sensor(object):
     """
@@ -13,6 +56,13 @@ class Sensor(object):
 
     __metaclass__ = ABCMeta
 
+    # Identifies the bus a sensor type reads over; reads that
+    # share a bus are never run concurrently.
+    bus_id = None
+
+    # Replaced by the controller when metrics are enabled
+    metrics = NullMetrics()
+
     @abstractmethod
     def __repr__(self):
         pass
@@ -30,7 +80,23 @@ class Sensor(object):
         pass
 
     @abstractmethod
-    def read(self):
+    def read(self, timeout=None):
+        """
+        Return a Reading for each connected sensor, giving up on any
+        sensor that takes longer than timeout seconds to read.
+        """
+        pass
+
+    def addresses(self):
+        """
+        Return the addresses of the sensors detected, for a snapshot.
+        """
+        return []
+
+    def restore(self, addresses):
+        """
+        Use sensors detected before a restart until the next scan.
+        """
         pass
 
 
@@ -39,12 +105,36 @@ class MCP9808(Sensor):
      Subtype of Sensor class that implements MCP9808 sensor functionality.
     """
 
-    def __init__(self, reserved_addr):
+    def __init__(self, reserved_addr, i2c_bus=None, busnum=1,
+                 first_addr=bus.FIRST_ADDR, last_addr=bus.LAST_ADDR,
+                 rescan_interval=10, calibration=None, health=None):
         self.sensor_cnt = 0
         self.addr_list = []
+        self.sensor_addrs = []
         self.sensor_list = []
         self.changed_sensors = False
-        self.reserved = list(reserved_addr)
+        # Initialized sensor handles keyed by integer address
+        self.sensor_cache = {}
+        # Number of detect() calls between full bus scans
+        self.rescan_interval = rescan_interval
+        # Scan on the first detect() call
+        self.cycles_since_scan = rescan_interval
+        # Set when a read fails so the next detect() rescans
+        self.rescan_needed = True
+        # Reserved hexadecimal strings, i.e. "68", as integer addresses
+        self.reserved = set(int(addr, 16) for addr in reserved_addr)
+        # Bus backend used for probing; opened on first detect()
+        self.bus = i2c_bus
+        self.busnum = busnum
+        self.bus_id = 'i2c-%d' % busnum
+        self.first_addr = first_addr
+        self.last_addr = last_addr
+        # Offset added to each sensor's readings, keyed by address
+        self.calibration = calibration or {}
+        # Flags stuck, noisy and slow sensors
+        self.health = health or SensorHealth()
+        # Reads the sensors one at a time when they have a deadline
+        self.reader = BusReader()
 
     def __repr__(self):
         return "MCP9808"
@@ -65,89 +155,142 @@ class MCP9808(Sensor):
         is a sensor object; thus, ensure that the class
         list reserved has addresses that are used
         by i2c devices other than the MCP9808s.
+        Only sensors that appeared since the previous scan
+        are initialized; handles for vanished sensors are dropped.
         """
 
-        # Command to detect the I2C bus connetions
-        op = ("sudo i2cdetect -y 1 "
-              "| sed 's/--//g' | tail -n +2 | "
-              "sed 's/^.0://g' | sed 's/UU//g'")
-
-        # Poll the number of sensors via text manipulation from the I2C bus.
-        # raw_sensors = subprocess.check_output(op, shell=True)
-        process = subprocess.Popen(op, stdout=subprocess.PIPE, shell=True)
-        raw_sensors, _ = process.communicate()
-
-        # Close the process/file
-        # In this case, we ignore if it's already terminated/closed.
-        try:
-            process.terminate()
-        except OSError:
-            pass
-
-        # Hexcode of an individual sensor
-        sensor_name = ''
-        temp_addr_list = []
-
-        # Create the sensor objects.
-        maxim = len(raw_sensors)
-        for i in range(0, maxim):
-            if raw_sensors[i] != ' ' and raw_sensors[i] != '\n':
-                sensor_name += raw_sensors[i]
-                if len(sensor_name) == 2 and sensor_name not in self.reserved:
-                    # Hexadecimal addresses are two digits long
-                    temp_addr_list.append(sensor_name)
-                    sensor_name = ''
-
-        # If a different number of sensors has been detected, update
-        if (len(temp_addr_list) != len(self.addr_list)):
-            for address in self.addr_list:
-                del address
-            for sensor in self.sensor_list:
-                try:
-                    del sensor
-                except IndexError:
-                    break
-            del self.addr_list
-            self.addr_list = list(temp_addr_list)
-            self.changed_sensors = True
-
-        self.sensor_cnt = len(self.addr_list)
-        # Begin communication with each sensor
-        # and add it to the list.
-        i = 0
-        for addr in self.addr_list:
-            if self.changed_sensors:
-                self.sensor_list.append(mcp9808.MCP9808((int(addr, 16))))
-                try:
-                    self.sensor_list[i].begin()
-                except:
-                    self.sensor_list.remove(self.sensor_list[i])
-                    self.sensor_cnt -= 1
-                    continue  # don't increment i
-                i += 1
+        # Only scan every rescan_interval cycles unless a read failed.
+        self.cycles_since_scan += 1
+        if (self.cycles_since_scan < self.rescan_interval and
+           not self.rescan_needed):
+            return
+        # A read given up on still holds the bus; scan once it is free
+        if self.reader.busy():
+            self.rescan_needed = True
+            return
+        self.cycles_since_scan = 0
+        self.rescan_needed = False
 
-        self.changed_sensors = False
+        if self.bus is None:
+            self.bus = bus.SMBusBackend(self.busnum)
+
+        # Probe the I2C bus directly for responding devices.
+        found = bus.scan(self.bus, self.reserved,
+                         self.first_addr, self.last_addr)
+
+        # Evict handles for sensors that have vanished.
+        vanished = set(self.sensor_cache) - found
+        for addr in vanished:
+            del self.sensor_cache[addr]
+            self.health.forget(addr)
+
+        # Begin communication with newly appeared sensors only.
+        # A sensor that fails to begin is retried at the next scan.
+        appeared = found - set(self.sensor_cache)
+        for addr in sorted(appeared):
+            handle = self.open_sensor(addr)
+            try:
+                handle.begin()
+            except:
+                continue
+            self.sensor_cache[addr] = handle
+
+        self.changed_sensors = bool(vanished or appeared)
+        if self.changed_sensors:
+            # Hexcode of each sensor, as reported by i2cdetect
+            ordered = sorted(self.sensor_cache)
+            self.addr_list = ['%02x' % addr for addr in ordered]
+            self.sensor_addrs = ordered
+            self.sensor_list = [self.sensor_cache[addr] for addr in ordered]
+            self.sensor_cnt = len(self.sensor_list)
+
+    def addresses(self):
+        return list(self.sensor_addrs)
+
+    def restore(self, addresses):
+        """
+        Open the sensors at the given addresses, as detected before a
+        restart, so the first detect() skips the full bus scan. A
+        sensor that is gone fails its read, which triggers a rescan.
+        """
+
+        if self.sensor_cache:
+            return
+        missing = False
+        for addr in sorted(addresses):
+            if addr in self.reserved:
+                continue
+            handle = self.open_sensor(addr)
+            try:
+                handle.begin()
+            except:
+                missing = True
+                continue
+            self.sensor_cache[addr] = handle
+        if not self.sensor_cache:
+            return
+
+        ordered = sorted(self.sensor_cache)
+        self.addr_list = ['%02x' % addr for addr in ordered]
+        self.sensor_addrs = ordered
+        self.sensor_list = [self.sensor_cache[addr] for addr in ordered]
+        self.sensor_cnt = len(self.sensor_list)
+        self.changed_sensors = True
+        # Count this as a scan; one that failed to begin is looked
+        # for at the first detect()
+        self.cycles_since_scan = 0
+        self.rescan_needed = missing
+
+    def open_sensor(self, addr):
+        """
+        Create the driver handle for the sensor at the given address.
+        Simulated buses provide their own handles.
+        """
+
+        if hasattr(self.bus, 'open_sensor'):
+            return self.bus.open_sensor(addr)
+
+        # Imported here so the module can be used off-device.
+        import Adafruit_MCP9808.MCP9808 as mcp9808
+        return mcp9808.MCP9808(address=addr, busnum=self.busnum)
 
-    def read(self):
+    def read(self, timeout=None):
         """
-        Read sensor data and return the averaged value and each individual
-        reading in CSV format for logging purposes.
+        Read each sensor and return a Reading per address with its
+        calibrated value, read latency and health status.
         If a sensor goes offline between detection and read,
-        then it is skipped.
+        or takes longer than timeout seconds to answer, then its
+        reading is marked as failed and the other sensors are still
+        read. A sensor that is given up on holds the bus until its
+        read returns; the remaining reads wait for it for up to
+        timeout seconds per sensor in all.
         """
 
-        indoor = 0
-        sensor_readings = ""
-        bad_sensors = 0
+        if timeout is not None:
+            deadline = time.monotonic() + timeout * self.sensor_cnt
+        readings = []
         for i in range(0, self.sensor_cnt):
+            addr = self.sensor_addrs[i]
+            start = time.perf_counter()
             try:
-                temp = float(self.sensor_list[i].readTempC())
+                if timeout is None:
+                    temp = float(self.sensor_list[i].readTempC())
+                else:
+                    temp = float(self.reader.call(
+                        self.sensor_list[i].readTempC, timeout, deadline))
             except:
-                bad_sensors += 1
-                continue # don't add to sensor_readings or indoor
-            sensor_readings += ("," + repr(temp))
-            indoor += temp
-        indoor /= (self.sensor_cnt - bad_sensors)
-        return indoor, sensor_readings
+                temp = None
+                self.metrics.count('errors', stage='sensor_read',
+                                   address=self.addr_list[i])
+                # Look for a hot-plug change at the next detect()
+                self.rescan_needed = True
+            else:
+                temp += self.calibration.get(addr, 0.0)
+            latency = time.perf_counter() - start
+            self.metrics.observe('sensor_read', latency,
+                                 address=self.addr_list[i])
+            readings.append(Reading(addr, temp, latency,
+                                    self.health.update(addr, temp, latency)))
+        return readings
 
 # Add other implementations of sensor types here
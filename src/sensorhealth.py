@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Calibration offsets and health tracking for individual sensors
+
+import codecs
+import collections
+import logging
+
+# Status of a reading: valid, failed to read, or read from a sensor
+# that is excluded from the control average for being stuck, noisy
+# or slow. The binary record store keeps these values.
+OK = 0
+FAILED = 1
+STUCK = 2
+NOISY = 3
+SLOW = 4
+
+STATUS_NAMES = {OK: 'ok', FAILED: 'failed', STUCK: 'stuck',
+                NOISY: 'noisy', SLOW: 'slow'}
+
+
+def load_calibration(filename='calibration'):
+    """
+    Read per-sensor offsets, in degrees, from lines of a hexadecimal
+    address and an offset, i.e. "18 -0.125". Blank lines and lines
+    starting with # are ignored. Returns {address: offset}, empty if
+    the file does not exist.
+    """
+
+    offsets = {}
+    try:
+        with codecs.open(filename, 'r', 'utf-8') as table:
+            for line in table:
+                fields = line.split('#')[0].split()
+                if not fields:
+                    continue
+                if len(fields) != 2:
+                    raise ValueError('Bad calibration line %r' % line)
+                offsets[int(fields[0], 16)] = float(fields[1])
+    except IOError:
+        pass
+    return offsets
+
+
+class Track(object):
+    """
+    Recent history of one sensor.
+    """
+
+    __slots__ = ('last', 'repeats', 'steps', 'latencies', 'status')
+
+    def __init__(self, window):
+        self.last = None
+        # Consecutive readings equal to the last one
+        self.repeats = 0
+        # Absolute change between consecutive readings
+        self.steps = collections.deque(maxlen=window)
+        self.latencies = collections.deque(maxlen=window)
+        self.status = OK
+
+
+class SensorHealth(object):
+    """
+    Flags sensors whose recent readings are stuck on one value, jump
+    around more than a real tent temperature can, or take too long to
+    read. Only in-memory state is kept, in a fixed window per sensor.
+    """
+
+    def __init__(self, window=30, stuck_cycles=60, noise_limit=1.0,
+                 slow_limit=0.5, min_samples=10, logger=None):
+        self.window = window
+        # Identical readings in a row before a sensor counts as stuck
+        self.stuck_cycles = stuck_cycles
+        # Mean change between readings, in degrees, above which a
+        # sensor counts as noisy
+        self.noise_limit = noise_limit
+        # Median read latency, in seconds, above which a sensor
+        # counts as slow
+        self.slow_limit = slow_limit
+        # Readings needed before noise or slowness is judged
+        self.min_samples = min_samples
+        self.logger = logger or logging.getLogger("Controller")
+
+        self.tracks = {}
+
+    def update(self, address, value, latency):
+        """
+        Record a reading and return its status; value is None for a
+        failed read.
+        """
+
+        track = self.tracks.get(address)
+        if track is None:
+            track = self.tracks[address] = Track(self.window)
+        if value is None:
+            return FAILED
+
+        track.latencies.append(latency)
+        if track.last is not None:
+            track.steps.append(abs(value - track.last))
+        track.repeats = track.repeats + 1 if value == track.last else 1
+        track.last = value
+
+        status = OK
+        if track.repeats >= self.stuck_cycles:
+            status = STUCK
+        elif len(track.steps) >= self.min_samples:
+            if sum(track.steps) / len(track.steps) > self.noise_limit:
+                status = NOISY
+            elif (sorted(track.latencies)[len(track.latencies) // 2] >
+                  self.slow_limit):
+                status = SLOW
+
+        if status != track.status:
+            self.logger.info('Sensor %02x is now %s', address,
+                             STATUS_NAMES[status])
+            track.status = status
+        return status
+
+    def forget(self, address):
+        """
+        Drop the history of a sensor that was unplugged.
+        """
+
+        self.tracks.pop(address, None)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Builds controllers on simulated hardware for off-device runs
+
+import hardware
+from sensor import MCP9808
+
+# First address of the simulated MCP9808 sensors (A0-A2 low)
+FIRST_SENSOR = 0x18
+
+
+def build(role, reserved, sensors=8, start=None, seed=None, latency=0.0,
+          failure_rate=0.0, co2_failure_rate=0.0, **controller_args):
+    """
+    Return (controller, tent, hardware) for a 'heat' or 'control'
+    tent running on a virtual clock. The simulated I2C bus carries
+    `sensors` MCP9808 sensors plus a device at each reserved address;
+    latency and failure_rate apply to every sensor read.
+    """
+
+    clock = hardware.SimClock(start)
+    simulated = hardware.simulated(
+        clock, co2=hardware.SimCO2(failure_rate=co2_failure_rate, seed=seed))
+
+    if role == 'heat':
+        tent = hardware.SimTent(clock, gpio=simulated.gpio)
+    else:
+        # The control tent measures ambient air
+        tent = hardware.SimTent(clock, loss=1.0 / 300)
+
+    addresses = ([FIRST_SENSOR + i for i in range(sensors)] +
+                 [int(addr, 16) for addr in reserved])
+    i2c = hardware.SimBus(tent, addresses, latency=latency,
+                          failure_rate=failure_rate, seed=seed)
+    sensor_list = [MCP9808(reserved, i2c_bus=i2c)]
+    feed = hardware.SimOutdoorFeed(tent, seed=seed)
+
+    if role == 'heat':
+        from heatcontroller import HeatController
+        controller = HeatController(sensor_list, hardware=simulated,
+                                    outdoor_feed=feed, **controller_args)
+    else:
+        from controlcontroller import ControlController
+        controller = ControlController(sensor_list, hardware=simulated,
+                                       outdoor_feed=feed, **controller_args)
+    return controller, tent, simulated
+
+
+def build_zones(zones=4, sensors=4, start=None, seed=None, latency=0.0,
+                failure_rate=0.0, schedule=None, **controller_args):
+    """
+    Return (controller, tents, hardware) for one heat controller
+    driving `zones` simulated tents. Each tent has its own relay pins
+    and `sensors` MCP9808 sensors on its own I2C bus, which selects
+    the zone's sensors; every zone follows the same schedule.
+    """
+
+    from heatcontroller import HeatController, Zone
+
+    clock = hardware.SimClock(start)
+    simulated = hardware.simulated(clock, co2=hardware.SimCO2(seed=seed))
+
+    tents = []
+    sensor_list = []
+    zone_list = []
+    for i in range(zones):
+        pins = (100 + 3 * i, 101 + 3 * i, 102 + 3 * i)
+        tent = hardware.SimTent(clock, gpio=simulated.gpio, pins=pins)
+        i2c = hardware.SimBus(tent, [FIRST_SENSOR + n for n in range(sensors)],
+                              busnum=i + 1, latency=latency,
+                              failure_rate=failure_rate,
+                              seed=None if seed is None else seed + i)
+        sen = MCP9808([], i2c_bus=i2c, busnum=i + 1)
+        tents.append(tent)
+        sensor_list.append(sen)
+        zone_list.append(Zone('zone%d' % (i + 1), pins=pins,
+                              bus_id=sen.bus_id, schedule=schedule))
+
+    feed = hardware.SimOutdoorFeed(tents[0], seed=seed)
+    controller = HeatController(sensor_list, hardware=simulated,
+                                outdoor_feed=feed, zones=zone_list,
+                                **controller_args)
+    return controller, tents, simulated
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+# Compact snapshots of controller state for warm restarts
+#
+# Usage: python snapshot.py [state.bin]
+# Prints a snapshot.
+#
+# A snapshot is a 24 byte header (magic, format version, CRC-32 of the
+# body and the time it was taken) followed by the last outdoor value
+# and when it was computed, the watchdog's error and reboot counters,
+# the addresses detected for each sensor type and the relay state of
+# each heat zone; well under 100 bytes for a tent. It replaces the
+# previous one by rename, and one that is torn or corrupt fails its
+# CRC and is ignored.
+
+import argparse
+import collections
+import math
+import os
+import struct
+import time
+import zlib
+
+# File magic, format version, CRC-32 of the body and time taken
+HEADER = struct.Struct('<8sHxxId')
+MAGIC = b'TENTSNAP'
+VERSION = 1
+
+# Outdoor value, when it was computed (NaN for none), watchdog errors
+# and reboots, number of sensor types and of zones
+BODY = struct.Struct('<ddIHBB')
+
+# Length of a name, followed by the name in UTF-8
+NAME = struct.Struct('<B')
+
+# Relay state and when the zone's burner last went on or out
+ZONE = struct.Struct('<Bd')
+
+# Relay states, as stored
+STATES = ("OFF", "FAN", "ST1", "ST2")
+
+# Controller state: when it was taken, the outdoor value and when it
+# was computed (None if unknown), the watchdog counters, a list of
+# (sensor type, [addresses]) and a list of (zone, relay state, since)
+Snapshot = collections.namedtuple(
+    'Snapshot', 'stamp outdoor outdoor_updated errors reboots sensors '
+                'zones')
+
+
+def number(value):
+    return float('nan') if value is None else value
+
+
+def optional(value):
+    return None if math.isnan(value) else value
+
+
+def pack_name(name):
+    data = name.encode('utf-8')[:255]
+    return NAME.pack(len(data)) + data
+
+
+def pack(snapshot):
+    """
+    Return a Snapshot as bytes.
+    """
+
+    parts = [BODY.pack(number(snapshot.outdoor),
+                       number(snapshot.outdoor_updated),
+                       snapshot.errors, snapshot.reboots,
+                       len(snapshot.sensors), len(snapshot.zones))]
+    for name, addresses in snapshot.sensors:
+        parts.append(pack_name(name))
+        parts.append(bytearray([len(addresses)] + list(addresses)))
+    for name, state, since in snapshot.zones:
+        parts.append(pack_name(name))
+        parts.append(ZONE.pack(STATES.index(state), number(since)))
+    body = b''.join(bytes(part) for part in parts)
+    return HEADER.pack(MAGIC, VERSION, zlib.crc32(body) & 0xffffffff,
+                       snapshot.stamp) + body
+
+
+def unpack(data):
+    """
+    Return the Snapshot in bytes; raises ValueError if they are not
+    a whole, intact snapshot.
+    """
+
+    try:
+        magic, version, crc, stamp = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a version %d snapshot' % VERSION)
+        body = data[HEADER.size:]
+        if zlib.crc32(body) & 0xffffffff != crc:
+            raise ValueError('Snapshot is corrupt')
+
+        (outdoor, updated, errors, reboots, sensor_types,
+         zone_count) = BODY.unpack_from(body)
+        offset = BODY.size
+
+        def name_at(offset):
+            length, = NAME.unpack_from(body, offset)
+            offset += NAME.size
+            return body[offset:offset + length].decode('utf-8'), \
+                offset + length
+
+        sensors = []
+        for _ in range(sensor_types):
+            name, offset = name_at(offset)
+            count = body[offset]
+            sensors.append((name, list(body[offset + 1:offset + 1 + count])))
+            offset += 1 + count
+        zones = []
+        for _ in range(zone_count):
+            name, offset = name_at(offset)
+            state, since = ZONE.unpack_from(body, offset)
+            zones.append((name, STATES[state], optional(since)))
+            offset += ZONE.size
+    except (struct.error, IndexError, UnicodeDecodeError):
+        raise ValueError('Snapshot is truncated')
+    return Snapshot(stamp, optional(outdoor), optional(updated), errors,
+                    reboots, sensors, zones)
+
+
+def save(filename, snapshot):
+    """
+    Atomically replace the snapshot file.
+    """
+
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'wb') as state:
+        state.write(pack(snapshot))
+    os.rename(tmp_file, filename)
+
+
+def load(filename, max_age=None, now=None):
+    """
+    Return the Snapshot in a file, or None if there is none, it cannot
+    be read or it was taken more than max_age seconds before now.
+    """
+
+    try:
+        with open(filename, 'rb') as state:
+            snapshot = unpack(state.read())
+    except (IOError, OSError, ValueError):
+        return None
+    now = time.time() if now is None else now
+    if max_age is not None and not 0 <= now - snapshot.stamp <= max_age:
+        return None
+    return snapshot
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Print a controller state snapshot.')
+    parser.add_argument('snapshot', nargs='?', default='state.bin',
+                        help='snapshot file (default: state.bin)')
+    args = parser.parse_args(argv)
+
+    snapshot = load(args.snapshot)
+    if snapshot is None:
+        parser.error('%s is not a readable snapshot' % args.snapshot)
+    print('taken %s (%d s ago)' % (
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot.stamp)),
+        time.time() - snapshot.stamp))
+    print('outdoor %r, watchdog %d errors, %d reboots' % (
+        snapshot.outdoor, snapshot.errors, snapshot.reboots))
+    for name, addresses in snapshot.sensors:
+        print('%s sensors at %s' % (
+            name, ' '.join('%02x' % addr for addr in addresses)))
+    for name, state, since in snapshot.zones:
+        print('zone %s relays %s' % (name, state))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+# Heater control strategies for the heat tents
+#
+# A strategy turns the indoor and outdoor temperatures and the wanted
+# differential into a heater state: "OFF", "FAN" (purging the heat
+# exchanger), "ST1" or "ST2". Every strategy keeps the heater on and
+# off for minimum times, so it can be run more often than sensors.csv
+# is written without cycling the heater harder.
+
+from abc import ABCMeta, abstractmethod
+import math
+
+# Temperature reported while the sensors are failing
+SENSOR_FAULT = 90
+
+# Heater states in order of heat output
+STAGES = ("OFF", "ST1", "ST2")
+
+# States with the burner lit
+HEATING = ("ST1", "ST2")
+
+
+def decide(indoor, outdoor, temperature_diff):
+    """
+    Return the heater state called for by the indoor and outdoor
+    temperatures, or None while the sensors are failing so the
+    relays are left as they are.
+    """
+
+    if indoor == SENSOR_FAULT or outdoor == SENSOR_FAULT:
+        return None
+
+    # If indoor temperature is below differential then
+    # engage Stage 2 since the purge period and Stage 1
+    # won't be enough to maintain our differential
+    if indoor - outdoor < temperature_diff:
+        return "ST2"
+
+    # Indoors >= outdoors -- turn off heater.
+    return "OFF"
+
+
+class Strategy(object):
+    """
+    Abstract base class for heater control strategies. Subclasses
+    choose the wanted state; step() holds the heater on for min_on
+    seconds and off for min_off seconds, and runs the fan alone for
+    purge seconds after the burner goes out.
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, min_on=0, min_off=0, purge=0):
+        self.min_on = min_on
+        self.min_off = min_off
+        self.purge = purge
+
+        # The relays are pulled low at startup
+        self.state = "OFF"
+        # When the burner last went on or out, and before the last step
+        self.since = None
+        self.last_since = None
+
+    @abstractmethod
+    def choose(self, stamp, indoor, outdoor, temperature_diff):
+        """
+        Return the wanted state, one of STAGES.
+        """
+
+        pass
+
+    def step(self, stamp, indoor, outdoor, temperature_diff):
+        """
+        Return the heater state for a cycle at stamp, or None while the
+        sensors are failing so the relays are left as they are. A
+        temperature_diff of None turns the heater off.
+        """
+
+        if indoor == SENSOR_FAULT or outdoor == SENSOR_FAULT:
+            return None
+        if temperature_diff is None:
+            wanted = "OFF"
+        else:
+            wanted = self.choose(stamp, indoor, outdoor, temperature_diff)
+        return self.switch(stamp, wanted)
+
+    def switch(self, stamp, wanted):
+        """
+        Move toward the wanted state as far as the minimum on, off and
+        purge times allow, and return the new state.
+        """
+
+        if self.since is None:
+            self.since = stamp
+        self.last_since = self.since
+        held = stamp - self.since
+        heating = self.state in HEATING
+        if (wanted in HEATING) != heating:
+            if held < (self.min_on if heating else self.min_off):
+                # Keep heating at the current stage, or stay off
+                wanted = self.state if heating else "OFF"
+            else:
+                self.since = stamp
+                held = 0
+        if (wanted == "OFF" and held < self.purge and
+                (heating or self.state == "FAN")):
+            wanted = "FAN"
+        self.state = wanted
+        return wanted
+
+    def settle(self, state):
+        """
+        Record the state the relays are in after step(), when they did
+        not follow it, i.e. while they hold the previous state for a
+        minimum dwell.
+        """
+
+        if state == self.state:
+            return
+        if (state in HEATING) != (self.state in HEATING):
+            # The burner did not go on or out after all
+            self.since = self.last_since
+        self.state = state
+
+
+class Threshold(Strategy):
+    """
+    Runs stage two whenever the indoor temperature is less than
+    temperature_diff above outdoors, and turns the heater off
+    otherwise. With a hysteresis band, a running heater is only
+    turned off once the differential reaches temperature_diff + band.
+    """
+
+    def __init__(self, band=0.0, min_on=0, min_off=0, purge=0):
+        Strategy.__init__(self, min_on, min_off, purge)
+        self.band = band
+
+    def choose(self, stamp, indoor, outdoor, temperature_diff):
+        state = decide(indoor, outdoor, temperature_diff)
+        if (state == "OFF" and self.state in HEATING and
+                indoor - outdoor < temperature_diff + self.band):
+            return self.state
+        return state
+
+
+class PID(Strategy):
+    """
+    Proportional-integral-derivative control of the differential. The
+    output, in stages, is rounded to OFF, ST1 or ST2; the integral is
+    frozen while the output is saturated so it does not wind up.
+    Gains are per degree of error, per degree-second and per degree
+    per second.
+    """
+
+    def __init__(self, kp=0.5, ki=0.5 / 1800, kd=0.0, max_step=600,
+                 min_on=180, min_off=180, purge=0):
+        Strategy.__init__(self, min_on, min_off, purge)
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        # Longest gap between cycles integrated, i.e. across a restart
+        self.max_step = max_step
+        self.integral = 0.0
+        self.last = None
+
+    def choose(self, stamp, indoor, outdoor, temperature_diff):
+        error = temperature_diff - (indoor - outdoor)
+        step = 0.0
+        derivative = 0.0
+        if self.last is not None:
+            step = min(stamp - self.last[0], self.max_step)
+            if step > 0:
+                derivative = (error - self.last[1]) / step
+        self.last = (stamp, error)
+
+        integral = self.integral + error * step
+        output = self.kp * error + self.ki * integral + self.kd * derivative
+        if (0 <= output <= len(STAGES) - 1 or
+                (output < 0) == (error > 0)):
+            self.integral = integral
+        level = int(math.floor(output + 0.5))
+        return STAGES[min(len(STAGES) - 1, max(0, level))]
+
+
+class ThermalModel(object):
+    """
+    First-order model of a tent: the indoor temperature relaxes toward
+    outdoors by `loss` of the difference per second, and each heater
+    state adds its rate, in degrees per second.
+    """
+
+    def __init__(self, loss=1.0 / 3600, rates=None):
+        self.loss = loss
+        self.rates = {"OFF": 0.0, "FAN": 0.0, "ST1": 10.0 / 3600,
+                      "ST2": 20.0 / 3600}
+        self.rates.update(rates or {})
+
+    def __repr__(self):
+        return 'ThermalModel(loss=%.3g, ST1=%.3g, ST2=%.3g)' % (
+            self.loss, self.rates["ST1"], self.rates["ST2"])
+
+    def predict(self, indoor, outdoor, state, seconds):
+        """
+        Indoor temperature after `seconds` in a heater state, with
+        the outdoor temperature held.
+        """
+
+        settled = outdoor + self.rates[state] / self.loss
+        return settled + (indoor - settled) * math.exp(-self.loss * seconds)
+
+    @classmethod
+    def fit(cls, stamps, indoor, outdoor, states, max_step=600):
+        """
+        Least-squares fit of a model to a history: sequences of the
+        timestamps, indoor and outdoor temperatures and the heater
+        state that followed each cycle. Steps longer than max_step
+        seconds, faults and missing readings are skipped. A stage that
+        was never used is assumed to give half or twice the heat of
+        the other. Raises ValueError if the history cannot be fitted.
+        """
+
+        # Columns: outdoor - indoor, stage one on, stage two on
+        columns = (0, 1, 2)
+        products = [[0.0] * 4 for _ in columns]
+        used = set()
+        for i in range(len(stamps) - 1):
+            step = stamps[i + 1] - stamps[i]
+            inside, outside, after = indoor[i], outdoor[i], indoor[i + 1]
+            if not 0 < step <= max_step or states[i] is None:
+                continue
+            if (SENSOR_FAULT in (inside, outside, after) or
+                    inside != inside or outside != outside or
+                    after != after):
+                continue
+            row = (outside - inside, float(states[i] == "ST1"),
+                   float(states[i] == "ST2"), (after - inside) / step)
+            if states[i] in HEATING:
+                used.add(states[i])
+            for j in columns:
+                for k in range(4):
+                    products[j][k] += row[j] * row[k]
+
+        if not used:
+            raise ValueError('No heated cycles to fit')
+        keep = [0] + [1 + HEATING.index(state) for state in HEATING
+                      if state in used]
+        solution = solve([[products[j][k] for k in keep] + [products[j][3]]
+                          for j in keep])
+        values = dict(zip(keep, solution))
+        loss = values[0]
+        if loss <= 0:
+            raise ValueError('Fitted heat loss is not positive')
+        one = values.get(1, values.get(2, 0.0) / 2)
+        two = values.get(2, one * 2)
+        return cls(loss, {"ST1": one, "ST2": two})
+
+
+def solve(augmented):
+    """
+    Solve a small linear system given as rows of coefficients followed
+    by the constant, by Gaussian elimination with partial pivoting.
+    """
+
+    rows = [list(row) for row in augmented]
+    size = len(rows)
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            raise ValueError('History does not determine the model')
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, size):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, size + 1):
+                rows[r][c] -= factor * rows[col][c]
+    result = [0.0] * size
+    for r in reversed(range(size)):
+        total = rows[r][size] - sum(rows[r][c] * result[c]
+                                    for c in range(r + 1, size))
+        result[r] = total / rows[r][r]
+    return result
+
+
+class Predictive(Strategy):
+    """
+    Model-predictive control: each cycle, the state whose predicted
+    differential stays closest to the wanted one over the next
+    `horizon` seconds is chosen, with switch_cost degrees counted
+    against changing state.
+    """
+
+    # Points of the horizon at which the prediction is compared
+    POINTS = 4
+
+    def __init__(self, model=None, horizon=300, switch_cost=0.1,
+                 min_on=180, min_off=180, purge=0):
+        Strategy.__init__(self, min_on, min_off, purge)
+        self.model = model or ThermalModel()
+        self.horizon = horizon
+        self.switch_cost = switch_cost
+
+    def choose(self, stamp, indoor, outdoor, temperature_diff):
+        current = self.state if self.state in STAGES else "OFF"
+
+        def cost(state):
+            error = sum(abs(self.model.predict(
+                indoor, outdoor, state, self.horizon * point / self.POINTS)
+                - outdoor - temperature_diff)
+                for point in range(1, self.POINTS + 1))
+            return (error / self.POINTS +
+                    (self.switch_cost if state != current else 0.0))
+        return min(STAGES, key=cost)
+
+
+# Strategies by name, for the command line tools
+STRATEGIES = {'threshold': Threshold, 'pid': PID, 'model': Predictive}
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# I/O error and reboot escalation for the controllers
+
+import codecs
+import logging
+import os
+import subprocess
+import time
+
+# Watchdog states; the state file is only rewritten when these change
+OK = 'OK'
+ERRORING = 'ERRORING'
+REBOOTING = 'REBOOTING'
+EXHAUSTED = 'EXHAUSTED'
+
+
+def system_reboot():
+    """
+    Reboot the Pi.
+    """
+
+    proc = subprocess.Popen('reboot', stdout=subprocess.PIPE, shell=True)
+    proc.communicate()
+
+
+class Watchdog(object):
+    """
+    Tracks consecutive sensor I/O errors and escalates to a reboot.
+    After error_max errors the next error reboots the system, up to
+    reboot_max reboots; past that the system stays online and keeps
+    counting errors. Counters live in memory and the state file is
+    only written, atomically, when the watchdog changes state.
+    """
+
+    def __init__(self, error_max=3, reboot_max=5, state_file='watchdog',
+                 clock=time.time, reboot=system_reboot, logger=None):
+        self.error_max = error_max
+        self.reboot_max = reboot_max
+        self.state_file = state_file
+        self.clock = clock
+        self.reboot = reboot
+        self.logger = logger or logging.getLogger("Controller")
+
+        self.state = OK
+        self.errors = 0
+        self.reboots = 0
+        # Time of the last state transition
+        self.since = clock()
+        # Number of times the state file has been written
+        self.writes = 0
+
+        self.load()
+
+    def load(self):
+        """
+        Restore the counters from the state file. Falls back to the
+        io_error and reboots files written by earlier versions.
+        """
+
+        try:
+            with codecs.open(self.state_file, 'r', 'utf-8') as state:
+                fields = state.read().split()
+            self.state = fields[0]
+            self.errors = int(fields[1])
+            self.reboots = int(fields[2])
+            self.since = float(fields[3])
+            return
+        except (IOError, OSError, IndexError, ValueError):
+            pass
+
+        try:
+            with codecs.open('io_error', 'r', 'utf-8') as io_errors:
+                self.errors = int(io_errors.read())
+            with codecs.open('reboots', 'r', 'utf-8') as reboots:
+                self.reboots = int(reboots.read())
+        except (IOError, OSError, ValueError):
+            self.errors = 0
+            self.reboots = 0
+
+        if self.reboots >= self.reboot_max:
+            self.state = EXHAUSTED
+        elif self.errors or self.reboots:
+            self.state = ERRORING
+
+    def save(self):
+        """
+        Atomically replace the state file with the current counters.
+        """
+
+        tmp_file = self.state_file + '.tmp'
+        with codecs.open(tmp_file, 'w', 'utf-8') as state:
+            state.write('%s %d %d %.3f\n' % (self.state, self.errors,
+                                             self.reboots, self.since))
+            state.flush()
+            os.fsync(state.fileno())
+        os.rename(tmp_file, self.state_file)
+        self.writes += 1
+
+    def transition(self, state):
+        """
+        Enter the given state, persisting only if it changed.
+        """
+
+        if state != self.state:
+            self.state = state
+            self.since = self.clock()
+            self.save()
+
+    def record_error(self):
+        """
+        Record a sensor I/O error, rebooting if the maximum number
+        of errors has been reached and reboots remain.
+        """
+
+        # If maximum reboots not reached, then reboot
+        if (self.errors >= self.error_max and
+           self.reboots < self.reboot_max):
+            self.logger.info('Maximum I/O errors (%d); rebooting.',
+                             self.errors)
+            self.errors = 0
+            self.reboots += 1
+            self.transition(REBOOTING)
+            self.reboot()
+
+        # If maximum reboots reached, stay on
+        elif self.reboots >= self.reboot_max:
+            self.errors += 1
+            self.logger.info('Max reboots (%d) reached; I/O error #%d'
+                             ' occurred', self.reboots, self.errors)
+            self.transition(EXHAUSTED)
+
+        # If maximums not reached, record the error
+        elif self.errors < self.error_max:
+            self.errors += 1
+            self.logger.info('I/O Error #%d occurred', self.errors)
+            self.transition(ERRORING)
+
+    def record_success(self):
+        """
+        Record a cycle without I/O errors and reset the counters.
+        """
+
+        if self.errors or self.reboots or self.state != OK:
+            self.logger.info('No I/O error detected; ' +
+                             'resetting number of errors and reboots')
+            self.errors = 0
+            self.reboots = 0
+            self.transition(OK)